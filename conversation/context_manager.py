@@ -0,0 +1,126 @@
+# context_manager.py
+import os
+import re
+import logging
+import storage
+from token_counter import count_tokens
+
+logger = logging.getLogger()
+
+# File contents in the initial review prompt; the patches are kept when the prompt is compressed
+FILE_CONTENT_BLOCK = re.compile(
+    r"\n\n(?:Full Content|Content Around Changes):\n.*?(?=---------------File changed---------------|\Z)",
+    re.DOTALL,
+)
+
+SUMMARY_PROMPT = (
+    "Summarize the following discussion between a developer and an AI reviewer about a pull request. "
+    "Keep every decision, open question, code suggestion and fact the developer stated, and drop pleasantries. "
+    "Answer with the summary only."
+)
+
+
+def compress_pr_context(content, max_tokens):
+    """Shrinks the initial review prompt to max_tokens: file contents go first, then the tail of the patches."""
+    if count_tokens(content) <= max_tokens:
+        return content
+    compressed = FILE_CONTENT_BLOCK.sub("\n", content)
+    if count_tokens(compressed) <= max_tokens:
+        return compressed
+    # Cut proportionally and re-check, the token count of a prefix is not linear in its length
+    while count_tokens(compressed) > max_tokens:
+        compressed = compressed[:int(len(compressed) * max_tokens / count_tokens(compressed) * 0.95)]
+    return compressed + "\n... (the rest of the pull request was omitted to fit the context) ..."
+
+
+class ContextManager:
+    """Chooses the messages sent to GPT for a follow-up question in a conversation.
+
+    The initial pull request prompt is pinned in compressed form together with the review, the
+    most recent turns are kept verbatim within the token budget, and older turns are folded into
+    a rolling summary stored with the conversation so that it is only extended, never recomputed.
+    The caller stores the returned updates together with the reply.
+    """
+
+    def __init__(self, collection, summarize, max_tokens=16000, pinned_max_tokens=8000, summary_model="gpt-3.5-turbo"):
+        self.collection = collection
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self.pinned_max_tokens = pinned_max_tokens
+        self.summary_model = summary_model
+
+    @classmethod
+    def from_env(cls, collection, summarize):
+        return cls(
+            collection,
+            summarize if os.getenv("CONTEXT_SUMMARIZE", "true").lower() == "true" else None,
+            max_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", 16000)),
+            pinned_max_tokens=int(os.getenv("CONTEXT_PINNED_MAX_TOKENS", 8000)),
+            summary_model=os.getenv("CONTEXT_SUMMARY_MODEL", "gpt-3.5-turbo"),
+        )
+
+    def _load_pr_prompt(self, uuid):
+        conversation = self.collection.find_one({"uuid": uuid}, {"_id": 0, "prompt": 1})
+        return storage.decompress_text(conversation["prompt"])
+
+    def build(self, conversation):
+        """Returns the messages to send and the fields to $set on the conversation afterwards.
+
+        The conversation holds the messages that are not folded into the summary yet; the PR prompt
+        is loaded only until its compressed form has been stored. The system prompt is never sent
+        for follow-ups. Ref: issue #41
+        """
+        messages = conversation.get("messages", [])
+        turns = [{"role": message["role"], "content": message["content"]} for message in messages]
+        if conversation.get("review") is None:
+            # The review has not been posted yet, nothing to pin
+            return turns, {}
+
+        context = conversation.get("context", {})
+        updates = {}
+        pinned = context.get("pinned")
+        if pinned is None:
+            pinned = compress_pr_context(self._load_pr_prompt(conversation["uuid"]), self.pinned_max_tokens)
+            updates["context.pinned"] = pinned
+        head = [{"role": "user", "content": pinned}, {"role": "assistant", "content": conversation["review"]}]
+
+        # Keep the newest turns that fit next to the pinned context and the summary
+        summary = context.get("summary")
+        budget = self.max_tokens - sum(count_tokens(message["content"]) for message in head)
+        if summary:
+            budget -= count_tokens(summary)
+        window_start = len(turns)
+        while window_start > 0:
+            tokens = count_tokens(turns[window_start - 1]["content"])
+            # The newest message is always sent, even if it alone exceeds the budget
+            if tokens > budget and window_start < len(turns):
+                break
+            budget -= tokens
+            window_start -= 1
+
+        if window_start > 0:
+            dropped = turns[:window_start]
+            if self.summarize is not None:
+                try:
+                    summary = self.summarize(self.summary_model, summary, dropped)
+                    updates["context.summary"] = summary
+                    # The seq of the first message that is not in the summary; the newest message is always kept
+                    updates["context.summarized_upto"] = messages[window_start]["seq"]
+                except Exception as e:
+                    # Answer without the dropped turns rather than failing the user's question
+                    logger.error(f"Error while summarizing the conversation history: {e}")
+            logger.info(f"{len(dropped)} older message(s) left the context window")
+
+        if summary:
+            head.append({"role": "system", "content": f"Summary of the earlier discussion:\n{summary}"})
+        return head + turns[window_start:], updates
+
+
+def summary_messages(previous_summary, turns):
+    transcript = "\n\n".join(f"{turn['role'].upper()}: {turn['content']}" for turn in turns)
+    if previous_summary:
+        transcript = f"Summary of the discussion so far:\n{previous_summary}\n\nLater messages:\n{transcript}"
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": transcript},
+    ]
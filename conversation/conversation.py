@@ -1,42 +1,146 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session
-from pymongo import MongoClient
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, render_template, redirect, url_for, session, stream_with_context
+from pymongo import ReturnDocument
+from datetime import datetime, timedelta
+import storage
+import metrics
 import os
-import openai
+import json
+import gzip
+from context_manager import ContextManager, summary_messages
+from retention import ConversationArchive
+from llm_client import LLMClient
+from llm_scheduler import INTERACTIVE, TokenBudget
+from llm_cache import CompletionCache
+from token_counter import count_tokens
+from readiness import Readiness
 
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY_FOR_SESSION")  # 用于Flask session
+try:
+    import brotli
+except ImportError:
+    # 没有安装brotli时只使用gzip压缩
+    brotli = None
 
-client = MongoClient('mongodb', 27017)
-db = client['pr_review']
-collection = db['review_comments_and_conversations']
+# 路由注册在create_app创建的应用上
+bp = Blueprint("conversation", __name__)
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+collection = storage.LazyCollection(storage.CONVERSATIONS)
+buckets = storage.LazyCollection(storage.CONVERSATION_BUCKETS)
 
-@app.before_request
+# 长期没有活动的对话由retention.py移到压缩的归档集合中，访问时自动移回
+archive = ConversationArchive.from_env(collection, buckets, storage.LazyCollection(storage.CONVERSATION_ARCHIVE))
+
+# 调用GPT的客户端（默认为OpenAI，见llm_client.py）以及对话使用的模型
+# 与pr_review服务共用MongoDB中每分钟的token和请求数预算（LLM_TPM_LIMITS/LLM_RPM_LIMITS，见llm_scheduler.py），
+# 对话请求的优先级高于PR审查
+llm_client = LLMClient.from_env(TokenBudget.from_env(storage.LazyCollection(storage.LLM_BUDGET)))
+chat_model = os.getenv("CHAT_MODEL", "gpt-4-1106-preview")
+
+# 相同的问题和上下文直接返回缓存的回复，与pr_review服务共用MongoDB中的缓存
+completion_cache = CompletionCache.from_env(storage.LazyCollection(storage.LLM_CACHE), llm_client)
+
+def summarize_history(model, previous_summary, turns):
+    completion = completion_cache.create(
+        model=model,
+        messages=summary_messages(previous_summary, turns),
+        priority=INTERACTIVE,
+    )
+    return completion["content"].strip()
+
+# 控制每轮对话发送给GPT的历史消息：固定压缩后的PR内容，保留最近的消息，更早的消息合并为摘要
+context_manager = ContextManager.from_env(collection, summarize_history)
+
+# 一轮对话等待GPT回复的最长时间，超时后允许发送新消息（例如处理该轮的进程已崩溃）
+pending_turn_timeout = int(os.getenv("PENDING_TURN_TIMEOUT_SECONDS", 300))
+
+# 对话页面每次加载的消息条数
+page_size = int(os.getenv("CONVERSATION_PAGE_SIZE", 50))
+MAX_PAGE_SIZE = 500
+
+# 小于该大小的响应不压缩，压缩带来的节省抵不上开销
+compress_min_bytes = int(os.getenv("COMPRESS_MIN_BYTES", 1024))
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/html")
+
+# 就绪探测只依赖MongoDB；OpenAI不可用时对话请求会返回错误，但不应让pod退出Service
+readiness = Readiness.from_env({"mongodb": storage.ping})
+
+def start_process():
+    # 在当前进程中启动一次就绪探测；gunicorn_config.py在worker启动时调用
+    readiness.start()
+
+def create_app():
+    # 返回WSGI应用。preload_app时在gunicorn master中运行，因此不建立连接也不启动线程，
+    # 各个客户端在每个worker中第一次使用时创建，见start_process
+    app = Flask(__name__)
+    app.secret_key = os.getenv("SECRET_KEY_FOR_SESSION")  # 用于Flask session
+    app.register_blueprint(bp)
+    # 加载tokenizer，preload时由所有worker共享
+    count_tokens("")
+    return app
+
+@bp.before_app_request
+def start_process_on_first_request():
+    start_process()
+
+@bp.before_app_request
 def require_login():
     # 列出不需要登录就可以访问的端点
-    allowed_routes = ['login', 'healthz']
+    allowed_routes = ['conversation.login', 'conversation.healthz', 'conversation.readyz',
+                      'conversation.cache_stats', 'conversation.prometheus_metrics']
     if 'logged_in' not in session and request.endpoint not in allowed_routes:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
+
+@bp.after_app_request
+def compress_response(response):
+    # 流式响应（SSE）不压缩，否则浏览器要等整个回复生成完才能显示
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < compress_min_bytes:
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        # 较低的压缩级别：响应是动态生成的，压缩速度比压缩率更重要
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers["Content-Encoding"] = "br"
+    elif accepted["gzip"]:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
 
-@app.route('/healthz')
+@bp.route('/healthz')
 def healthz():
-    # 目前比较简单，后续可以添加任何需要的健康检查逻辑
+    # 进程存活即返回成功；依赖是否可用见/readyz
     return "Healthy", 200
 
-@app.route('/conversation')
+@bp.route('/readyz')
+def readyz():
+    # 只读取探测线程缓存的结果，见readiness.py
+    ready, probes = readiness.status()
+    return jsonify({"ready": ready, "probes": probes}), 200 if ready else 503
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    return metrics.metrics_response()
+
+@bp.route('/cache_stats')
+def cache_stats():
+    return jsonify({"llm": completion_cache.stats()})
+
+@bp.route('/conversation')
 def index():
     if 'logged_in' in session:
         return render_template('template.html')
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         password = request.form.get('password')
         if password == os.getenv("LOGIN_PASSWORD"):  # 替换为您的密码
             session['logged_in'] = True
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
         else:
             return "Wrong password!", 401
     return '''
@@ -46,45 +150,243 @@ def login():
         </form>
     '''
 
-@app.route('/get-conversation/<uuid>', methods=['GET'])
+@bp.route('/get-conversation/<uuid>', methods=['GET'])
 def get_conversation(uuid):
-    conversation = collection.find_one({"uuid": uuid})
-    messages = conversation.get('messages', []) if conversation else []
-    return jsonify(messages)
+    # 返回最新一页消息、编号`before`之前的一页消息，或编号`since`及之后的消息。到达对话开头的那一页
+    # 以PR审查内容开始。`next`是获取本次响应之后的消息时作为`since`传入的编号。
+    #
+    # 对话的version随这里可见的每次改动而变化，所以只要version不变，同一URL的响应就相同，
+    # If-None-Match匹配的请求直接返回304，不读取消息
+    before = request.args.get('before', type=int)
+    since = request.args.get('since', type=int)
+    limit = min(request.args.get('limit', page_size, type=int), MAX_PAGE_SIZE)
+    projection = {"_id": 0, "review": 1, "message_count": 1, "bucket_size": 1, "version": 1, "archived": 1}
+    conversation = collection.find_one({"uuid": uuid}, projection)
+    if conversation is None:
+        return jsonify({"messages": [], "before": None, "next": 0})
+    etag = str(conversation.get("version", 0))
+    if request.if_none_match.contains_weak(etag):
+        # 归档的对话保留了version，所以这里也不需要先把它移回
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        response.cache_control.no_cache = True
+        response.cache_control.private = True
+        return response
+    if "archived" in conversation:
+        if not archive.rehydrate(uuid):
+            return jsonify({"status": "error", "message": "The conversation is being restored, please retry"}), 503
+        conversation = collection.find_one({"uuid": uuid}, projection)
 
-@app.route('/add-message', methods=['POST'])
+    message_count = conversation["message_count"]
+    if since is not None:
+        start = min(max(since, 0), message_count)
+        end = min(start + limit, message_count)
+    else:
+        end = message_count if before is None else min(before, message_count)
+        start = max(end - limit, 0)
+    messages = storage.read_messages(buckets, uuid, conversation["bucket_size"], start, end)
+    # message_count在消息写入bucket之前增加，所以某条消息可能短暂缺失；此时只返回缺失之前的消息，
+    # 并且响应不缓存
+    next_seq = start
+    while next_seq - start < len(messages) and messages[next_seq - start]["seq"] == next_seq:
+        next_seq += 1
+    complete = next_seq == end
+    del messages[next_seq - start:]
+    if start == 0 and since is None and conversation.get("review") is not None:
+        messages.insert(0, {"role": "assistant", "content": conversation["review"]})
+
+    response = jsonify({"messages": messages, "before": start if start > 0 and since is None else None, "next": next_seq})
+    if complete:
+        response.set_etag(etag, weak=True)
+        response.cache_control.no_cache = True
+        response.cache_control.private = True
+    else:
+        response.cache_control.no_store = True
+    return response
+
+def begin_turn(uuid, content, rehydrate=True):
+    # 追加用户的消息，返回对话以及构建上下文所需的消息
+    #
+    # 一个对话同时只能有一轮在进行：之前的消息还在等待回复时拒绝追加，除非那一轮已经等待太久
+    now = datetime.utcnow()
+    conversation = collection.find_one_and_update(
+        {
+            "uuid": uuid,
+            "archived": {"$exists": False},
+            "$or": [
+                {"pending": {"$ne": True}},
+                {"pending_since": {"$lt": now - timedelta(seconds=pending_turn_timeout)}},
+            ],
+        },
+        {
+            "$inc": {"turn": 1, "message_count": 1, "version": 1},
+            "$set": {"pending": True, "pending_since": now, "last_active_at": now},
+        },
+        # 不需要读取提示词，见ContextManager
+        projection={"uuid": 1, "turn": 1, "context": 1, "review": 1, "message_count": 1, "bucket_size": 1, "metadata.repo": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if conversation is None:
+        # 归档的对话只剩下占位文档，先把它移回再重试一次
+        if rehydrate and archive.rehydrate(uuid):
+            return begin_turn(uuid, content, rehydrate=False)
+        return None
+
+    # 将用户消息保存到MongoDB
+    seq = conversation["message_count"] - 1
+    bucket_size = conversation["bucket_size"]
+    messages = storage.append_message(buckets, uuid, bucket_size, seq, {"role": "user", "content": content})
+    # 已经合并进摘要的消息不再读取；其余的消息通常都在刚写入的bucket中
+    start = conversation.get("context", {}).get("summarized_upto", 0)
+    if start // bucket_size < seq // bucket_size:
+        messages = storage.read_messages(buckets, uuid, bucket_size, start, seq // bucket_size * bucket_size) + messages
+    conversation["messages"] = storage.in_range(messages, start)
+    return conversation
+
+def finish_turn(uuid, turn, reply, usage, context_updates):
+    # token用量和上下文记录一次写入；只有在此期间没有开始新的一轮时才生效，
+    # 所以回复不会和另一个标签页的消息交错
+    update = {
+        "$set": {"pending": False, **context_updates},
+        "$unset": {"pending_since": ""},
+    }
+    if reply is not None:
+        update["$set"]["last_usage"] = usage
+        update["$inc"] = {
+            "message_count": 1,
+            "version": 1,
+            "usage.prompt_tokens": usage["prompt_tokens"],
+            "usage.completion_tokens": usage["completion_tokens"],
+        }
+    conversation = collection.find_one_and_update(
+        {"uuid": uuid, "turn": turn},
+        update,
+        projection={"_id": 0, "message_count": 1, "bucket_size": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if conversation is None:
+        current_app.logger.warning(f"Conversation {uuid} moved past turn {turn}, dropping its reply")
+        return
+    if reply is not None:
+        # 将GPT-4的回复保存到MongoDB
+        storage.append_message(buckets, uuid, conversation["bucket_size"], conversation["message_count"] - 1, reply)
+
+def turn_rejected(uuid):
+    if collection.count_documents({"uuid": uuid}, limit=1) == 0:
+        return jsonify({"status": "error", "message": "Conversation not found"}), 404
+    return jsonify({"status": "error", "message": "Another message in this conversation is still being answered"}), 409
+
+@bp.route('/add-message', methods=['POST'])
 def add_message():
     data = request.json
     uuid = data['uuid']
-    user_message = {
-        "role": "user",
-        "content": data['content']
+    conversation = begin_turn(uuid, data['content'])
+    if conversation is None:
+        return turn_rejected(uuid)
+
+    reply, usage, context_updates = None, None, {}
+    try:
+        messages_to_send, context_updates = context_manager.build(conversation)
+        completion = completion_cache.create(
+            model=chat_model,
+            messages=messages_to_send,
+            bypass=data.get('bypass_cache', False),
+            repo=conversation_repo(conversation),
+            priority=INTERACTIVE,
+        )
+        reply = {"role": "assistant", "content": completion["content"]}
+        usage = completion["usage"]
+    finally:
+        finish_turn(uuid, conversation["turn"], reply, usage, context_updates)
+
+    return jsonify({"status": "success"})
+
+def conversation_repo(conversation):
+    # 用于按仓库统计GPT请求的指标，旧的对话记录没有仓库信息
+    return conversation.get("metadata", {}).get("repo", "")
+
+def sse_event(data, event=None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+def stream_usage(messages, content):
+    # 流式回复不带用量信息，所以在本地计算
+    return {
+        "prompt_tokens": sum(count_tokens(message["content"]) for message in messages),
+        "completion_tokens": count_tokens(content),
     }
 
-    # 将用户消息保存到MongoDB
-    collection.update_one({"uuid": uuid}, {"$push": {"messages": user_message}})
-    # 从MongoDB中获取与该uuid相关的历史对话
-    conversation = collection.find_one({"uuid": uuid})
-    messages = conversation.get('messages', []) if conversation else []
-
-    # Don't include the initial system prompt when generating subsequent conversation. Ref: issue #41
-    if len(messages) > 1 and messages[0].get("role") == "system":
-        # Exclude the first message (initial system prompt)
-        messages_to_send = messages[1:]
-    else:
-        # Otherwise, send all messages
-        messages_to_send = messages
+@bp.route('/add-message-stream', methods=['POST'])
+def add_message_stream():
+    # 与/add-message相同，但在GPT生成回复的同时以server-sent events转发给浏览器
+    data = request.json
+    uuid = data['uuid']
+    conversation = begin_turn(uuid, data['content'])
+    if conversation is None:
+        return turn_rejected(uuid)
+
+    content = ""
+    cached = None
+    finished = False
+    messages_to_send, context_updates = [], {}
+
+    def finish():
+        # 只保存一次回复，并在最后一个事件之前保存，这样页面下一次获取时能看到它
+        nonlocal finished
+        if finished:
+            return
+        finished = True
+        reply, usage = None, None
+        if content:
+            reply = {"role": "assistant", "content": content}
+            usage = stream_usage(messages_to_send, content) if cached is None else {"prompt_tokens": 0, "completion_tokens": 0}
+        finish_turn(uuid, conversation["turn"], reply, usage, context_updates)
 
-    completion = openai.ChatCompletion.create(
-        model="gpt-4-1106-preview",
-        messages=messages_to_send
+    def generate():
+        nonlocal content, cached, messages_to_send, context_updates
+        try:
+            messages_to_send, context_updates = context_manager.build(conversation)
+            cached = completion_cache.get(chat_model, messages_to_send, bypass=data.get('bypass_cache', False))
+            if cached is not None:
+                content = cached["content"]
+                yield sse_event({"delta": content})
+            else:
+                finish_reason = None
+                repo = conversation_repo(conversation)
+                for delta, chunk_finish_reason in llm_client.stream(chat_model, messages_to_send, repo=repo, priority=INTERACTIVE):
+                    finish_reason = chunk_finish_reason or finish_reason
+                    if delta:
+                        content += delta
+                        yield sse_event({"delta": delta})
+                usage = stream_usage(messages_to_send, content)
+                metrics.observe_llm_usage(chat_model, repo, usage)
+                if finish_reason in (None, "stop"):
+                    completion_cache.put(chat_model, messages_to_send, content, usage)
+            finish()
+            yield sse_event({"status": "success"}, event="done")
+        except Exception as e:
+            current_app.logger.error(f"Error while streaming the response from OpenAI API: {e}")
+            finish()
+            yield sse_event({"status": "error"}, event="error")
+        finally:
+            # 浏览器中途断开时也会执行，已经生成的部分会被保存
+            finish()
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    gpt_response = completion.choices[0].message
+    # 浏览器在收到第一个事件前断开时generate不会开始执行，它的finally也不会运行，
+    # 所以在响应关闭时再结束一次本轮对话，否则这个对话会一直停留在进行中
+    app = current_app._get_current_object()
 
-    # 将GPT-4的回复保存到MongoDB
-    collection.update_one({"uuid": uuid}, {"$push": {"messages": gpt_response}})
+    def finish_on_close():
+        with app.app_context():
+            finish()
 
-    return jsonify({"status": "success"})
+    response.call_on_close(finish_on_close)
+    return response
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0')
+    create_app().run(host='0.0.0.0')
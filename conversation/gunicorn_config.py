@@ -1,14 +1,16 @@
 # gunicorn_config.py
+import os
+import shutil
 
 # 服务器套接字
 bind = '0.0.0.0:5000'      # 绑定ip和端口号
 backlog = 512               # 监听队列
 
 # 工作进程设置
-workers = 1                 # 进程数
-worker_class = 'sync'       # 使用同步模型
-worker_connections = 1000   # 最大客户端并发数量
-timeout = 30                # 超时时间
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))  # 进程数
+worker_class = 'gevent'     # 使用gevent协程模型，等待OpenAI和MongoDB返回时不阻塞其他对话
+worker_connections = 1000   # 每个进程最大客户端并发数量
+timeout = 30                # 超时时间，gevent模型下用于检测卡死的进程，不限制单个请求的时长
 keepalive = 2               # 在keep-alive连接上等待请求的秒数
 
 # 安全设置
@@ -16,6 +18,16 @@ limit_request_line = 4094   # HTTP请求行的最大大小
 limit_request_fields = 20   # HTTP请求头的最大数量
 limit_request_field_size = 8190  # HTTP请求头的最大大小（字节）
 
+# 预加载应用：master进程导入代码和tokenizer后再fork出worker，worker以写时复制的方式共享这部分内存，
+# 新worker启动时无需重新导入。MongoDB、GitHub、OpenAI的客户端和后台线程在每个worker中首次使用时创建
+preload_app = os.environ.get('GUNICORN_PRELOAD_APP', 'true').lower() == 'true'
+
+# preload时应用在master进程中导入，早于gevent worker打补丁的时间；
+# 在导入应用之前打补丁，否则已导入的ssl、threading等模块不会被替换为gevent的版本
+if preload_app and worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 # 调试设置
 reload = False              # 开发环境下设置为True，生产环境下为False
 
@@ -24,3 +36,22 @@ loglevel = 'info'           # 日志级别
 accesslog = '-'             # 访问日志文件，'-' 表示输出到标准输出
 errorlog = '-'              # 错误日志文件，'-' 表示输出到标准输出
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'  # 自定义访问日志格式
+
+# Prometheus指标
+# 多进程模式：每个worker把指标写入该目录下的文件，/metrics汇总所有worker的指标。
+# 在worker导入prometheus_client之前设置，worker从master进程继承该环境变量。
+prometheus_multiproc_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+
+def on_starting(server):
+    # 清除上次运行留下的指标文件
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+def post_worker_init(worker):
+    # 在处理第一个请求之前启动后台线程和就绪探测（同时建立MongoDB连接），见conversation.start_process
+    import conversation
+    conversation.start_process()
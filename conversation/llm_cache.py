@@ -0,0 +1,120 @@
+# llm_cache.py
+# Chat completion cache shared by the pr_review and conversation services; keep both copies in sync.
+import os
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from content_cache import LRUCache
+from llm_scheduler import BULK
+
+logger = logging.getLogger()
+
+
+def cache_key(model, messages):
+    # Only the role and the content are sent to the model; whitespace around a message does not change the answer
+    normalized = [{"role": message["role"], "content": message["content"].strip()} for message in messages]
+    data = json.dumps([model, normalized], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """Caches chat completions by model and messages, in process and in MongoDB.
+
+    The in-process LRU serves repeats within a worker; the MongoDB tier is shared by the workers of
+    both services and survives restarts, and its entries are removed by a TTL index when they expire.
+    """
+
+    def __init__(self, collection, client, enabled=True, memory_max_bytes=32 * 1024 * 1024,
+                 ttl_seconds=7 * 24 * 3600, max_entry_bytes=1024 * 1024):
+        self.collection = collection
+        self.client = client
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.max_entry_bytes = max_entry_bytes
+        self.memory = LRUCache(memory_max_bytes, ttl_seconds, sizeof=lambda entry: len(entry["content"]))
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "mongo_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "errors": 0}
+
+    @classmethod
+    def from_env(cls, collection, client):
+        return cls(
+            collection,
+            client,
+            enabled=os.environ.get("LLM_CACHE_ENABLED", "true").lower() == "true",
+            memory_max_bytes=int(os.environ.get("LLM_CACHE_MEMORY_MAX_BYTES", 32 * 1024 * 1024)),
+            ttl_seconds=int(os.environ.get("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600)),
+            max_entry_bytes=int(os.environ.get("LLM_CACHE_MAX_ENTRY_BYTES", 1024 * 1024)),
+        )
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def get(self, model, messages, bypass=False):
+        """Returns the cached {"content", "usage"} of a completion, or None."""
+        if not self.enabled or bypass:
+            self._count("bypassed")
+            return None
+        key = cache_key(model, messages)
+        entry = self.memory.get(key)
+        if entry is not None:
+            self._count("memory_hits")
+            return entry
+        try:
+            document = self.collection.find_one(
+                {"_id": key, "expires_at": {"$gt": datetime.utcnow()}},
+                {"_id": 0, "content": 1, "usage": 1},
+            )
+        except Exception as e:
+            # The cache is an optimization, a MongoDB problem must not fail the completion
+            logger.error(f"Error while reading the completion cache from MongoDB: {e}")
+            self._count("errors")
+            return None
+        if document is None:
+            self._count("misses")
+            return None
+        self.memory.put(key, document)
+        self._count("mongo_hits")
+        return document
+
+    def put(self, model, messages, content, usage):
+        if not self.enabled or len(content.encode("utf-8")) > self.max_entry_bytes:
+            return
+        key = cache_key(model, messages)
+        entry = {"content": content, "usage": usage}
+        self.memory.put(key, entry)
+        now = datetime.utcnow()
+        try:
+            self.collection.replace_one(
+                {"_id": key},
+                {**entry, "model": model, "created_at": now, "expires_at": now + timedelta(seconds=self.ttl_seconds)},
+                upsert=True,
+            )
+        except Exception as e:
+            logger.error(f"Error while storing a completion in the MongoDB cache: {e}")
+            self._count("errors")
+            return
+        self._count("stores")
+
+    def create(self, model, messages, bypass=False, repo="", priority=BULK):
+        """Returns {"content", "usage", "cached"} of a chat completion, answering from the cache when possible.
+
+        A bypassed call still refreshes the cache with its answer. Cached answers report no token usage.
+        repo and priority are passed to LLMClient.complete.
+        """
+        entry = self.get(model, messages, bypass)
+        if entry is not None:
+            return {"content": entry["content"], "usage": {"prompt_tokens": 0, "completion_tokens": 0}, "cached": True}
+
+        completion = self.client.complete(model, messages, repo=repo, priority=priority)
+        # Answers cut off by the token limit or a content filter are not worth repeating
+        if completion["finish_reason"] in (None, "stop"):
+            self.put(model, messages, completion["content"], completion["usage"])
+        return {"content": completion["content"], "usage": completion["usage"], "cached": False}
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        return {"enabled": self.enabled, **counters, "memory": self.memory.stats()}
@@ -0,0 +1,205 @@
+# llm_client.py
+# Chat completion client shared by the pr_review and conversation services; keep both copies in sync.
+import os
+import time
+import random
+import logging
+import openai
+import requests
+import metrics
+from llm_scheduler import BULK, LLMScheduler
+
+logger = logging.getLogger()
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.TryAgain,
+)
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    # 5xx answers that have no more specific error class
+    return isinstance(error, openai.error.APIError) and (error.http_status is None or error.http_status >= 500)
+
+
+class SharedSession(requests.Session):
+    """A session shared by all threads, which openai must not close.
+
+    openai 0.28 gives each thread its own session and closes and replaces it once it is older than
+    MAX_SESSION_LIFETIME_SECS. With openai.requestssession set to a session instance every thread
+    gets that same instance, so closing it would drop the pooled connections of all other threads.
+    """
+
+    def close(self):
+        pass
+
+
+class OpenAIProvider:
+    """The OpenAI chat completions API, or any compatible server such as conversation/test/fake_openai_server.py."""
+
+    def __init__(self, api_key, api_base=None, pool_size=32):
+        openai.api_key = api_key
+        if api_base:
+            openai.api_base = api_base
+        self.pool_size = pool_size
+        self._session_pid = None
+
+    def _ensure_session(self):
+        # openai keeps one session per thread, so every short-lived executor thread opened new
+        # connections; one pooled session is shared by all threads instead. It is created in the
+        # process that sends the requests, since pooled connections must not be shared across fork()
+        if self._session_pid == os.getpid():
+            return
+        session = SharedSession()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        openai.requestssession = session
+        self._session_pid = os.getpid()
+
+    def complete(self, model, messages, timeout):
+        self._ensure_session()
+        completion = openai.ChatCompletion.create(model=model, messages=messages, request_timeout=timeout)
+        choice = completion.choices[0]
+        return {
+            "content": choice["message"]["content"],
+            "usage": {
+                "prompt_tokens": completion.usage["prompt_tokens"],
+                "completion_tokens": completion.usage["completion_tokens"],
+            },
+            "finish_reason": choice.get("finish_reason"),
+        }
+
+    def stream(self, model, messages, timeout):
+        # The request is sent here, so errors are raised before the first chunk is read
+        self._ensure_session()
+        completion = openai.ChatCompletion.create(model=model, messages=messages, stream=True, request_timeout=timeout)
+
+        def chunks():
+            for chunk in completion:
+                choice = chunk.choices[0]
+                yield choice["delta"].get("content") or "", choice.get("finish_reason")
+
+        return chunks()
+
+
+PROVIDERS = {
+    "openai": lambda: OpenAIProvider(
+        os.environ.get("OPENAI_API_KEY"),
+        os.environ.get("OPENAI_API_BASE"),
+        pool_size=int(os.environ.get("LLM_CONNECTION_POOL_SIZE", 32)),
+    ),
+}
+
+
+class LLMClient:
+    """Sends chat completions through a provider with a timeout, retries and per-model concurrency limits.
+
+    Rate limits, timeouts, connection errors and 5xx answers are retried with exponential backoff and
+    jitter, honouring Retry-After. Requests wait in an LLMScheduler for a concurrency slot of their
+    model and for room in the token budget, by priority and taking turns by repo, instead of running
+    into the provider's rate limit.
+    """
+
+    def __init__(self, provider, timeout_seconds=120, max_retries=3, retry_backoff_seconds=1.0,
+                 max_concurrency=8, model_concurrency=None, budget=None, estimated_completion_tokens=1000):
+        self.provider = provider
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = model_concurrency or {}
+        self.scheduler = LLMScheduler(self.concurrency_of, budget, estimated_completion_tokens)
+
+    @classmethod
+    def from_env(cls, budget=None):
+        # budget is the llm_scheduler.TokenBudget shared with the other pods, if any
+        # LLM_MODEL_CONCURRENCY overrides the limit per model, e.g. "gpt-4-1106-preview=4,gpt-3.5-turbo=16"
+        model_concurrency = {}
+        for item in os.environ.get("LLM_MODEL_CONCURRENCY", "").split(","):
+            if "=" in item:
+                model, limit = item.split("=", 1)
+                model_concurrency[model.strip()] = int(limit)
+        return cls(
+            PROVIDERS[os.environ.get("LLM_PROVIDER", "openai")](),
+            timeout_seconds=float(os.environ.get("LLM_TIMEOUT_SECONDS", 120)),
+            max_retries=int(os.environ.get("LLM_MAX_RETRIES", 3)),
+            retry_backoff_seconds=float(os.environ.get("LLM_RETRY_BACKOFF_SECONDS", 1)),
+            max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", 8)),
+            model_concurrency=model_concurrency,
+            budget=budget,
+            estimated_completion_tokens=int(os.environ.get("LLM_ESTIMATED_COMPLETION_TOKENS", 1000)),
+        )
+
+    def concurrency_of(self, model):
+        return self.model_concurrency.get(model, self.max_concurrency)
+
+    def _with_retries(self, model, call):
+        attempt = 0
+        while True:
+            try:
+                return call()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = self.retry_backoff_seconds * (2 ** attempt) * random.uniform(0.5, 1.5)
+                retry_after = getattr(e, "headers", None) and e.headers.get("retry-after")
+                if retry_after:
+                    try:
+                        delay = max(delay, float(retry_after))
+                    except ValueError:
+                        pass
+                attempt += 1
+                if isinstance(e, openai.error.RateLimitError):
+                    # The other requests to the model would only run into the same limit
+                    self.scheduler.pause(model, delay)
+                logger.warning(f"Request to {model} failed, retry {attempt} of {self.max_retries} in {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    def complete(self, model, messages, repo="", priority=BULK):
+        """Returns {"content", "usage", "finish_reason"} of a chat completion.
+
+        repo labels its metrics and is the unit of fairness in the scheduler, priority is one of the
+        llm_scheduler priorities. The duration includes the wait for the scheduler.
+        """
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            with self.scheduler.admit(model, messages, repo, priority) as settle:
+                completion = self._with_retries(model, lambda: self.provider.complete(model, messages, self.timeout_seconds))
+                settle(completion["usage"])
+            outcome = "success"
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe_llm_request(model, repo, elapsed, outcome)
+        cost = metrics.observe_llm_usage(model, repo, completion["usage"])
+        logger.info(
+            f"Request to {model} took {elapsed * 1000:.0f}ms",
+            extra={"model": model, "duration_ms": round(elapsed * 1000), **completion["usage"], "cost_usd": cost},
+        )
+        return completion
+
+    def stream(self, model, messages, repo="", priority=BULK):
+        """Yields (delta, finish_reason) of a streamed chat completion; the model slot is held until the stream ends.
+
+        Streams carry no token usage, the caller records it with metrics.observe_llm_usage; the token
+        budget keeps the estimate.
+        """
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            with self.scheduler.admit(model, messages, repo, priority):
+                chunks = self._with_retries(model, lambda: self.provider.stream(model, messages, self.timeout_seconds))
+                yield from chunks
+            outcome = "success"
+        except GeneratorExit:
+            # The consumer stopped reading, e.g. the browser went away
+            outcome = "abandoned"
+            raise
+        finally:
+            metrics.observe_llm_request(model, repo, time.perf_counter() - start, outcome)
@@ -0,0 +1,278 @@
+# llm_scheduler.py
+# Admission control for chat completions shared by the pr_review and conversation services; keep both copies in sync.
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+import metrics
+from token_counter import count_tokens
+
+logger = logging.getLogger()
+
+# Request priorities, most urgent first: chat turns someone is waiting for, reviews of small PRs, everything else
+INTERACTIVE = 0
+REVIEW = 1
+BULK = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", REVIEW: "review", BULK: "bulk"}
+
+# Tokens the chat format adds to each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+WINDOW_SECONDS = 60
+
+
+def estimate_tokens(messages, completion_tokens):
+    """Returns the tokens a request is expected to use: its prompt plus the expected completion."""
+    return sum(count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages) + completion_tokens
+
+
+def parse_limits(value):
+    # "gpt-4-1106-preview=300000,gpt-3.5-turbo=1000000"
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, limit = item.split("=", 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+
+class TokenBudget:
+    """Tokens and requests per minute of each model, shared by the pods of both services through MongoDB.
+
+    Every model and minute has a counter document. A request reserves its estimated tokens with one
+    conditional upsert, which fails when the minute's limits would be exceeded, and the estimate is
+    corrected once the real usage is known.
+
+    The priorities of LLMScheduler only order the requests waiting in one process, so the budget
+    also keeps part of every minute for the more urgent requests of all pods: reviews of small PRs
+    may only use review_share of the limits and the other requests bulk_share, which leaves the
+    rest for chat turns even while the review pods keep the budget busy.
+    """
+
+    def __init__(self, collection, tpm_limits=None, rpm_limits=None, bulk_share=1.0, review_share=1.0):
+        self.collection = collection
+        self.tpm_limits = tpm_limits or {}
+        self.rpm_limits = rpm_limits or {}
+        # A less urgent priority never gets a larger share than a more urgent one
+        self.shares = {INTERACTIVE: 1.0, REVIEW: review_share, BULK: min(bulk_share, review_share)}
+
+    @classmethod
+    def from_env(cls, collection):
+        return cls(
+            collection,
+            tpm_limits=parse_limits(os.environ.get("LLM_TPM_LIMITS", "")),
+            rpm_limits=parse_limits(os.environ.get("LLM_RPM_LIMITS", "")),
+            bulk_share=float(os.environ.get("LLM_BULK_BUDGET_SHARE", 0.8)),
+            review_share=float(os.environ.get("LLM_REVIEW_BUDGET_SHARE", 0.9)),
+        )
+
+    def limited(self, model):
+        return model in self.tpm_limits or model in self.rpm_limits
+
+    def seconds_to_next_window(self):
+        return WINDOW_SECONDS - time.time() % WINDOW_SECONDS
+
+    def reserve(self, model, tokens, priority):
+        """Counts a request against the current minute; returns the reservation, or None if the minute is used up."""
+        share = self.shares[priority]
+        window = int(time.time() // WINDOW_SECONDS)
+        query = {"_id": f"{model}:{window}"}
+        tpm = self.tpm_limits.get(model)
+        if tpm:
+            # A request larger than the whole budget would never fit; it gets a minute to itself instead
+            tokens = min(tokens, int(tpm * share))
+            query["tokens"] = {"$lte": tpm * share - tokens}
+        rpm = self.rpm_limits.get(model)
+        if rpm:
+            query["requests"] = {"$lte": rpm * share - 1}
+        try:
+            self.collection.update_one(
+                query,
+                {
+                    "$inc": {"tokens": tokens, "requests": 1},
+                    "$setOnInsert": {"model": model, "expires_at": datetime.utcnow() + timedelta(seconds=2 * WINDOW_SECONDS)},
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # The minute's document exists but does not match the limits
+            return None
+        except Exception as e:
+            # Counting is best effort; the provider still enforces its own limits
+            logger.error(f"Error while reserving the token budget of {model} in MongoDB: {e}")
+        return {"window": window, "tokens": tokens}
+
+    def settle(self, model, reservation, tokens):
+        """Replaces the estimate of a reservation by the tokens the request actually used."""
+        if tokens == reservation["tokens"]:
+            return
+        try:
+            self.collection.update_one(
+                {"_id": f"{model}:{reservation['window']}"},
+                {"$inc": {"tokens": tokens - reservation["tokens"]}},
+            )
+        except Exception as e:
+            logger.error(f"Error while settling the token budget of {model} in MongoDB: {e}")
+
+
+class Ticket:
+    def __init__(self, model, repo, priority):
+        self.model = model
+        self.repo = repo
+        self.priority = priority
+        self.tokens = 0
+        self.reservation = None
+
+
+class LLMScheduler:
+    """Decides the order in which the chat completion requests of a process are sent.
+
+    Waiting requests go by priority; requests of the same priority take turns by repo, so that a
+    burst from one repo does not hold up the others, and go in arrival order within a repo. The
+    request at the head of a model's line is sent once the model has a free concurrency slot and the
+    token budget has room for it; the requests behind it wait for it, so that a large request of a
+    busy minute is not overtaken forever by small ones.
+
+    When the budget has no room for a request, its priority and the less urgent ones wait for the next
+    minute, since their shares are used up; the more urgent priorities have larger shares and go on.
+    """
+
+    def __init__(self, concurrency, budget=None, completion_tokens=1000):
+        # concurrency(model) returns the number of requests to the model allowed in flight
+        self.concurrency = concurrency
+        self.budget = budget
+        self.completion_tokens = completion_tokens
+        self._cond = threading.Condition()
+        # (model, priority) -> repo -> waiting tickets; the repo served last moves to the end
+        self._queues = {}
+        self._in_flight = {}
+        self._reserving = set()
+        # model -> time; set by pause(), e.g. after a rate limit error of the provider
+        self._paused_until = {}
+        # (model, priority) -> time; set when the priority's share of the token budget is used up
+        self._budget_paused_until = {}
+
+    @contextmanager
+    def admit(self, model, messages, repo="", priority=BULK):
+        """Waits until the request may be sent and holds its concurrency slot until the block exits.
+
+        Yields a function to call with the usage of the completion, which corrects the token budget.
+        """
+        ticket = Ticket(model, repo or "", priority)
+        if self.budget is not None and self.budget.limited(model):
+            ticket.tokens = estimate_tokens(messages, self.completion_tokens)
+        start = time.perf_counter()
+        self._wait(ticket)
+        metrics.LLM_SCHEDULER_WAIT_SECONDS.labels(model, PRIORITY_NAMES[priority]).observe(time.perf_counter() - start)
+        try:
+            yield lambda usage: self._settle(ticket, usage)
+        finally:
+            with self._cond:
+                self._in_flight[model] -= 1
+                self._cond.notify_all()
+
+    def pause(self, model, seconds):
+        """Holds back the requests to a model, e.g. after the provider answered with a rate limit error."""
+        with self._cond:
+            until = time.monotonic() + seconds
+            self._paused_until[model] = max(until, self._paused_until.get(model, 0))
+
+    def waiting(self):
+        with self._cond:
+            return {
+                f"{model}/{PRIORITY_NAMES[priority]}": sum(len(tickets) for tickets in queue.values())
+                for (model, priority), queue in self._queues.items() if queue
+            }
+
+    def _wait(self, ticket):
+        model = ticket.model
+        with self._cond:
+            queue = self._queues.setdefault((model, ticket.priority), OrderedDict())
+            queue.setdefault(ticket.repo, deque()).append(ticket)
+        reserving = False
+        try:
+            while True:
+                with self._cond:
+                    while not self._ready(ticket):
+                        paused = max(
+                            self._paused_until.get(model, 0),
+                            self._budget_paused_until.get((model, ticket.priority), 0),
+                        ) - time.monotonic()
+                        self._cond.wait(paused if paused > 0 else None)
+                    if ticket.tokens == 0:
+                        self._start(ticket)
+                        return
+                    self._reserving.add(model)
+                    reserving = True
+
+                # Outside the lock: only the head of the model's line gets here
+                reservation = self.budget.reserve(model, ticket.tokens, ticket.priority)
+
+                with self._cond:
+                    self._reserving.discard(model)
+                    reserving = False
+                    if reservation is not None:
+                        ticket.reservation = reservation
+                        self._start(ticket)
+                        return
+                    wait = self.budget.seconds_to_next_window()
+                    logger.info(f"Token budget of {model} used up for {PRIORITY_NAMES[ticket.priority]} requests "
+                                f"this minute, they wait {wait:.1f}s")
+                    until = time.monotonic() + wait
+                    for priority in PRIORITY_NAMES:
+                        # The less urgent priorities have no larger share
+                        if priority >= ticket.priority:
+                            self._budget_paused_until[(model, priority)] = until
+                    self._cond.notify_all()
+        except BaseException:
+            # e.g. the consumer of a stream went away while it was waiting
+            with self._cond:
+                if reserving:
+                    self._reserving.discard(model)
+                self._remove(ticket)
+                self._cond.notify_all()
+            raise
+
+    def _head(self, model):
+        now = time.monotonic()
+        for priority in sorted(PRIORITY_NAMES):
+            queue = self._queues.get((model, priority))
+            if queue and self._budget_paused_until.get((model, priority), 0) <= now:
+                return next(iter(queue.values()))[0]
+        return None
+
+    def _ready(self, ticket):
+        model = ticket.model
+        return (
+            self._head(model) is ticket
+            and model not in self._reserving
+            and self._in_flight.get(model, 0) < self.concurrency(model)
+            and self._paused_until.get(model, 0) <= time.monotonic()
+        )
+
+    def _remove(self, ticket):
+        queue = self._queues[(ticket.model, ticket.priority)]
+        tickets = queue.get(ticket.repo)
+        if tickets is None or ticket not in tickets:
+            return False
+        tickets.remove(ticket)
+        if not tickets:
+            del queue[ticket.repo]
+        return True
+
+    def _start(self, ticket):
+        self._remove(ticket)
+        queue = self._queues[(ticket.model, ticket.priority)]
+        if ticket.repo in queue:
+            # The other repos of this priority go first next time
+            queue.move_to_end(ticket.repo)
+        self._in_flight[ticket.model] = self._in_flight.get(ticket.model, 0) + 1
+        self._cond.notify_all()
+
+    def _settle(self, ticket, usage):
+        if ticket.reservation is not None:
+            self.budget.settle(ticket.model, ticket.reservation, usage["prompt_tokens"] + usage["completion_tokens"])
@@ -0,0 +1,71 @@
+"""Moves conversations stored as a single `messages` array to the header and bucket documents.
+
+A legacy document holds [system prompt, PR prompt, review, chat messages...] in `messages`. The
+chat messages are written to their buckets first and the header is rewritten last, only if the
+document did not change meanwhile, so the tool can be interrupted and run again at any time:
+
+    MONGODB_URI=mongodb://127.0.0.1:27017 python migrate_conversations.py [--dry-run]
+"""
+import argparse
+import storage
+
+
+def split_legacy_messages(messages):
+    # Returns (system prompt, PR prompt, review, chat messages) of a legacy messages array
+    rest = list(messages)
+    system_prompt = rest.pop(0)["content"] if rest and rest[0].get("role") == "system" else ""
+    prompt = rest.pop(0)["content"] if rest and rest[0].get("role") == "user" else ""
+    review = rest.pop(0)["content"] if rest and rest[0].get("role") == "assistant" else None
+    return system_prompt, prompt, review, rest
+
+
+def migrate_conversation(collection, buckets, document, bucket_size, dry_run=False):
+    """Converts one legacy document, returns False if it changed while being converted."""
+    uuid = document["uuid"]
+    system_prompt, prompt, review, chat = split_legacy_messages(document["messages"])
+    if dry_run:
+        return True
+
+    for start in range(0, len(chat), bucket_size):
+        bucket = start // bucket_size
+        buckets.replace_one(
+            {"uuid": uuid, "bucket": bucket},
+            {
+                "uuid": uuid,
+                "bucket": bucket,
+                "messages": [{"seq": start + i, **message} for i, message in enumerate(chat[start:start + bucket_size])],
+            },
+            upsert=True,
+        )
+
+    header = storage.new_conversation(uuid, system_prompt, prompt)
+    header.update({
+        "review": review,
+        "message_count": len(chat),
+        "bucket_size": bucket_size,
+        "created_at": document["_id"].generation_time.replace(tzinfo=None),
+    })
+    # turn, pending, usage and context are kept: the seq of a chat message equals its old index after the review
+    result = collection.update_one(
+        {"_id": document["_id"], "messages": {"$size": len(document["messages"])}},
+        {"$set": header, "$unset": {"messages": ""}},
+    )
+    return result.modified_count == 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="only count the documents to migrate")
+    parser.add_argument("--bucket-size", type=int, default=storage.BUCKET_SIZE)
+    args = parser.parse_args()
+
+    collection = storage.get_collection(storage.CONVERSATIONS)
+    buckets = storage.get_collection(storage.CONVERSATION_BUCKETS)
+    migrated, changed = 0, 0
+    for document in collection.find({"messages": {"$exists": True}}):
+        if migrate_conversation(collection, buckets, document, args.bucket_size, args.dry_run):
+            migrated += 1
+        else:
+            changed += 1
+            print(f"Conversation {document['uuid']} changed during the migration, run the tool again")
+    print(f"{'Would migrate' if args.dry_run else 'Migrated'} {migrated} conversation(s), {changed} skipped")
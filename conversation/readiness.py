@@ -0,0 +1,96 @@
+# readiness.py
+# Readiness probes shared by the pr_review and conversation services; keep both copies in sync.
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger()
+
+
+class Readiness:
+    """Probes the dependencies of this process in a background thread and caches the results.
+
+    /readyz only reads the cached results, so Kubernetes can poll it every second without reaching
+    MongoDB each time, and one slow probe does not take the pod out of the Service: a probe has to
+    fail failure_threshold times in a row. The first round also warms the process up, e.g. the
+    MongoDB probe connects the client and creates the indexes before the pod receives traffic.
+    """
+
+    def __init__(self, probes, interval_seconds=5, failure_threshold=3):
+        # name -> probe; a probe raises if the dependency is not usable
+        self.probes = probes
+        self.interval_seconds = interval_seconds
+        self.failure_threshold = failure_threshold
+        self._results = {}
+        self._lock = threading.Lock()
+        self._started_pid = None
+
+    @classmethod
+    def from_env(cls, probes):
+        return cls(
+            probes,
+            interval_seconds=float(os.environ.get("READINESS_INTERVAL_SECONDS", 5)),
+            failure_threshold=int(os.environ.get("READINESS_FAILURE_THRESHOLD", 3)),
+        )
+
+    def start(self):
+        # Threads do not survive fork(), so the probes run in whichever process serves requests
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._results = {}
+            threading.Thread(target=self._probe_loop, name="readiness-probes", daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def _probe_loop(self):
+        while True:
+            self.run_probes()
+            time.sleep(self.interval_seconds)
+
+    def run_probes(self):
+        for name, probe in self.probes.items():
+            start = time.perf_counter()
+            try:
+                probe()
+                error = None
+            except Exception as e:
+                error = str(e)
+            result = {"ok": error is None, "error": error, "duration_ms": round((time.perf_counter() - start) * 1000, 1)}
+            previous = self._results.get(name, {})
+            result["succeeded"] = error is None or previous.get("succeeded", False)
+            if error is None:
+                result["failures"] = 0
+            else:
+                result["failures"] = previous.get("failures", 0) + 1
+                if result["failures"] == self.failure_threshold:
+                    logger.error(f"Error while probing {name}: {error}")
+            result["checked_at"] = time.time()
+            self._results[name] = result
+
+    def status(self):
+        """Returns (ready, details): ready once every probe has succeeded and has not failed too often since."""
+        now = time.time()
+        ready = self._started_pid == os.getpid()
+        details = {}
+        for name in self.probes:
+            result = self._results.get(name)
+            if result is None:
+                details[name] = {"ok": None}
+                ready = False
+                continue
+            # A probe that stopped reporting means the probe thread is stuck
+            stale = now - result["checked_at"] > self.interval_seconds * self.failure_threshold + 30
+            probe_ready = result["succeeded"] and result["failures"] < self.failure_threshold and not stale
+            if not probe_ready:
+                ready = False
+            details[name] = {
+                "ok": result["ok"],
+                "error": result["error"],
+                "failures": result["failures"],
+                "duration_ms": result["duration_ms"],
+                "age_seconds": round(now - result["checked_at"], 1),
+            }
+        return ready, details
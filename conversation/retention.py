@@ -0,0 +1,215 @@
+"""Moves conversations idle for a while out of the hot collections into a compressed archive.
+
+The header and message buckets of an archived conversation are stored as one zlib-compressed BSON
+document in CONVERSATION_ARCHIVE. Only a stub holding the uuid and version stays in CONVERSATIONS,
+so the conversation page still gets a 304 for an unchanged conversation, and the first request
+that needs the messages moves the conversation back (see ConversationArchive.rehydrate).
+
+Run it from cron; it can be interrupted and run again at any time:
+
+    MONGODB_URI=mongodb://127.0.0.1:27017 python retention.py --idle-days 30 [--dry-run]
+    MONGODB_URI=mongodb://127.0.0.1:27017 python retention.py --rehydrate <uuid>
+"""
+import os
+import time
+import zlib
+import logging
+import argparse
+from datetime import datetime, timedelta
+import bson
+from bson.binary import Binary
+from pymongo import ReturnDocument
+import storage
+
+logger = logging.getLogger()
+
+# States of the stub left in CONVERSATIONS: the buckets are being deleted after the archive was
+# written, the conversation is archived, or its documents are being written back
+MOVING = "moving"
+ARCHIVED = "archived"
+RESTORING = "restoring"
+
+
+def encode_conversation(header, bucket_documents, level=9):
+    return Binary(zlib.compress(bson.encode({"header": header, "buckets": bucket_documents}), level))
+
+
+def decode_conversation(data):
+    document = bson.decode(zlib.decompress(data))
+    return document["header"], document["buckets"]
+
+
+class ConversationArchive:
+    """Archives and rehydrates conversations.
+
+    Archiving writes the archive document first, then replaces the header with a stub only if the
+    conversation's version did not change meanwhile, and deletes the buckets last. Rehydrating
+    claims the stub first, so the buckets are never written back while an archiver is still
+    deleting them; a stub stuck in a state for longer than stale_seconds (its process died) can be
+    claimed by anyone.
+    """
+
+    def __init__(self, collection, buckets, archive, compression_level=9, stale_seconds=300):
+        self.collection = collection
+        self.buckets = buckets
+        self.archive = archive
+        self.compression_level = compression_level
+        self.stale_seconds = stale_seconds
+
+    @classmethod
+    def from_env(cls, collection, buckets, archive):
+        return cls(
+            collection, buckets, archive,
+            compression_level=int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", 9)),
+            stale_seconds=int(os.getenv("ARCHIVE_STALE_SECONDS", 300)),
+        )
+
+    def idle_query(self, idle_days, now=None):
+        cutoff = (now or datetime.utcnow()) - timedelta(days=idle_days)
+        return {
+            "archived": {"$exists": False},
+            "$or": [
+                {"last_active_at": {"$lt": cutoff}},
+                # Conversations created before last_active_at was recorded
+                {"last_active_at": {"$exists": False}, "created_at": {"$lt": cutoff}},
+            ],
+        }
+
+    def archive_conversation(self, header, dry_run=False):
+        """Archives the conversation of header; returns (bytes before, bytes after), or None if it changed meanwhile."""
+        uuid = header["uuid"]
+        bucket_documents = list(self.buckets.find({"uuid": uuid}, {"_id": 0}))
+        data = encode_conversation(header, bucket_documents, self.compression_level)
+        stub = {
+            "uuid": uuid,
+            "version": header.get("version", 0),
+            "archived": MOVING,
+            "archived_at": datetime.utcnow(),
+        }
+        hot_bytes = len(bson.encode(header)) + sum(len(bson.encode(bucket)) for bucket in bucket_documents)
+        cold_bytes = len(data) + len(bson.encode(stub))
+        if dry_run:
+            return hot_bytes, cold_bytes
+
+        self.archive.replace_one(
+            {"uuid": uuid},
+            {"uuid": uuid, "data": data, "hot_bytes": hot_bytes, "archived_at": stub["archived_at"]},
+            upsert=True,
+        )
+        # The stub keeps the _id and version, so an ETag handed out before stays valid
+        result = self.collection.replace_one(
+            {"_id": header["_id"], "version": header.get("version", 0), "archived": {"$exists": False}},
+            stub,
+        )
+        if result.modified_count == 0:
+            self.archive.delete_one({"uuid": uuid})
+            return None
+        self.buckets.delete_many({"uuid": uuid})
+        self.collection.update_one(
+            {"_id": header["_id"], "archived": MOVING},
+            {"$set": {"archived": ARCHIVED, "archived_at": datetime.utcnow()}},
+        )
+        return hot_bytes, cold_bytes
+
+    def _claim(self, uuid):
+        stale = datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+        return self.collection.find_one_and_update(
+            {
+                "uuid": uuid,
+                "$or": [
+                    {"archived": ARCHIVED},
+                    {"archived": {"$in": [MOVING, RESTORING]}, "archived_at": {"$lt": stale}},
+                ],
+            },
+            {"$set": {"archived": RESTORING, "archived_at": datetime.utcnow()}},
+            projection={"_id": 1, "archived": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+
+    def rehydrate(self, uuid, wait_seconds=5):
+        """Moves an archived conversation back; returns True once it is in the hot collections again.
+
+        Returns False if the conversation does not exist or could not be restored within wait_seconds,
+        e.g. because another request is restoring it.
+        """
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            stub = self._claim(uuid)
+            if stub is not None:
+                break
+            current = self.collection.find_one({"uuid": uuid}, {"_id": 0, "archived": 1})
+            if current is None:
+                return False
+            if "archived" not in current:
+                return True
+            if time.monotonic() >= deadline:
+                logger.warning(f"Conversation {uuid} is still {current['archived']}, giving up rehydrating it")
+                return False
+            time.sleep(0.1)
+
+        start = time.perf_counter()
+        document = self.archive.find_one({"uuid": uuid}, {"_id": 0, "data": 1})
+        if document is None:
+            logger.error(f"Error while rehydrating conversation {uuid}: no archive document")
+            return False
+        header, bucket_documents = decode_conversation(document["data"])
+        if stub["archived"] == MOVING:
+            # The archiver died before it deleted all buckets
+            self.buckets.delete_many({"uuid": uuid})
+        for bucket in bucket_documents:
+            self.buckets.replace_one({"uuid": uuid, "bucket": bucket["bucket"]}, bucket, upsert=True)
+        header["last_active_at"] = datetime.utcnow()
+        self.collection.replace_one({"_id": stub["_id"], "archived": RESTORING}, header)
+        self.archive.delete_one({"uuid": uuid})
+        logger.info(f"Rehydrated conversation {uuid} in {(time.perf_counter() - start) * 1000:.0f}ms")
+        return True
+
+    def run(self, idle_days, limit=None, dry_run=False):
+        """Archives the conversations idle for idle_days; returns the counts and bytes reclaimed."""
+        report = {"archived": 0, "changed": 0, "hot_bytes": 0, "cold_bytes": 0}
+        query = self.idle_query(idle_days)
+        headers = self.collection.find(query)
+        if limit is not None:
+            headers = headers.limit(limit)
+        for header in headers:
+            try:
+                sizes = self.archive_conversation(header, dry_run)
+            except Exception as e:
+                logger.error(f"Error while archiving conversation {header['uuid']}: {e}")
+                continue
+            if sizes is None:
+                report["changed"] += 1
+                continue
+            report["archived"] += 1
+            report["hot_bytes"] += sizes[0]
+            report["cold_bytes"] += sizes[1]
+        report["reclaimed_bytes"] = report["hot_bytes"] - report["cold_bytes"]
+        return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--idle-days", type=float, default=float(os.getenv("ARCHIVE_IDLE_DAYS", 30)),
+                        help="archive conversations without a turn for this many days")
+    parser.add_argument("--limit", type=int, help="archive at most this many conversations")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be archived")
+    parser.add_argument("--rehydrate", metavar="UUID", help="move one archived conversation back instead")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    archive = ConversationArchive.from_env(
+        storage.get_collection(storage.CONVERSATIONS),
+        storage.get_collection(storage.CONVERSATION_BUCKETS),
+        storage.get_collection(storage.CONVERSATION_ARCHIVE),
+    )
+    if args.rehydrate:
+        print(f"Rehydrated {args.rehydrate}" if archive.rehydrate(args.rehydrate) else f"Could not rehydrate {args.rehydrate}")
+    else:
+        report = archive.run(args.idle_days, args.limit, args.dry_run)
+        ratio = report["cold_bytes"] / report["hot_bytes"] if report["hot_bytes"] else 0
+        print(
+            f"{'Would archive' if args.dry_run else 'Archived'} {report['archived']} conversation(s), "
+            f"{report['changed']} skipped because they changed; "
+            f"{report['hot_bytes']} bytes -> {report['cold_bytes']} bytes ({ratio:.0%}), "
+            f"{report['reclaimed_bytes']} bytes reclaimed"
+        )
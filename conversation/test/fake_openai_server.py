@@ -0,0 +1,179 @@
+"""A deterministic stand-in for the OpenAI chat completions API, for load tests without network or cost.
+
+Point the services at it with OPENAI_API_BASE=http://127.0.0.1:8000/v1 and any OPENAI_API_KEY.
+With --error-rate, that fraction of the requests is answered with alternating 429 and 503 errors
+to exercise the retries of llm_client.py; the failing requests are the same on every run.
+
+    python fake_openai_server.py --port 8000 --latency 1.0 --tokens-per-second 50 --completion-tokens 100
+
+With --prompt-tokens-per-second, the time to the first token also grows with the prompt, like a real
+model reading it; the prompt is counted as 4 characters per token.
+
+A request that asks for a bilingual review (a message containing the marker of pr_review's
+review_comment.CHINESE_MARKER) gets a review with section headings, followed by the marker and a
+"translation" with Chinese section headings, so that pr_review splits it as it splits a real one.
+"""
+import argparse
+import json
+import time
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# review_comment.CHINESE_MARKER of pr_review
+CHINESE_MARKER = "<<<ZH>>>"
+REVIEW_SECTIONS = ("**[Changes]**: ", "\n**[Conclusion]**: ")
+TRANSLATED_SECTIONS = ("**[变更]**: ", "\n**[结论]**: ")
+
+
+def fake_completion_tokens(messages, count):
+    # The same messages always produce the same answer
+    seed = hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+    return [f"{seed[i % len(seed)]}{i} " for i in range(count)]
+
+
+def fake_bilingual_tokens(tokens):
+    """Lays out tokens as a review with two sections, followed by the marker and its translation."""
+    english, chinese = tokens[:len(tokens) // 2], tokens[len(tokens) // 2:]
+
+    def sections(part, headings):
+        middle = len(part) // 2
+        return [headings[0], *part[:middle], headings[1], *part[middle:]]
+
+    return sections(english, REVIEW_SECTIONS) + [f"\n{CHINESE_MARKER}\n"] + sections(chinese, TRANSLATED_SECTIONS)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 1.0
+    tokens_per_second = 50.0
+    completion_tokens = 100
+    error_rate = 0.0
+    prompt_tokens_per_second = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _next_error(self):
+        # Fails request i when the running total of error_rate passes an integer, so exactly that fraction fails
+        with self.server.stats_lock:
+            i = self.server.stats["requests"]
+            self.server.stats["requests"] += 1
+            if int((i + 1) * self.error_rate) > int(i * self.error_rate):
+                self.server.stats["errors"] += 1
+                return 429 if self.server.stats["errors"] % 2 else 503
+        return None
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        status = self._next_error()
+        if status is not None:
+            self._send_json({"error": {"message": "Injected error", "type": "fake_error"}}, status)
+            return
+        messages = body.get("messages", [])
+        model = body.get("model", "gpt-4-1106-preview")
+        tokens = fake_completion_tokens(messages, self.completion_tokens)
+        if any(CHINESE_MARKER in str(message.get("content", "")) for message in messages):
+            tokens = fake_bilingual_tokens(tokens)
+        prompt_tokens = sum(len(str(message.get("content", ""))) // 4 for message in messages)
+        with self.server.stats_lock:
+            self.server.stats["prompt_tokens"] += prompt_tokens
+            self.server.stats["completion_tokens"] += len(tokens)
+
+        # Time to first token
+        time.sleep(self.latency + (prompt_tokens / self.prompt_tokens_per_second if self.prompt_tokens_per_second else 0))
+        if body.get("stream"):
+            self._stream(model, tokens)
+        else:
+            time.sleep(len(tokens) / self.tokens_per_second)
+            self._send_json({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(tokens),
+                    "total_tokens": prompt_tokens + len(tokens),
+                },
+            })
+
+    def _send_json(self, data, status=200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _stream(self, model, tokens):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write_event(data):
+            chunk = f"data: {data}\n\n".encode()
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.flush()
+
+        for i, token in enumerate(tokens):
+            delta = {"role": "assistant", "content": token} if i == 0 else {"content": token}
+            write_event(json.dumps({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+            }))
+            time.sleep(1 / self.tokens_per_second)
+        write_event(json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }))
+        write_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def make_server(host="127.0.0.1", port=8000, latency=1.0, tokens_per_second=50.0, completion_tokens=100, error_rate=0.0,
+                prompt_tokens_per_second=0.0):
+    handler = type("ConfiguredFakeOpenAIHandler", (FakeOpenAIHandler,), {
+        "latency": latency,
+        "tokens_per_second": tokens_per_second,
+        "completion_tokens": completion_tokens,
+        "error_rate": error_rate,
+        "prompt_tokens_per_second": prompt_tokens_per_second,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    # Request, injected error and token counts, e.g. to compare with the requests the service answered
+    server.stats = {"requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    server.stats_lock = threading.Lock()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--completion-tokens", type=int, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 429/503")
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=0.0, help="0 for no prompt reading time")
+    args = parser.parse_args()
+    server = make_server(args.host, args.port, args.latency, args.tokens_per_second, args.completion_tokens,
+                         args.error_rate, args.prompt_tokens_per_second)
+    print(f"Fake OpenAI API listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
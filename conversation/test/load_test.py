@@ -0,0 +1,175 @@
+"""Load test for the conversation service against the fake OpenAI server.
+
+By default it starts the fake OpenAI server, then runs the service under gunicorn once per worker
+class and sends the same load to each, so the effect of the worker model can be compared directly.
+The service needs a MongoDB, e.g. `docker run -p 27017:27017 mongo`:
+
+    MONGODB_URI=mongodb://127.0.0.1:27017 python load_test.py --concurrency 100 --requests 300
+
+To load an already running deployment instead (its OPENAI_API_BASE should point at the fake server
+and MONGODB_URI at its MongoDB, where the test conversations are created):
+
+    MONGODB_URI=mongodb://127.0.0.1:27017 python load_test.py --url http://127.0.0.1:5000 --password <LOGIN_PASSWORD>
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from fake_openai_server import make_server
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_healthy(url, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            if requests.get(f"{url}/healthz", timeout=1).status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become healthy within {timeout}s")
+
+
+def seed_conversations(concurrency):
+    # Messages are only accepted for existing conversations, so create one reviewed PR per client
+    sys.path.insert(0, SERVICE_DIR)
+    import storage
+    collection = storage.get_collection(storage.CONVERSATIONS)
+    for i in range(concurrency):
+        conversation = storage.new_conversation(f"load-test-{i}", "You are a code reviewer.", "Load test pull request")
+        conversation["review"] = "Load test review"
+        collection.replace_one({"uuid": conversation["uuid"]}, conversation, upsert=True)
+
+
+def run_load(url, password, concurrency, total_requests, stream):
+    local = threading.local()
+    clients = iter(range(concurrency))
+    clients_lock = threading.Lock()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.post(f"{url}/login", data={"password": password}, allow_redirects=False)
+            # Each client thread talks to its own conversation, one message at a time like a user
+            with clients_lock:
+                local.uuid = f"load-test-{next(clients)}"
+        return local.session
+
+    def one_request(i):
+        endpoint = "/add-message-stream" if stream else "/add-message"
+        start = time.perf_counter()
+        try:
+            response = session().post(
+                f"{url}{endpoint}",
+                json={"uuid": local.uuid, "content": f"Load test question {i}"},
+                timeout=300,
+            )
+            # Read the whole body so that streamed responses are timed to their last event
+            response.content
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one_request, range(total_requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, ok in results if ok)
+    errors = sum(1 for _, ok in results if not ok)
+
+    def percentile(p):
+        if not latencies:
+            return float("nan")
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    return {
+        "requests": total_requests,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput": (total_requests - errors) / elapsed,
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "mean": statistics.mean(latencies) if latencies else float("nan"),
+    }
+
+
+def run_with_gunicorn(worker_class, openai_base, args):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = dict(
+        os.environ,
+        OPENAI_API_BASE=openai_base,
+        OPENAI_API_KEY="fake",
+        LOGIN_PASSWORD=args.password,
+        SECRET_KEY_FOR_SESSION="load-test",
+    )
+    process = subprocess.Popen(
+        ["gunicorn", "-c", "gunicorn_config.py", "-k", worker_class, "-b", f"127.0.0.1:{port}",
+         "--access-logfile", "/dev/null", "conversation:create_app()"],
+        cwd=SERVICE_DIR,
+        env=env,
+    )
+    try:
+        wait_until_healthy(url, process)
+        return run_load(url, args.password, args.concurrency, args.requests, args.stream)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def print_report(name, result):
+    print(f"{name:>10}: {result['throughput']:8.2f} req/s  "
+          f"p50 {result['p50']:6.2f}s  p95 {result['p95']:6.2f}s  p99 {result['p99']:6.2f}s  "
+          f"errors {result['errors']}/{result['requests']}  ({result['seconds']:.1f}s total)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="load an already running service instead of starting gunicorn")
+    parser.add_argument("--password", default=os.environ.get("LOGIN_PASSWORD", "load-test"))
+    parser.add_argument("--worker-classes", default="sync,gevent")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--stream", action="store_true", help="use /add-message-stream")
+    parser.add_argument("--latency", type=float, default=1.0, help="fake OpenAI time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of fake OpenAI requests that fail with 429/503 and are retried by the service")
+    args = parser.parse_args()
+
+    os.environ.setdefault("MONGODB_URI", "mongodb://127.0.0.1:27017")
+    seed_conversations(args.concurrency)
+    if args.url:
+        print_report("service", run_load(args.url, args.password, args.concurrency, args.requests, args.stream))
+        sys.exit(0)
+
+    fake_port = free_port()
+    fake_server = make_server(port=fake_port, latency=args.latency, tokens_per_second=args.tokens_per_second,
+                              completion_tokens=args.completion_tokens, error_rate=args.error_rate)
+    threading.Thread(target=fake_server.serve_forever, daemon=True).start()
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}, fake OpenAI latency {args.latency}s "
+          f"+ {args.completion_tokens} tokens at {args.tokens_per_second} tokens/s")
+    for worker_class in args.worker_classes.split(","):
+        print_report(worker_class, run_with_gunicorn(worker_class, f"http://127.0.0.1:{fake_port}/v1", args))
+    print(f"fake OpenAI: {fake_server.stats['requests']} requests, {fake_server.stats['errors']} injected errors")
@@ -0,0 +1,179 @@
+# context_extractor.py
+import re
+import ast
+import bisect
+
+# Hunk headers and the lines of a unified diff
+HUNK_START = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
+PYTHON_EXTENSIONS = (".py", ".pyi")
+GO_EXTENSIONS = (".go",)
+JS_EXTENSIONS = (".js", ".jsx", ".mjs", ".cjs", ".ts", ".tsx")
+
+# Go declarations start at column 0; types only have a body when it opens on the same line
+GO_DECLARATION = re.compile(r"^(func\b|type\s+\w+.*\{)")
+JS_DECLARATION = re.compile(
+    r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?(?:"
+    r"function\b|class\b"
+    r"|(?:const|let|var)\s+[\w$]+\s*=\s*(?:async\s+)?(?:function\b|\([^)]*\)\s*=>|[\w$]+\s*=>)"
+    r"|(?:static\s+)?(?:get\s+|set\s+)?(?P<method>[\w$]+)\s*\([^;]*\)\s*\{)"
+)
+JS_KEYWORDS = {"if", "for", "while", "switch", "catch", "with", "return", "function"}
+
+# A declaration whose body opens further down (multi-line signatures) is matched to the first
+# block opening within this many lines
+MAX_SIGNATURE_LINES = 10
+
+
+def changed_lines(patch):
+    """Returns the (start, end) line ranges of the new file added or modified by a unified diff.
+
+    A deletion is placed on the line that follows it in the new file.
+    """
+    lines = []
+    new_line = None
+    for line in (patch or "").splitlines():
+        match = HUNK_START.match(line)
+        if match:
+            new_line = int(match.group(1))
+        elif new_line is None or line.startswith("\\"):
+            # Before the first hunk, or "\ No newline at end of file"
+            continue
+        elif line.startswith("+"):
+            lines.append(new_line)
+            new_line += 1
+        elif line.startswith("-"):
+            lines.append(new_line)
+        else:
+            new_line += 1
+
+    ranges = []
+    for number in lines:
+        if ranges and number <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], number))
+        else:
+            ranges.append((number, number))
+    return ranges
+
+
+def merge_ranges(ranges, line_count):
+    """Clamps (start, end) line ranges to the file and merges the overlapping and adjacent ones."""
+    merged = []
+    for start, end in sorted(ranges):
+        start, end = max(1, start), min(line_count, end)
+        if start > end:
+            continue
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def python_symbols(content):
+    """Returns the (start, end) lines of the functions and classes of Python source, or None if it does not parse."""
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError, ValueError):
+        return None
+    symbols = []
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            # Decorators belong to the definition
+            start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+            symbols.append((start, node.end_lineno))
+    return symbols
+
+
+def brace_blocks(content):
+    """Returns (open line, close line) of every balanced {} block, in the order the blocks open.
+
+    Braces in strings, template literals and comments are ignored. Unbalanced braces are dropped.
+    """
+    blocks = []
+    stack = []
+    line = 1
+    i = 0
+    length = len(content)
+    while i < length:
+        char = content[i]
+        if char == "\n":
+            line += 1
+        elif char in "\"'`":
+            # Skip to the closing quote; only template literals span lines
+            i += 1
+            while i < length and content[i] != char:
+                if content[i] == "\\":
+                    i += 1
+                elif content[i] == "\n":
+                    if char != "`":
+                        break
+                    line += 1
+                i += 1
+            if i < length and content[i] == "\n":
+                line += 1
+        elif content.startswith("//", i):
+            end = content.find("\n", i)
+            i = length if end == -1 else end
+            continue
+        elif content.startswith("/*", i):
+            end = content.find("*/", i + 2)
+            end = length if end == -1 else end + 2
+            line += content.count("\n", i, end)
+            i = end
+            continue
+        elif char == "{":
+            stack.append(len(blocks))
+            blocks.append([line, None])
+        elif char == "}" and stack:
+            blocks[stack.pop()][1] = line
+        i += 1
+    return [(start, end) for start, end in blocks if end is not None]
+
+
+def brace_symbols(content, declaration):
+    """Returns the (start, end) lines of the declarations matched by the declaration regex and their {} bodies."""
+    blocks = brace_blocks(content)
+    block_starts = [start for start, _ in blocks]
+    symbols = []
+    for number, text in enumerate(content.splitlines(), start=1):
+        match = declaration.match(text)
+        if match is None or (match.groupdict().get("method") in JS_KEYWORDS):
+            continue
+        i = bisect.bisect_left(block_starts, number)
+        if i < len(blocks) and blocks[i][0] - number <= MAX_SIGNATURE_LINES:
+            symbols.append((number, blocks[i][1]))
+    return symbols
+
+
+def symbols_of(filename, content):
+    """Returns the (start, end) lines of the functions, methods and classes of a file, or None for other languages."""
+    if filename.endswith(PYTHON_EXTENSIONS):
+        return python_symbols(content)
+    if filename.endswith(GO_EXTENSIONS):
+        return brace_symbols(content, GO_DECLARATION)
+    if filename.endswith(JS_EXTENSIONS):
+        return brace_symbols(content, JS_DECLARATION)
+    return None
+
+
+def context_ranges(filename, content, patch, context_lines=30, max_symbol_lines=200):
+    """Returns the line ranges of content to show with a patch, merged and in order.
+
+    Each run of changed lines is shown with its innermost enclosing function or class, plus the
+    first line of the symbols around that one (e.g. the class of a method). Changes outside any
+    symbol, in symbols longer than max_symbol_lines and in files of other languages are shown
+    with context_lines of context instead.
+    """
+    line_count = content.count("\n") + (0 if content.endswith("\n") else 1)
+    symbols = symbols_of(filename, content) or []
+    ranges = []
+    for start, end in changed_lines(patch):
+        enclosing = [symbol for symbol in symbols if symbol[0] <= start and end <= symbol[1]]
+        innermost = min(enclosing, key=lambda symbol: symbol[1] - symbol[0], default=None)
+        if innermost is None or innermost[1] - innermost[0] + 1 > max_symbol_lines:
+            ranges.append((start - context_lines, end + context_lines))
+            continue
+        ranges.append(innermost)
+        ranges.extend((symbol[0], symbol[0]) for symbol in enclosing if symbol[0] < innermost[0])
+    return merge_ranges(ranges, line_count)
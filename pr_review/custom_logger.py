@@ -4,5 +4,6 @@ from gunicorn.glogging import Logger
 
 class CustomLogger(Logger):
     def access(self, resp, req, environ, request_time):
-        if req.path != '/healthz':
+        # Health checks and metric scrapes would flood the access log
+        if req.path not in ('/healthz', '/readyz', '/metrics'):
             super().access(resp, req, environ, request_time)
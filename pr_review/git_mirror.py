@@ -0,0 +1,321 @@
+# git_mirror.py
+import os
+import re
+import time
+import fcntl
+import shutil
+import base64
+import logging
+import subprocess
+from contextlib import contextmanager
+from github_fetch import decode_content
+
+logger = logging.getLogger()
+
+REPO_NAME = re.compile(r"^[\w.-]+/[\w.-]+$")
+
+# git diff --raw status letters and the status GitHub reports for them
+STATUSES = {"A": "added", "D": "removed", "M": "modified", "R": "renamed", "C": "copied", "T": "changed"}
+
+# Tree entry modes of symlinks and submodules, which have no file content to show
+SYMLINK_MODE = "120000"
+SUBMODULE_MODE = "160000"
+
+
+class GitMirrorError(Exception):
+    pass
+
+
+class MirrorFile:
+    """A changed file computed from a mirror, with the attributes of PyGithub's File that the review uses."""
+
+    def __init__(self, filename, status, sha, mode, patch, additions, deletions, previous_filename=None):
+        self.filename = filename
+        self.status = status
+        # Blob SHA of the new version, or of the old one for removed files
+        self.sha = sha
+        self.mode = mode
+        self.patch = patch
+        self.additions = additions
+        self.deletions = deletions
+        self.changes = additions + deletions
+        self.previous_filename = previous_filename
+
+
+def parse_raw(output):
+    """Returns (status letter, new mode, new sha, old sha, path, old path) of each entry of `git diff --raw -z`."""
+    fields = output.decode("utf-8", errors="surrogateescape").split("\0")
+    entries = []
+    i = 0
+    while i < len(fields) and fields[i].startswith(":"):
+        _, new_mode, old_sha, new_sha, status = fields[i][1:].split(" ")
+        status = status[0]
+        if status in "RC":
+            old_path, path = fields[i + 1], fields[i + 2]
+            i += 3
+        else:
+            old_path = path = fields[i + 1]
+            i += 2
+        entries.append((status, new_mode, new_sha, old_sha, path, old_path))
+    return entries
+
+
+def split_patches(output):
+    """Returns (patch, additions, deletions) of each file of a `git diff` patch, in order.
+
+    The patch is the hunks alone, as GitHub reports it, or None for binary files and changes without hunks.
+    """
+    patches = []
+    hunks = None
+    for line in output.decode("utf-8", errors="replace").split("\n"):
+        if line.startswith("diff --git "):
+            hunks = []
+            patches.append(hunks)
+        elif hunks is not None and (hunks or line.startswith("@@")):
+            hunks.append(line)
+    results = []
+    for lines in patches:
+        while lines and lines[-1] == "":
+            lines.pop()
+        additions = sum(1 for line in lines if line.startswith("+"))
+        deletions = sum(1 for line in lines if line.startswith("-"))
+        results.append(("\n".join(lines) if lines else None, additions, deletions))
+    return results
+
+
+class Mirror:
+    """A bare clone holding a fetched PR; reads the same things as GithubFetcher, from the local repository."""
+
+    def __init__(self, mirrors, path, base_ref, max_file_bytes):
+        self.mirrors = mirrors
+        self.path = path
+        self.base_ref = base_ref
+        self.max_file_bytes = max_file_bytes
+
+    def git(self, *args, stdin=None):
+        return self.mirrors.git(*args, cwd=self.path, stdin=stdin)
+
+    def has_commit(self, sha):
+        try:
+            self.git("cat-file", "-e", f"{sha}^{{commit}}")
+        except GitMirrorError:
+            return False
+        return True
+
+    def _diff(self, *revisions):
+        raw = parse_raw(self.git("diff", "--raw", "-z", "-M", "--no-abbrev", *revisions))
+        patches = split_patches(self.git("diff", "-M", "--no-color", "--no-ext-diff", "--full-index", *revisions))
+        # git prints a type change (e.g. a file replaced by a symlink) as the removal of the old entry
+        # followed by the addition of the new one; both belong to the one raw entry
+        expected = sum(2 if status == "T" else 1 for status, *_ in raw)
+        if len(patches) != expected:
+            raise GitMirrorError(f"git diff listed {len(raw)} files but {len(patches)} patches")
+        files = []
+        patches = iter(patches)
+        for status, new_mode, new_sha, old_sha, path, old_path in raw:
+            patch, additions, deletions = next(patches)
+            if status == "T":
+                new_patch, new_additions, new_deletions = next(patches)
+                patch = "\n".join(part for part in (patch, new_patch) if part is not None) or None
+                additions += new_additions
+                deletions += new_deletions
+            files.append(MirrorFile(
+                path, STATUSES.get(status, "modified"), old_sha if status == "D" else new_sha, new_mode,
+                patch, additions, deletions, old_path if status in "RC" else None,
+            ))
+        return files
+
+    def fetch_files(self, gh_pr):
+        # Like the PR files API: the changes of the head since its merge base with the base branch
+        base = gh_pr.base.sha if self.has_commit(gh_pr.base.sha) else f"refs/heads/{self.base_ref}"
+        return self._diff(f"{base}...{gh_pr.head.sha}")
+
+    def fetch_compare_files(self, gh_repo, base_sha, head_sha):
+        # None when base_sha is unknown here or the head does not extend it, as GithubFetcher does
+        if not self.has_commit(base_sha):
+            return None
+        try:
+            self.git("merge-base", "--is-ancestor", base_sha, head_sha)
+        except GitMirrorError:
+            return None
+        return self._diff(base_sha, head_sha)
+
+    def fetch_contents(self, gh_repo, files, ref):
+        """Returns (content, note) for each file, as GithubFetcher.fetch_contents, reading all blobs with one git process."""
+        results = [(None, None)] * len(files)
+        wanted = {}
+        for i, file in enumerate(files):
+            if file.status == "removed":
+                continue
+            if file.mode in (SYMLINK_MODE, SUBMODULE_MODE):
+                results[i] = (None, "not a regular file")
+            else:
+                wanted.setdefault(file.sha, []).append(i)
+        if not wanted:
+            return results
+
+        shas = list(wanted)
+        sizes = {}
+        for line in self.git("cat-file", "--batch-check", stdin="\n".join(shas) + "\n").decode().splitlines():
+            sha, kind, *size = line.split(" ")
+            sizes[sha] = int(size[0]) if kind == "blob" else None
+        small = []
+        for sha in shas:
+            if sizes.get(sha) is None:
+                note = (None, "not found at the head commit")
+            elif sizes[sha] > self.max_file_bytes:
+                note = (None, f"larger than {self.max_file_bytes} bytes")
+            else:
+                small.append(sha)
+                continue
+            for i in wanted[sha]:
+                results[i] = note
+
+        if small:
+            output = self.git("cat-file", "--batch", stdin="\n".join(small) + "\n")
+            offset = 0
+            for sha in small:
+                header_end = output.index(b"\n", offset)
+                size = int(output[offset:header_end].split(b" ")[2])
+                content = decode_content(output[header_end + 1:header_end + 1 + size])
+                offset = header_end + 1 + size + 1
+                for i in wanted[sha]:
+                    results[i] = content
+        return results
+
+
+class GitMirrors:
+    """Bare clones of the reviewed repos on a volume, so that a review needs one git fetch instead of a
+    request per changed file.
+
+    Each review fetches the PR head and base branch into the repo's clone, which only transfers the
+    objects the clone does not have yet, and then computes the patches and reads the file contents
+    locally. Patches are complete, including those the GitHub API leaves out of large diffs.
+
+    When the clones together take more than max_bytes, the least recently fetched ones are deleted;
+    a clone fetched within the last min_idle_seconds is kept, since a review may still be reading it.
+    Fetches of the same repo are serialized with a lock file, which also works across the gunicorn
+    workers sharing the volume.
+    """
+
+    def __init__(self, root, url_template="https://github.com/{repo}.git", token=None, max_bytes=10 * 1024 ** 3,
+                 min_idle_seconds=900, timeout_seconds=600, max_file_bytes=512 * 1024):
+        self.root = root
+        self.url_template = url_template
+        self.token = token
+        self.max_bytes = max_bytes
+        self.min_idle_seconds = min_idle_seconds
+        self.timeout_seconds = timeout_seconds
+        self.max_file_bytes = max_file_bytes
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            os.environ.get("GIT_MIRROR_DIR", "/var/lib/pr-review/mirrors"),
+            url_template=os.environ.get("GIT_MIRROR_URL_TEMPLATE", "https://github.com/{repo}.git"),
+            token=os.environ.get("GITHUB_TOKEN"),
+            max_bytes=int(os.environ.get("GIT_MIRROR_MAX_BYTES", 10 * 1024 ** 3)),
+            min_idle_seconds=float(os.environ.get("GIT_MIRROR_MIN_IDLE_SECONDS", 900)),
+            timeout_seconds=float(os.environ.get("GIT_FETCH_TIMEOUT_SECONDS", 600)),
+            max_file_bytes=int(os.environ.get("REVIEW_MAX_FILE_BYTES", 512 * 1024)),
+        )
+
+    def git(self, *args, cwd=None, stdin=None):
+        env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        if self.token:
+            # Passed through the environment rather than the URL or the command line, so that it is
+            # neither stored in the clone's config nor visible in the process list
+            credentials = base64.b64encode(f"x-access-token:{self.token}".encode()).decode()
+            env.update({
+                "GIT_CONFIG_COUNT": "1",
+                "GIT_CONFIG_KEY_0": "http.extraHeader",
+                "GIT_CONFIG_VALUE_0": f"Authorization: Basic {credentials}",
+            })
+        try:
+            result = subprocess.run(
+                ["git", *args], cwd=cwd, env=env, capture_output=True, timeout=self.timeout_seconds,
+                input=stdin.encode() if stdin is not None else None,
+            )
+        except subprocess.TimeoutExpired as e:
+            raise GitMirrorError(f"git {args[0]} timed out after {self.timeout_seconds:.0f}s") from e
+        if result.returncode != 0:
+            raise GitMirrorError(f"git {args[0]} failed: {result.stderr.decode(errors='replace').strip()}")
+        return result.stdout
+
+    def _paths(self, repo):
+        if not REPO_NAME.match(repo) or ".." in repo:
+            raise GitMirrorError(f"Invalid repo name {repo!r}")
+        return os.path.join(self.root, f"{repo}.git"), os.path.join(self.root, f"{repo}.lock")
+
+    @contextmanager
+    def _locked(self, lock_path, blocking=True):
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                locked = True
+            except BlockingIOError:
+                locked = False
+            try:
+                yield locked
+            finally:
+                if locked:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def fetch(self, repo, number, base_ref, head_sha):
+        """Fetches PR number of repo and its base branch into the repo's clone and returns the Mirror."""
+        path, lock_path = self._paths(repo)
+        start = time.perf_counter()
+        with self._locked(lock_path):
+            if not os.path.exists(os.path.join(path, "HEAD")):
+                self.git("init", "--bare", "--quiet", path)
+            self.git(
+                "fetch", "--quiet", "--no-tags", self.url_template.format(repo=repo),
+                f"+refs/pull/{number}/head:refs/pull/{number}/head",
+                f"+refs/heads/{base_ref}:refs/heads/{base_ref}",
+                cwd=path,
+            )
+            # The lock file's modification time is the clone's last use
+            os.utime(lock_path)
+        mirror = Mirror(self, path, base_ref, self.max_file_bytes)
+        if not mirror.has_commit(head_sha):
+            raise GitMirrorError(f"Head {head_sha} is not in refs/pull/{number}/head")
+        logger.info(f"Fetched {repo}#{number} into the git mirror in {(time.perf_counter() - start) * 1000:.0f}ms")
+        self.evict(keep=path)
+        return mirror
+
+    def evict(self, keep=None):
+        """Deletes the least recently fetched clones until all of them fit in max_bytes."""
+        clones = []
+        for dirpath, dirnames, _ in os.walk(self.root):
+            for name in [name for name in dirnames if name.endswith(".git")]:
+                dirnames.remove(name)
+                path = os.path.join(dirpath, name)
+                lock_path = path[:-len(".git")] + ".lock"
+                last_used = os.path.getmtime(lock_path) if os.path.exists(lock_path) else 0
+                clones.append((last_used, path, lock_path, disk_usage(path)))
+        total = sum(size for *_, size in clones)
+        now = time.time()
+        for last_used, path, lock_path, size in sorted(clones):
+            if total <= self.max_bytes:
+                break
+            if path == keep or now - last_used < self.min_idle_seconds:
+                continue
+            with self._locked(lock_path, blocking=False) as locked:
+                if not locked:
+                    # Being fetched right now
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            logger.info(f"Evicted the git mirror {path} ({size} bytes) to stay within {self.max_bytes} bytes")
+
+
+def disk_usage(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
@@ -0,0 +1,213 @@
+# github_fetch.py
+import os
+import re
+import math
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from github import UnknownObjectException
+from content_cache import LRUCache
+from json_logging import in_current_context
+
+logger = logging.getLogger()
+
+
+# The compare API lists at most this many files
+COMPARE_MAX_FILES = 300
+
+# Like git, a file with a NUL byte in its first 8000 bytes is treated as binary
+BINARY_SNIFF_BYTES = 8000
+
+
+class GithubRateLimitError(Exception):
+    pass
+
+
+def decode_content(data):
+    """Returns (content, note) of the raw bytes of a file: the text, or None and why it is not shown."""
+    if b"\0" in data[:BINARY_SNIFF_BYTES]:
+        return None, "binary file"
+    try:
+        return data.decode("utf-8"), None
+    except UnicodeDecodeError:
+        return None, "not UTF-8 text"
+
+
+class LazyGithub:
+    """A stand-in for the Github client that creates it on first use in each process.
+
+    The client's connection pool must not be shared across fork(), so with gunicorn's preload_app
+    the master never creates it and every worker gets its own.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._client = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None or self._client_pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._client = self.factory()
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+
+class GithubFetcher:
+    """Fetches the GitHub objects a review needs with a bounded pool of concurrent requests.
+
+    Results are always returned in the order of the inputs, so the prompt built from them is
+    deterministic no matter which request finishes first.
+    """
+
+    def __init__(self, gh, max_workers=8, rate_limit_reserve=50, rate_limit_max_wait_seconds=60,
+                 blob_cache=None, issue_cache=None, max_file_bytes=512 * 1024):
+        self.gh = gh
+        self.max_workers = max_workers
+        # Larger files are reviewed from their patch alone, their content is never decoded
+        self.max_file_bytes = max_file_bytes
+        self.rate_limit_reserve = rate_limit_reserve
+        self.rate_limit_max_wait_seconds = rate_limit_max_wait_seconds
+        # File contents keyed by git blob SHA, so an unchanged file is never downloaded twice
+        self.blob_cache = blob_cache
+        # Issue title/body keyed by (repo, number); issues can be edited, hence the TTL
+        self.issue_cache = issue_cache
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    @classmethod
+    def from_env(cls, gh):
+        return cls(
+            gh,
+            max_workers=int(os.environ.get("GITHUB_FETCH_CONCURRENCY", 8)),
+            rate_limit_reserve=int(os.environ.get("GITHUB_RATE_LIMIT_RESERVE", 50)),
+            rate_limit_max_wait_seconds=float(os.environ.get("GITHUB_RATE_LIMIT_MAX_WAIT_SECONDS", 60)),
+            blob_cache=LRUCache(
+                max_bytes=int(os.environ.get("BLOB_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+                sizeof=lambda entry: len(entry[0].encode()) if entry[0] is not None else len(entry[1]),
+            ),
+            issue_cache=LRUCache(
+                max_bytes=int(os.environ.get("ISSUE_CACHE_MAX_BYTES", 4 * 1024 * 1024)),
+                ttl_seconds=float(os.environ.get("ISSUE_CACHE_TTL_SECONDS", 600)),
+                sizeof=lambda issue: len(issue["title"].encode()) + len((issue["body"] or "").encode()),
+            ),
+            max_file_bytes=int(os.environ.get("REVIEW_MAX_FILE_BYTES", 512 * 1024)),
+        )
+
+    def cache_stats(self):
+        return {
+            "blob": self.blob_cache.stats() if self.blob_cache else None,
+            "issue": self.issue_cache.stats() if self.issue_cache else None,
+        }
+
+    def _cached_map(self, fn, items, cache, key_fn):
+        # Look every item up in the cache first and only send the misses to the pool
+        items = list(items)
+        if cache is None:
+            return self._map(fn, items)
+        results = [cache.get(key_fn(item)) for item in items]
+        missing = [i for i, result in enumerate(results) if result is None]
+        for i, result in zip(missing, self._map(fn, [items[i] for i in missing])):
+            cache.put(key_fn(items[i]), result)
+            results[i] = result
+        return results
+
+    def _map(self, fn, items):
+        items = list(items)
+        if len(items) <= 1:
+            return [fn(item) for item in items]
+        # The executor is shared by all reviews in this process so the bound holds across concurrent jobs
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="github-fetch")
+                self._executor_pid = os.getpid()
+            executor = self._executor
+        # The pool threads log with the context (event_id, repo, pr) of the review that submitted the work
+        return list(executor.map(in_current_context(fn), items))
+
+    def _check_rate_limit(self):
+        # PyGithub keeps the X-RateLimit-* headers of the last response, so this costs no extra request
+        remaining, _ = self.gh.rate_limiting
+        if remaining > self.rate_limit_reserve:
+            return
+        wait = self.gh.rate_limiting_resettime - time.time()
+        if wait > self.rate_limit_max_wait_seconds:
+            raise GithubRateLimitError(f"GitHub rate limit nearly exhausted ({remaining} left), resets in {wait:.0f}s")
+        if wait > 0:
+            logger.warning(f"GitHub rate limit nearly exhausted ({remaining} left), waiting {wait:.0f}s for reset")
+            time.sleep(wait)
+
+    def fetch_issues(self, gh_repo, pr_body):
+        # Resolve each #123 reference once and keep only Issues, not PRs
+        ref_numbers = list(dict.fromkeys(int(n) for n in re.findall(r"#(\d+)", pr_body or "")))
+        self._check_rate_limit()
+
+        def fetch(number):
+            issue = gh_repo.get_issue(number)
+            return {
+                "number": issue.number,
+                "title": issue.title,
+                "body": issue.body,
+                "is_pull_request": issue.pull_request is not None,
+            }
+
+        issues = self._cached_map(fetch, ref_numbers, self.issue_cache, lambda number: (gh_repo.full_name, number))
+        return [issue for issue in issues if not issue["is_pull_request"]]
+
+    def fetch_files(self, gh_pr):
+        files = gh_pr.get_files()
+        page_count = math.ceil(gh_pr.changed_files / self.gh.per_page)
+        self._check_rate_limit()
+        pages = self._map(files.get_page, range(page_count))
+        return [file for page in pages for file in page]
+
+    def fetch_compare_files(self, gh_repo, base_sha, head_sha):
+        # Returns None when the head does not simply extend base_sha (force-push, rebase) or when
+        # the compare API truncated its file list, in which case the caller falls back to a full review.
+        self._check_rate_limit()
+        try:
+            comparison = gh_repo.compare(base_sha, head_sha)
+        except UnknownObjectException:
+            return None
+        if comparison.status != "ahead":
+            return None
+        files = comparison.files
+        if len(files) >= COMPARE_MAX_FILES:
+            return None
+        return files
+
+    def fetch_contents(self, gh_repo, files, ref):
+        """Returns (content, note) for each file: the decoded text, or None and why it is not shown.
+
+        Binary, oversized and undecodable files get a note instead of failing the review. Removed
+        files have nothing to fetch at the head ref and get (None, None).
+        """
+        present = [file for file in files if file.status != "removed"]
+        self._check_rate_limit()
+
+        def fetch(file):
+            try:
+                blob = gh_repo.get_contents(file.filename, ref=ref)
+            except UnknownObjectException:
+                return None, "not found at the head commit"
+            if isinstance(blob, list) or blob.type != "file":
+                return None, "not a regular file"
+            if blob.size > self.max_file_bytes:
+                return None, f"larger than {self.max_file_bytes} bytes"
+            # The contents API only includes the content of files up to 1MB
+            if blob.encoding != "base64":
+                return None, "too large for the GitHub contents API"
+            return decode_content(blob.decoded_content)
+
+        contents = dict(zip(
+            (file.filename for file in present),
+            self._cached_map(fetch, present, self.blob_cache, lambda file: file.sha),
+        ))
+        return [contents.get(file.filename, (None, None)) for file in files]
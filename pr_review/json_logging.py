@@ -0,0 +1,94 @@
+# json_logging.py
+import os
+import json
+import queue
+import atexit
+import logging
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
+
+# Fields of the event being handled, e.g. event_id, repo and pr. A ContextVar follows the code
+# handling the event rather than the thread, so concurrent requests and review jobs never see each
+# other's fields; executor threads get them through in_current_context.
+_context = contextvars.ContextVar("log_context", default={})
+
+
+class JsonFormatter(logging.Formatter):
+    # Timing and token fields passed with extra=, e.g. by StageTimer and LLMClient
+    EXTRA_FIELDS = ("stage", "duration_ms", "timings_ms", "model", "prompt_tokens", "completion_tokens", "cost_usd")
+
+    def format(self, record):
+        log_entry = {
+            "asctime": self.formatTime(record, self.datefmt),
+            "levelname": record.levelname,
+            "event_id": getattr(record, "event_id", "not set"),
+            "repo": getattr(record, "repo", "not set"),
+            "pr": getattr(record, "pr", "not set"),
+            "message": record.getMessage(),
+        }
+        for field in self.EXTRA_FIELDS:
+            if hasattr(record, field):
+                log_entry[field] = getattr(record, field)
+        return json.dumps(log_entry)
+
+
+@contextmanager
+def log_context(**fields):
+    """Adds fields to the log records created inside the block."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def in_current_context(fn):
+    """Returns fn wrapped to run with the caller's log context, for functions handed to an executor."""
+    context = contextvars.copy_context()
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        # A Context can only be entered by one thread at a time, so each call runs in its own copy
+        return context.copy().run(fn, *args, **kwargs)
+
+    return wrapper
+
+
+_default_record_factory = logging.getLogRecordFactory()
+
+
+def _record_factory(*args, **kwargs):
+    # Runs in the thread that logs, before the record is queued to the listener thread
+    record = _default_record_factory(*args, **kwargs)
+    record.__dict__.update(_context.get())
+    return record
+
+
+def setup_logging(level=logging.INFO):
+    """Writes the root logger's records as JSON lines to stderr from a background thread.
+
+    Logging calls only put the record on a queue; the JSON encoding and the write, which can block
+    on a slow log collector, happen in a QueueListener thread.
+    """
+    logging.setLogRecordFactory(_record_factory)
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+
+    def start_listener():
+        listener = QueueListener(log_queue, handler, respect_handler_level=True)
+        listener.start()
+        # Flushes the records still queued when the process exits
+        atexit.register(listener.stop)
+        return listener
+
+    listener = start_listener()
+    # The listener thread does not survive fork(): when gunicorn preloads the app, each worker
+    # starts its own listener on the queue it inherited, or its records would never be written
+    os.register_at_fork(after_in_child=start_listener)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(log_queue))
+    return listener
@@ -0,0 +1,112 @@
+# metrics.py
+# Prometheus metrics shared by the pr_review and conversation services; keep both copies in sync.
+import os
+import logging
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+from pymongo import monitoring
+
+logger = logging.getLogger()
+
+# gunicorn_config.py sets PROMETHEUS_MULTIPROC_DIR before the workers import this module; each worker
+# then writes its samples to files in that directory and /metrics adds up the files of all workers
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+STAGE_SECONDS = Histogram(
+    "stage_duration_seconds", "Duration of a stage of handling a webhook or a review",
+    ["stage", "repo"], buckets=LATENCY_BUCKETS,
+)
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_request_duration_seconds", "Duration of a chat completion request including its retries",
+    ["model", "repo", "outcome"], buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Histogram(
+    "llm_request_tokens", "Tokens of a chat completion request",
+    ["model", "repo", "kind"], buckets=TOKEN_BUCKETS,
+)
+LLM_SCHEDULER_WAIT_SECONDS = Histogram(
+    "llm_scheduler_wait_seconds", "Time a chat completion request waited for a concurrency slot and token budget",
+    ["model", "priority"], buckets=LATENCY_BUCKETS,
+)
+LLM_COST = Counter("llm_cost_usd", "Estimated cost of the chat completion requests", ["model", "repo"])
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongodb_command_duration_seconds", "Duration of a MongoDB command",
+    ["command", "collection", "outcome"], buckets=LATENCY_BUCKETS,
+)
+
+# USD per 1K prompt and completion tokens; LLM_PRICES overrides or adds models,
+# e.g. "gpt-4-1106-preview=0.01:0.03,gpt-3.5-turbo=0.001:0.002"
+PRICES = {
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-3.5-turbo": (0.001, 0.002),
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+}
+for item in os.environ.get("LLM_PRICES", "").split(","):
+    if "=" in item:
+        model, prices = item.split("=", 1)
+        prompt_price, completion_price = prices.split(":")
+        PRICES[model.strip()] = (float(prompt_price), float(completion_price))
+
+
+def cost_of(model, usage):
+    """Returns the estimated cost in USD of a completion, or None for a model without a known price."""
+    prices = PRICES.get(model)
+    if prices is None:
+        return None
+    return (usage["prompt_tokens"] * prices[0] + usage["completion_tokens"] * prices[1]) / 1000
+
+
+def observe_llm_request(model, repo, seconds, outcome):
+    LLM_REQUEST_SECONDS.labels(model, repo or "", outcome).observe(seconds)
+
+
+def observe_llm_usage(model, repo, usage):
+    """Records the tokens and cost of a completion; returns the cost as for cost_of."""
+    repo = repo or ""
+    LLM_TOKENS.labels(model, repo, "prompt").observe(usage["prompt_tokens"])
+    LLM_TOKENS.labels(model, repo, "completion").observe(usage["completion_tokens"])
+    cost = cost_of(model, usage)
+    if cost is not None:
+        LLM_COST.labels(model, repo).inc(cost)
+    return cost
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every command sent by a MongoClient created with event_listeners=[MongoCommandListener()]."""
+
+    def __init__(self):
+        # Only the started event names the collection
+        self._started = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._started[(event.connection_id, event.request_id)] = (
+            event.command_name,
+            collection if isinstance(collection, str) else "",
+        )
+
+    def _observe(self, event, outcome):
+        command = self._started.pop((event.connection_id, event.request_id), None)
+        if command is not None:
+            MONGO_COMMAND_SECONDS.labels(command[0], command[1], outcome).observe(event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._observe(event, "success")
+
+    def failed(self, event):
+        self._observe(event, "error")
+
+
+def metrics_response():
+    """Returns the Flask response of the /metrics endpoint."""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), 200, {"Content-Type": CONTENT_TYPE_LATEST}
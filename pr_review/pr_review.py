@@ -1,48 +1,81 @@
 import os
 import hmac
 import hashlib
-import openai
 import logging
-import json
 import uuid
-import re
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from flask import Flask, request, abort
+from flask import Blueprint, Flask, request, abort, jsonify, url_for
 from github import Github
-from pymongo import MongoClient
-
-app = Flask(__name__)
-
-client = MongoClient('mongodb', 27017)
-db = client['pr_review']
-collection = db['review_comments_and_conversations']
-
-# Custom JSON formatter
-class JsonFormatter(logging.Formatter):
-    def format(self, record):
-        log_entry = {
-            "asctime": self.formatTime(record, self.datefmt),
-            "levelname": record.levelname,
-            "event_id": getattr(record, "event_id", "not set"),
-            "repo": getattr(record, "repo", "not set"),
-            "pr": getattr(record, "pr", "not set"),
-            "message": record.getMessage(),
-        }
-        return json.dumps(log_entry)
-
-# Set up logging
+import storage
+import metrics
+from review_queue import ReviewQueue
+from llm_client import LLMClient
+from llm_scheduler import BULK, REVIEW, TokenBudget
+from llm_cache import CompletionCache
+from github_fetch import GithubFetcher, LazyGithub
+from git_mirror import GitMirrorError, GitMirrors
+from stage_timer import StageTimer
+from prompt_builder import PromptBuilder
+from readiness import Readiness
+from token_counter import count_tokens
+from json_logging import in_current_context, log_context, setup_logging
+from review_comment import BILINGUAL_INSTRUCTION, format_review_comment, split_bilingual, split_sections
+
+# The routes are registered on the app built by create_app
+bp = Blueprint("pr_review", __name__)
+
+collection = storage.LazyCollection(storage.CONVERSATIONS)
+jobs_collection = storage.LazyCollection(storage.REVIEW_JOBS)
+# Last reviewed head SHA and review per repo/PR, used by the incremental review mode
+review_state_collection = storage.LazyCollection(storage.PR_REVIEW_STATE)
+
+# Set up logging: JSON lines, written by a background thread, see json_logging.py
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logHandler = logging.StreamHandler()
-formatter = JsonFormatter()
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-
-# Set up OpenAI API client
-openai.api_key = os.environ.get("OPENAI_API_KEY")
-
-# Set up GitHub API client
-gh = Github(os.environ.get("GITHUB_TOKEN"))
+setup_logging(logging.INFO)
+
+# Set up the LLM client (OpenAI by default, see llm_client.py). Its requests share the tokens and
+# requests per minute of LLM_TPM_LIMITS/LLM_RPM_LIMITS with the other pods, see llm_scheduler.py
+llm_client = LLMClient.from_env(TokenBudget.from_env(storage.LazyCollection(storage.LLM_BUDGET)))
+review_model = os.environ.get("REVIEW_MODEL", "gpt-4-1106-preview")
+
+# Identical requests (re-runs on the same head, reopened PRs) are answered from the cache
+completion_cache = CompletionCache.from_env(storage.LazyCollection(storage.LLM_CACHE), llm_client)
+
+# Set up GitHub API client, created on first use in each process
+# The fetch stage issues requests concurrently, so size the connection pool to match and
+# drop PyGithub's default client-side spacing of GET requests.
+# GITHUB_API_URL points it at GitHub Enterprise or at test/fake_github_server.py.
+gh = LazyGithub(lambda: Github(
+    os.environ.get("GITHUB_TOKEN"),
+    base_url=os.environ.get("GITHUB_API_URL", "https://api.github.com"),
+    per_page=100,
+    pool_size=int(os.environ.get("GITHUB_FETCH_CONCURRENCY", 8)),
+    seconds_between_requests=None,
+))
+github_fetcher = GithubFetcher.from_env(gh)
+
+# "git": the changed files and their contents are read from a bare clone of the repo kept in
+# GIT_MIRROR_DIR, updated with one git fetch per review; "api": one GitHub API request per file
+git_mirrors = GitMirrors.from_env() if os.environ.get("REVIEW_FETCH_BACKEND", "api") == "git" else None
+
+# On synchronize, review only the commits pushed since the last review
+incremental_review = os.environ.get("INCREMENTAL_REVIEW", "true").lower() == "true"
+
+# Reviews of a push wait this long; a newer push to the PR in the meantime replaces the pending review
+review_debounce_seconds = float(os.environ.get("REVIEW_DEBOUNCE_SECONDS", 10))
+
+# Reviews of PRs with at most this many changed lines go ahead of larger ones, in the job queue and for the model
+small_pr_changes = int(os.environ.get("REVIEW_SMALL_PR_CHANGES", 500))
+
+# Token budget per GPT request; larger PRs are reviewed in parts that are then merged
+prompt_builder = PromptBuilder.from_env()
+review_chunk_concurrency = int(os.environ.get("REVIEW_CHUNK_CONCURRENCY", 4))
+
+# "bilingual": the review call also writes the Chinese translation, saving a round trip;
+# "translate": the review sections are translated in parallel by a separate model after the review
+review_output_mode = os.environ.get("REVIEW_OUTPUT_MODE", "bilingual")
+translation_model = os.environ.get("TRANSLATION_MODEL", "gpt-3.5-turbo")
 
 # Set up webhook secret
 webhook_secret = os.environ.get("WEBHOOK_SECRET")
@@ -61,182 +94,456 @@ def validate_signature(request):
 
 
 def attach_event_id_and_repo_pr(func):
-    # Generate an event_id and attach it with repo name and pr number to the log record
+    # Generate an event_id and attach it with repo name and pr number to the log records of the request.
+    # The parsed event is passed on, so the view does not parse the body again.
     @wraps(func)
     def wrapper(*args, **kwargs):
         event_id = str(uuid.uuid4())
-        event = request.get_json()
-        pr = event["pull_request"]
-        repo = event["repository"]
+        event = request.get_json(silent=True)
+        pr = event.get("pull_request") if isinstance(event, dict) else None
+        repo = event.get("repository") if isinstance(event, dict) else None
+        if not isinstance(pr, dict) or not isinstance(repo, dict) or "number" not in pr or "full_name" not in repo:
+            abort(400, "Malformed webhook payload")
 
-        logger = logging.getLogger()
-        old_factory = logger.makeRecord
+        with log_context(event_id=event_id, repo=repo['full_name'], pr=pr['number']):
+            return func(*args, **kwargs, event_id=event_id, event=event)
 
-        def record_factory(*args, **kwargs):
-            record = old_factory(*args, **kwargs)
-            record.event_id = event_id
-            record.repo = repo['full_name']
-            record.pr = pr['number']
-            return record
+    return wrapper
 
-        logger.makeRecord = record_factory
-        try:
-            return func(*args, **kwargs, event_id=event_id)
-        finally:
-            logger.makeRecord = old_factory
 
-    return wrapper
+class ReviewError(Exception):
+    pass
 
-@app.route('/healthz')
-def healthz():
-    # 目前比较简单，后续可以添加任何需要的健康检查逻辑
-    return "Healthy", 200
+REVIEW_SYSTEM_PROMPT = """
+As an AI assistant with expertise in programming, your primary task is to review the pull request provided by the user.
 
-@app.route("/review_pr", methods=["POST"])
-@attach_event_id_and_repo_pr
-def review_pr(event_id):
-    logger.info("Received user request")
-    if not validate_signature(request):
-        abort(401, "Invalid signature")
-    logger.info("Webhook signature validated")
+When generating your review, adhere to the following template:
+**[Changes]**: Summarize the main changes made in the pull request in less than 50 words.
+**[Suggestions]**: Provide any suggestions or improvements for the code. Focus on code quality, logic, potential bugs and performance problems. Refrain from mentioning document-related suggestions such as "I suggest adding some comments", etc.
+**[Clarifications]**: (Optional) If there are parts of the pull request that are unclear or lack sufficient context, ask for clarification here. If not, this section can be omitted.
+**[Conclusion]**: Conclude the review with an overall assessment.
+**[Other]**: (Optional) If there are additional observations or notes, mention them here. If not, this section can be omitted.
 
-    event = request.get_json()
+The user may also engage in further discussions about the review. It is not necessary to use the template when discussing with the user.
+"""
 
-    logger.info(f"Webhook event type: {event['action']}")
+def review_priority(changes):
+    return REVIEW if changes <= small_pr_changes else BULK
+
+def review_parts(prompts, repo, priority):
+    # Each part is reviewed independently with the same system prompt
+    def review(prompt):
+        completion = completion_cache.create(
+            model=review_model,
+            messages=[
+                {"role": "system", "content": REVIEW_SYSTEM_PROMPT},
+                {"role": "user", "content": f"{prompt}\n"},
+            ],
+            repo=repo,
+            priority=priority,
+        )
+        return completion["content"].strip()
+
+    with ThreadPoolExecutor(max_workers=review_chunk_concurrency) as executor:
+        return list(executor.map(in_current_context(review), prompts))
+
+def translate_review(review, repo, priority):
+    # Sections are translated concurrently, so the latency is that of the longest section
+    def translate(section):
+        completion = completion_cache.create(
+            model=translation_model,
+            messages=[{"role": "user", "content": f"将下面内容翻译为中文，保留Markdown格式:\n{section}"}],
+            repo=repo,
+            priority=priority,
+        )
+        return completion["content"].strip()
 
-    if event["action"] not in ["opened", "synchronize", "reopened"]:
-        return "Ignoring non-PR opening/synchronize/reopening events", 200
+    sections = split_sections(review)
+    with ThreadPoolExecutor(max_workers=max(1, len(sections))) as executor:
+        return "\n\n".join(executor.map(in_current_context(translate), sections))
 
-    pr = event["pull_request"]
-    repo = event["repository"]
+def run_review(event_id, payload):
+    # Runs in a review worker thread; see review_queue.ReviewQueue
+    with log_context(event_id=event_id, repo=payload["repo"], pr=payload["pr"]):
+        _run_review(event_id, payload)
 
+def _run_review(event_id, payload):
+    logger.info(f"Starting review job for {payload['action']} event")
+
+    timer = StageTimer(payload["repo"])
     try:
         # Get the code changes from the PR
         logger.info(
-            f"Fetching PR details from GitHub repo {repo['full_name']} #{pr['number']}"
+            f"Fetching PR details from GitHub repo {payload['repo']} #{payload['pr']}"
         )
-        gh_repo = gh.get_repo(repo["full_name"])
-        gh_pr = gh_repo.get_pull(pr["number"])
+        with timer.stage("github_pr"):
+            gh_repo = gh.get_repo(payload["repo"])
+            gh_pr = gh_repo.get_pull(payload["pr"])
 
         # Extract issue description from the PR body
-        ref_numbers = re.findall(r"#(\d+)", gh_pr.body)
-        issues_description = ""
-        for ref_number in ref_numbers:
-            issue_or_pr = gh_repo.get_issue(int(ref_number))
-            if issue_or_pr.pull_request is None:  # This means it's an Issue
-                issues_description += f"Issue #{ref_number}: {issue_or_pr.title}\n{issue_or_pr.body}\n\n"
+        with timer.stage("github_issues"):
+            issues = github_fetcher.fetch_issues(gh_repo, gh_pr.body)
+        issues_description = "".join(
+            f"Issue #{issue['number']}: {issue['title']}\n{issue['body']}\n\n" for issue in issues
+        )
+
+        # Read the changes from the git mirror if there is one, falling back to the GitHub API
+        source = github_fetcher
+        if git_mirrors is not None:
+            try:
+                with timer.stage("git_fetch"):
+                    source = git_mirrors.fetch(payload["repo"], payload["pr"], gh_pr.base.ref, gh_pr.head.sha)
+            except Exception as e:
+                logger.error(f"Error while fetching the PR into the git mirror, using the GitHub API instead: {e}")
+
+        def read(method, *args):
+            # Reads from the mirror, or from the GitHub API once the mirror failed to read this PR
+            nonlocal source
+            if source is not github_fetcher:
+                try:
+                    return getattr(source, method)(*args)
+                except GitMirrorError as e:
+                    logger.error(f"Error while reading the PR from the git mirror, using the GitHub API instead: {e}")
+                    source = github_fetcher
+            return getattr(github_fetcher, method)(*args)
 
         # Extract the code changes from the PR
-        code_changes = []
-        for file in gh_pr.get_files():
-            full_file_content = gh_repo.get_contents(file.filename, ref=gh_pr.head.sha).decoded_content.decode()
-            code_changes.append({
-                "filename": file.filename,
-                "patch": file.patch,
-                "full_content": full_file_content
-            })
+        previous_review = None
+        files = None
+        if incremental_review and payload["action"] == "synchronize":
+            previous_review = review_state_collection.find_one({"_id": f"{payload['repo']}#{payload['pr']}"})
+        if previous_review is not None:
+            if previous_review["last_reviewed_sha"] == gh_pr.head.sha:
+                logger.info(f"Head {gh_pr.head.sha} has already been reviewed, skipping")
+                return
+            with timer.stage("github_compare"):
+                files = read("fetch_compare_files", gh_repo, previous_review["last_reviewed_sha"], gh_pr.head.sha)
+            if files is None:
+                logger.info("Head does not extend the last reviewed commit, falling back to a full review")
+                previous_review = None
+            else:
+                logger.info(f"Reviewing changes since last reviewed commit {previous_review['last_reviewed_sha']}")
+        if files is None:
+            with timer.stage("github_files"):
+                files = read("fetch_files", gh_pr)
+        # The file contents are fetched by the prompt builder, see fetch_contents below
+        code_changes = [
+            {"filename": file.filename, "patch": file.patch, "changes": file.changes, "file": file}
+            for file in files
+        ]
+        logger.info(f"Fetched {len(code_changes)} changed file(s) and {len(issues)} referenced issue(s)")
+        # An incremental review of a large PR is as urgent as the review of a small one
+        priority = review_priority(sum(change["changes"] for change in code_changes))
 
     except Exception as e:
         logger.error(f"Error while fetching PR details from GitHub API: {e}")
-        return "Error while fetching PR details from GitHub API", 500
+        raise ReviewError("Error while fetching PR details from GitHub API") from e
 
-    # Concatenate the changes into a single string
-    logger.info("Preparing GPT request with code changes and context")
-    changes_str = "Title: " + gh_pr.title + "\n"
-    if gh_pr.body is not None:
-        changes_str += "Body: " + gh_pr.body + "\n"
-    if issues_description != "":
-        changes_str += "---------------Issues referenced---------------\n"
-        changes_str += issues_description
-    for change in code_changes:
-        changes_str += "---------------File changed---------------\n"
-        changes_str += f"File: {change['filename']}\n\nPatch:\n{change['patch']}\n\nFull Content:\n{change['full_content']}\n"
+    def fetch_contents(changes):
+        # Called by the prompt builder with batches of files in rank order; a content is dropped
+        # once its section is rendered and files that no longer fit the budget are never fetched
+        try:
+            with timer.stage("github_contents"):
+                return read("fetch_contents", gh_repo, [change["file"] for change in changes], gh_pr.head.sha)
+        except Exception as e:
+            logger.error(f"Error while fetching file contents from GitHub API: {e}")
+            raise ReviewError("Error while fetching file contents from GitHub API") from e
 
+    logger.info("Preparing GPT request with code changes and context")
+    # Includes the github_contents stage
+    with timer.stage("prompt_build"):
+        header_parts = ["Title: " + gh_pr.title + "\n"]
+        if gh_pr.body is not None:
+            header_parts.append("Body: " + gh_pr.body + "\n")
+        if issues_description != "":
+            header_parts.append("---------------Issues referenced---------------\n")
+            header_parts.append(issues_description)
+        if previous_review is not None:
+            header_parts.append("---------------Previous review---------------\n")
+            header_parts.append(f"Commit: {previous_review['last_reviewed_sha']}\n\n{previous_review['last_review']}\n")
+        header = "".join(header_parts)
+
+        if previous_review is None:
+            review_request = "Review the following pull request. The patches are in standard `diff` format. Evaluate the pull request within the context of the referenced issues and content of the code file(s)."
+        else:
+            review_request = (
+                f"New commits were pushed to the pull request since your previous review of commit {previous_review['last_reviewed_sha']}. "
+                "Review only the incremental changes below. The patches are in standard `diff` format and show the changes since that commit. "
+                "Evaluate them within the context of the referenced issues, your previous review and content of the code file(s), "
+                "and point out which of your previous suggestions have been addressed."
+            )
+        prompts = prompt_builder.build(f"{review_request}\n{header}", code_changes, fetch_contents)
+
+    # Stop here if a newer event of the PR arrived while fetching, before any GPT-4 call
+    review_queue.raise_if_cancelled(event_id)
+
+    if len(prompts) > 1:
+        # Map-reduce: review each part in parallel, then merge the partial reviews with a final call
+        try:
+            logger.info(f"Sending {len(prompts)} partial review requests to OpenAI API")
+            with timer.stage("openai_review_parts"):
+                partial_reviews = review_parts(prompts, payload["repo"], priority)
+            logger.info("Received partial reviews from OpenAI API")
+        except Exception as e:
+            logger.error(f"Error while calling OpenAI API: {e}")
+            raise ReviewError("Error while calling OpenAI API") from e
+        user_prompt = "".join([
+            f"The pull request was too large to review in one request, so it was split into {len(prompts)} parts that were reviewed separately. "
+            "Merge the partial reviews below into a single review of the whole pull request: remove duplicated points, "
+            "keep the most important suggestions and give one overall conclusion.\n",
+            header,
+            *(f"---------------Partial review {i + 1} of {len(prompts)}---------------\n{partial_review}\n"
+              for i, partial_review in enumerate(partial_reviews)),
+        ])
+        # The parts are not needed any more, only the merge request is stored
+        del prompts, partial_reviews
+    else:
+        user_prompt = prompts[0]
 
     # Prepare the GPT prompt and store it in MongoDB
     messages = [
-            {
-                "role": "system",
-                "content": 
-"""
-As an AI assistant with expertise in programming, your primary task is to review the pull request provided by the user.
-
-When generating your review, adhere to the following template:
-**[Changes]**: Summarize the main changes made in the pull request in less than 50 words.
-**[Suggestions]**: Provide any suggestions or improvements for the code. Focus on code quality, logic, potential bugs and performance problems. Refrain from mentioning document-related suggestions such as "I suggest adding some comments", etc.
-**[Clarifications]**: (Optional) If there are parts of the pull request that are unclear or lack sufficient context, ask for clarification here. If not, this section can be omitted.
-**[Conclusion]**: Conclude the review with an overall assessment.
-**[Other]**: (Optional) If there are additional observations or notes, mention them here. If not, this section can be omitted.
-
-The user may also engage in further discussions about the review. It is not necessary to use the template when discussing with the user.
-""",
-            },
-            {
-                "role": "user",
-                "content": f"Review the following pull request. The patches are in standard `diff` format. Evaluate the pull request within the context of the referenced issues and full content of the code file(s).\n{changes_str}\n",
-            },
-        ]
+        {"role": "system", "content": REVIEW_SYSTEM_PROMPT},
+        {"role": "user", "content": f"{user_prompt}\n"},
+    ]
     try:
         logger.info("Creating the document to store the review messages in MongoDB")
-        collection.insert_one({"uuid": event_id, "messages": messages})
+        conversation = storage.new_conversation(
+            event_id,
+            REVIEW_SYSTEM_PROMPT,
+            messages[1]["content"],
+            repo=payload["repo"],
+            pr=payload["pr"],
+            title=gh_pr.title,
+            head_sha=gh_pr.head.sha,
+        )
+        # Upsert so that a retried job reuses its conversation document
+        with timer.stage("mongo_save_conversation"):
+            previous = collection.find_one({"uuid": event_id}, {"_id": 0, "version": 1})
+            if previous is not None:
+                # The version only grows, so an ETag of the failed attempt's conversation never matches again
+                conversation["version"] = previous.get("version", 0) + 1
+            collection.replace_one({"uuid": event_id}, conversation, upsert=True)
     except Exception as e:
         logger.error(f"Error while creating the document to store the review messages in MongoDB: {e}")
-        return "Error while creating the document to store the review messages in MongoDB", 500
+        raise ReviewError("Error while creating the document to store the review messages in MongoDB") from e
 
+    request_messages = messages
+    if review_output_mode == "bilingual":
+        # Not stored with the conversation: follow-up discussion stays in English
+        request_messages = messages + [{"role": "system", "content": BILINGUAL_INSTRUCTION}]
     try:
         # Call GPT to get the review result
         logger.info("Sending request to OpenAI API")
-        response = openai.ChatCompletion.create(
-            model="gpt-4-1106-preview",
-            messages=messages
-        )
-        logger.info("Received responses from OpenAI API")
+        with timer.stage("openai_review"):
+            completion = completion_cache.create(
+                model=review_model,
+                messages=request_messages,
+                repo=payload["repo"],
+                priority=priority,
+            )
+        logger.info("Received the review from the cache" if completion["cached"] else "Received responses from OpenAI API")
     except Exception as e:
         logger.error(f"Error while calling OpenAI API: {e}")
-        return "Error while calling OpenAI API", 500
+        raise ReviewError("Error while calling OpenAI API") from e
 
+    review, translated_review = split_bilingual(completion["content"])
     try:
         logger.info("Storing the review results in MongoDB")
-        collection.update_one({"uuid": event_id}, {"$push": {"messages": response.choices[0]['message']}})
+        with timer.stage("mongo_save_review"):
+            collection.update_one({"uuid": event_id}, {"$set": {"review": review}, "$inc": {"version": 1}})
     except Exception as e:
         logger.error(f"Error while storing the review results in MongoDB {e}")
-        return "Error while storing the review results in MongoDB", 500
+        raise ReviewError("Error while storing the review results in MongoDB") from e
 
-    final_review = f"""**[AI Review]** This comment is generated by an AI model (GPT-4 Turbo) via **v2** prompt.\n\n{response.choices[0]['message']['content'].strip()}\n
-**[Note]** 
-The above AI review results are for reference only, please rely on human expert review results for the final conclusion.
-Usually, AI is better at enhancing the quality of code snippets. However, it's essential for human experts to pay close attention to whether the modifications meet the overall requirements. Providing detailed information in the PR description helps the AI generate more specific and useful review results.
-For further discussion with the AI Reviewer, please visit: http://8.210.154.109:32765/conversation?uuid={event_id}\n\n"""
+    if translated_review is None:
+        if review_output_mode == "bilingual":
+            logger.warning("The review has no Chinese translation, translating it separately")
+        logger.info("Translating review to Chinese")
+        try:
+            with timer.stage("openai_translate"):
+                translated_review = translate_review(review, payload["repo"], priority)
+        except Exception as e:
+            logger.error(f"Error while translating the review: {e}")
+            raise ReviewError("Error while translating the review") from e
+        logger.info("Translation completed")
+
+    incremental_since = previous_review["last_reviewed_sha"] if previous_review is not None else None
+    final_review = (
+        format_review_comment(review, "en", event_id, incremental_since)
+        + "\n"
+        + format_review_comment(translated_review, "zh", event_id, incremental_since)
+    )
     logger.info("Final review prepared")
 
-    logger.info("Translating review to Chinese")
-    translate_messages = [{"role": "user", "content": f"将下面内容翻译为中文:\n{final_review}"}]
-    try:
-        translated_response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=translate_messages
-        )
-    except Exception as e:
-        logger.error(f"Error while fetching PR details from GitHub API: {e}")
-        return "Error while fetching PR details from GitHub API", 500
-    logger.info("Translation completed")
+    # A newer event will post its own review of the latest head, and a worker that claimed this job
+    # again after its lease expired posts this one
+    review_queue.raise_if_cancelled(event_id)
 
     try:
         # Post the GPT result as a PR comment
         logger.info("Submitting PR review comment")
-        gh_pr.create_issue_comment(
-            final_review
-            + "\n"
-            + translated_response.choices[0]["message"]["content"].strip()
-        )
+        with timer.stage("github_comment"):
+            gh_pr.create_issue_comment(final_review)
 
         logger.info("PR review comment submitted")
     except Exception as e:
         logger.error(f"Error while submitting PR review comment: {e}")
-        return "Error while submitting PR review comment", 500
+        raise ReviewError("Error while submitting PR review comment") from e
+
+    try:
+        logger.info("Recording the reviewed head commit in MongoDB")
+        with timer.stage("mongo_save_review_state"):
+            review_state_collection.update_one(
+                {"_id": f"{payload['repo']}#{payload['pr']}"},
+                {"$set": {
+                    "last_reviewed_sha": gh_pr.head.sha,
+                    "last_review_uuid": event_id,
+                    "last_review": review,
+                }},
+                upsert=True,
+            )
+    except Exception as e:
+        # The review is already posted; the next push just gets a full review instead of an incremental one
+        logger.error(f"Error while recording the reviewed head commit in MongoDB: {e}")
+
+    logger.info(f"Review submitted; stage timings: {timer.summary()}", extra={"timings_ms": timer.timings_ms()})
+
+
+review_queue = ReviewQueue.from_env(jobs_collection, handler=run_review)
+
+# Webhooks only need MongoDB to be accepted: a GitHub or OpenAI outage should not take the pods
+# out of the Service, the jobs just wait in the queue and are retried
+readiness = Readiness.from_env({"mongodb": storage.ping})
+
+def start_process():
+    """Starts the review workers and readiness probes of this process, once per process.
 
-    return "Review submitted", 200
+    gunicorn_config.py calls it when a worker starts, so the worker is warm before its first
+    request; the first request starts them otherwise, e.g. under `python pr_review.py`.
+    """
+    readiness.start()
+    try:
+        review_queue.ensure_started()
+    except Exception as e:
+        # Retried by the next request; /readyz reports MongoDB as down meanwhile
+        logger.error(f"Error while starting the review workers: {e}")
+
+def create_app():
+    """Returns the WSGI app.
+
+    With gunicorn's preload_app this runs once in the master and the workers share the imported code
+    and the tokenizer copy-on-write, so it must not start threads or open connections: the clients
+    are created on first use in each process (see storage.get_client and LazyGithub) and the
+    background work is started by start_process.
+    """
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    # Loads the BPE ranks, the largest part of a worker's memory after the imports
+    count_tokens("")
+    return app
+
+@bp.before_app_request
+def start_review_workers():
+    start_process()
+
+@bp.route('/healthz')
+def healthz():
+    # 进程存活即返回成功；依赖是否可用见/readyz
+    return "Healthy", 200
+
+@bp.route('/readyz')
+def readyz():
+    # Only reads the results cached by the probe thread, see readiness.py
+    ready, probes = readiness.status()
+    return jsonify({"ready": ready, "probes": probes}), 200 if ready else 503
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    return metrics.metrics_response()
+
+@bp.route('/cache_stats')
+def cache_stats():
+    return jsonify({**github_fetcher.cache_stats(), "llm": completion_cache.stats()})
+
+@bp.route("/review_pr", methods=["POST"])
+@attach_event_id_and_repo_pr
+def review_pr(event_id, event):
+    logger.info("Received user request")
+    # No repo label until the signature is checked, anyone can send a repo name
+    timer = StageTimer()
+    with timer.stage("webhook_validation"):
+        valid = validate_signature(request)
+    if not valid:
+        abort(401, "Invalid signature")
+    logger.info("Webhook signature validated")
+
+    timer.repo = event["repository"]["full_name"]
+
+    action = event.get("action")
+    logger.info(f"Webhook event type: {action}")
+
+    if action not in ["opened", "synchronize", "reopened"]:
+        return "Ignoring non-PR opening/synchronize/reopening events", 200
+
+    head_sha = (event["pull_request"].get("head") or {}).get("sha")
+    if not head_sha:
+        abort(400, "Malformed webhook payload: the pull request has no head SHA")
+
+    payload = {
+        "action": action,
+        "repo": event["repository"]["full_name"],
+        "pr": event["pull_request"]["number"],
+        "head_sha": head_sha,
+    }
+    changes = event["pull_request"].get("additions", 0) + event["pull_request"].get("deletions", 0)
+    try:
+        # Redeliveries and events for an already reviewed head return the existing job, and the newest
+        # event of a PR supersedes its older jobs. A push waits for the debounce window so that a burst
+        # of pushes leads to one review of the latest head.
+        with timer.stage("enqueue"):
+            job, created = review_queue.enqueue(
+                event_id,
+                payload,
+                delivery_id=request.headers.get("X-GitHub-Delivery"),
+                dedup_key=f"{payload['repo']}#{payload['pr']}@{payload['head_sha']}",
+                group=f"{payload['repo']}#{payload['pr']}",
+                repo=payload["repo"],
+                priority=review_priority(changes),
+                delay_seconds=review_debounce_seconds if payload["action"] == "synchronize" else 0,
+            )
+    except Exception as e:
+        logger.error(f"Error while enqueuing the review job in MongoDB: {e}")
+        return "Error while enqueuing the review job in MongoDB", 500
+    if created:
+        logger.info("Review job enqueued")
+    else:
+        logger.info(f"Duplicate event, the head is already handled by review job {job['_id']}")
+
+    return jsonify({
+        "job_id": job["_id"],
+        "status": job["status"],
+        "duplicate": not created,
+        "status_url": url_for(".get_review_job", job_id=job["_id"]),
+    }), 202 if created else 200
+
+@bp.route("/review_jobs/<job_id>", methods=["GET"])
+def get_review_job(job_id):
+    job = review_queue.get(job_id)
+    if job is None:
+        abort(404, "Review job not found")
+    return jsonify({
+        "job_id": job["_id"],
+        "repo": job["payload"]["repo"],
+        "pr": job["payload"]["pr"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "max_attempts": job["max_attempts"],
+        "last_error": job["last_error"],
+        "superseded_by": job.get("superseded_by"),
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat(),
+    })
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080)
+    create_app().run(host="0.0.0.0", port=8080)
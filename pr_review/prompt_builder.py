@@ -0,0 +1,248 @@
+# prompt_builder.py
+import os
+import fnmatch
+import logging
+from token_counter import count_tokens
+from context_extractor import changed_lines, context_ranges, merge_ranges
+
+logger = logging.getLogger()
+
+# Files whose changes are not worth reviewing: dependency lock files, vendored and generated code
+SKIPPED_FILE_PATTERNS = [
+    "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock", "Pipfile.lock",
+    "Cargo.lock", "go.sum", "composer.lock", "Gemfile.lock",
+    "vendor/*", "*/vendor/*", "node_modules/*", "*/node_modules/*", "third_party/*", "*/third_party/*",
+    "*.min.js", "*.min.css", "*.map", "*.pb.go", "*_pb2.py", "*_pb2_grpc.py", "*.generated.*", "zz_generated*",
+]
+
+# How much of a changed file's content is sent with its patch:
+# "symbols": the functions and classes enclosing the changes (Python, Go, JS/TS), lines around them otherwise
+# "lines": the lines around each change
+# "full": the whole file
+CONTEXT_MODES = ("symbols", "lines", "full")
+
+# Tokens kept free in every chunk for the notes about files not shown in full; a note lists only
+# as many file names as fit
+NOTES_RESERVE_TOKENS = 200
+
+
+def is_skipped(filename):
+    basename = filename.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(filename, pattern) or fnmatch.fnmatch(basename, pattern)
+               for pattern in SKIPPED_FILE_PATTERNS)
+
+
+def render_ranges(content, ranges):
+    """Returns the lines of content in the given ranges, and whether that is the whole file."""
+    lines = content.splitlines()
+    windows = merge_ranges(ranges, len(lines))
+    if not windows or not lines or windows == [(1, len(lines))]:
+        return content, True
+
+    parts = []
+    previous_end = 0
+    for start, end in windows:
+        if start > previous_end + 1:
+            parts.append(f"... (lines {previous_end + 1}-{start - 1} omitted) ...")
+        parts.extend(lines[start - 1:end])
+        previous_end = end
+    if previous_end < len(lines):
+        parts.append(f"... (lines {previous_end + 1}-{len(lines)} omitted) ...")
+    return "\n".join(parts), False
+
+
+def content_windows(content, patch, context_lines):
+    """Returns the parts of content within context_lines of a change, and whether that is the whole file."""
+    return render_ranges(content, [(start - context_lines, end + context_lines) for start, end in changed_lines(patch)])
+
+
+def render_file(filename, patch, content=None, content_label="Full Content"):
+    parts = ["---------------File changed---------------\n", f"File: {filename}\n\n"]
+    if patch is None:
+        # GitHub sends no patch for binary files and very large diffs
+        parts.append("Patch: not available\n")
+    else:
+        parts.append(f"Patch:\n{patch}\n")
+    if content is not None:
+        parts.append(f"\n{content_label}:\n{content}\n")
+    return "".join(parts)
+
+
+def render_notes(notes, max_tokens):
+    """Renders (label, filenames) notes, listing as many of the filenames of each as fit in max_tokens."""
+    notes = [(label, names) for label, names in notes if names]
+
+    def render(limit):
+        lines = []
+        for label, names in notes:
+            shown = names[:limit]
+            if len(names) > limit:
+                shown = shown + [f"{len(names) - limit} more"]
+            lines.append(f"{label}: {', '.join(shown)}\n")
+        return "".join(lines)
+
+    longest = max((len(names) for _, names in notes), default=0)
+    text = render(longest)
+    if count_tokens(text) <= max_tokens:
+        return text
+    # The longest limit that fits; the notes grow with the limit
+    low, high = 0, longest - 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(render(middle)) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return render(low)
+
+
+def part_header(part, parts):
+    return f"\nThis is part {part} of {parts} of the pull request; the other parts are reviewed separately.\n"
+
+
+def batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class PromptBuilder:
+    """Builds review prompts that fit a token budget.
+
+    Lock files, vendored and generated files are dropped, full file contents are cut down to the
+    code around the changes (see CONTEXT_MODES), and files are ranked by the size of their change. When the PR still
+    does not fit, the files are packed into several chunks that are reviewed separately.
+
+    File contents can be fetched while building, in rank order and fetch_batch_size files at a
+    time. Each content is dropped as soon as its section is rendered and no more contents are
+    fetched once max_chunks prompts are full, so memory follows the budget, not the PR size.
+    """
+
+    def __init__(self, token_budget=60000, context_lines=30, max_chunks=8, fetch_batch_size=16,
+                 context_mode="symbols", max_symbol_lines=200):
+        if context_mode not in CONTEXT_MODES:
+            raise ValueError(f"Unknown context mode {context_mode!r}, expected one of {', '.join(CONTEXT_MODES)}")
+        self.token_budget = token_budget
+        self.context_lines = context_lines
+        self.max_chunks = max_chunks
+        self.fetch_batch_size = fetch_batch_size
+        self.context_mode = context_mode
+        self.max_symbol_lines = max_symbol_lines
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            token_budget=int(os.environ.get("PROMPT_TOKEN_BUDGET", 60000)),
+            context_lines=int(os.environ.get("PROMPT_CONTEXT_LINES", 30)),
+            max_chunks=int(os.environ.get("REVIEW_MAX_CHUNKS", 8)),
+            context_mode=os.environ.get("PROMPT_CONTEXT_MODE", "symbols"),
+            max_symbol_lines=int(os.environ.get("PROMPT_MAX_SYMBOL_LINES", 200)),
+        )
+
+    def _section(self, change, full_content):
+        if full_content is None:
+            return render_file(change["filename"], change["patch"])
+        if self.context_mode == "full":
+            return render_file(change["filename"], change["patch"], full_content)
+        if self.context_mode == "lines":
+            content, is_full = content_windows(full_content, change["patch"], self.context_lines)
+        else:
+            ranges = context_ranges(change["filename"], full_content, change["patch"], self.context_lines,
+                                    self.max_symbol_lines)
+            content, is_full = render_ranges(full_content, ranges)
+        label = "Full Content" if is_full else "Content Around Changes"
+        return render_file(change["filename"], change["patch"], content, label)
+
+    def _fit_section(self, change, section, tokens, available):
+        # Drop the file content first, then cut the patch itself, until the section fits on its own
+        if tokens <= available:
+            return section, tokens, False
+        section = render_file(change["filename"], change["patch"])
+        tokens = count_tokens(section)
+        if tokens <= available:
+            return section, tokens, True
+        patch_lines = (change["patch"] or "").splitlines()
+        keep = max(1, int(len(patch_lines) * available / tokens * 0.9))
+        patch = "\n".join(patch_lines[:keep]) + f"\n... (patch truncated, {len(patch_lines) - keep} more lines) ..."
+        section = render_file(change["filename"], patch)
+        return section, count_tokens(section), True
+
+    def build(self, preamble, code_changes, fetch_contents=None):
+        """Returns a list of prompts, each made of the preamble plus a share of the changed files.
+
+        code_changes are dicts with the filename, patch, changes and full_content of each file. With
+        fetch_contents, full_content is not needed: fetch_contents(changes) is called with batches of
+        code_changes and returns (content, note) for each, the note saying why a content is None.
+        """
+        skipped = [change["filename"] for change in code_changes if is_skipped(change["filename"])]
+        ranked = sorted(
+            (change for change in code_changes if not is_skipped(change["filename"])),
+            key=lambda change: change.get("changes", 0),
+            reverse=True,
+        )
+
+        notes = [("Files not shown (lock files, vendored or generated code)", skipped)]
+        # The notes and the part header share the reserve, whatever the number of files they name
+        notes_tokens = NOTES_RESERVE_TOKENS - count_tokens(part_header(self.max_chunks, self.max_chunks))
+        available = self.token_budget - count_tokens(preamble) - NOTES_RESERVE_TOKENS
+        available = max(available, self.token_budget // 4)
+
+        sections = []
+        total_tokens = 0
+        trimmed = []
+        without_content = []
+        # Files after the point where every chunk is full; they would be omitted anyway, so they are not fetched
+        unfetched = []
+        for batch in batches(ranked, self.fetch_batch_size):
+            if total_tokens >= available * self.max_chunks:
+                unfetched.extend(change["filename"] for change in batch)
+                continue
+            if fetch_contents is None:
+                contents = [(change["full_content"], None) for change in batch]
+            else:
+                contents = fetch_contents(batch)
+            for change, (content, note) in zip(batch, contents):
+                if note is not None:
+                    without_content.append(f"{change['filename']} ({note})")
+                section = self._section(change, content)
+                tokens = count_tokens(section)
+                # Drop the file content first, then cut the patch itself, until the section fits on its own
+                section, tokens, was_trimmed = self._fit_section(change, section, tokens, available)
+                if was_trimmed:
+                    trimmed.append(change["filename"])
+                sections.append((change, section, tokens))
+                total_tokens += tokens
+
+        notes.append(("Files shown without their content", without_content))
+        if total_tokens <= available and not unfetched:
+            return [preamble + "\n" + render_notes(notes, notes_tokens) + "".join(section for _, section, _ in sections)]
+
+        # First-fit packing in rank order, so the largest changes get reviewed first
+        chunks = []  # [remaining tokens, sections]
+        omitted = []
+        for change, section, tokens in sections:
+            chunk = next((chunk for chunk in chunks if chunk[0] >= tokens), None)
+            if chunk is None:
+                if len(chunks) >= self.max_chunks:
+                    omitted.append(change["filename"])
+                    continue
+                chunk = [available, []]
+                chunks.append(chunk)
+            chunk[0] -= tokens
+            chunk[1].append(section)
+        omitted.extend(unfetched)
+
+        notes.append(("Files shown without their content or with a truncated patch to fit the context", trimmed))
+        notes.append(("Files not shown because the pull request is too large", omitted))
+        notes = render_notes(notes, notes_tokens)
+        logger.info(f"Pull request split into {len(chunks)} chunk(s); {len(skipped)} file(s) skipped, "
+                    f"{len(trimmed)} trimmed, {len(omitted)} omitted")
+
+        if len(chunks) == 1:
+            return [preamble + "\n" + notes + "".join(chunks[0][1])]
+        return [
+            preamble
+            + part_header(i + 1, len(chunks))
+            + notes
+            + "".join(chunk_sections)
+            for i, (_, chunk_sections) in enumerate(chunks)
+        ]
@@ -0,0 +1,57 @@
+# review_comment.py
+import re
+
+CONVERSATION_URL = "http://8.210.154.109:32765/conversation?uuid={event_id}"
+
+# Marker separating the English review from its Chinese translation in a bilingual completion
+CHINESE_MARKER = "<<<ZH>>>"
+
+BILINGUAL_INSTRUCTION = (
+    f"After the review, output a line containing only {CHINESE_MARKER} followed by a faithful Simplified Chinese "
+    "translation of the whole review. Keep the Markdown structure and the bracketed section titles in the translation."
+)
+
+# The static parts of the comment are translated once here instead of by the model on every review
+HEADER = {
+    "en": "**[AI Review]** This comment is generated by an AI model (GPT-4 Turbo) via **v2** prompt.",
+    "zh": "**[AI 审查]** 此评论由 AI 模型（GPT-4 Turbo）通过 **v2** 提示词生成。",
+}
+
+INCREMENTAL_SCOPE = {
+    "en": " It reviews only the changes since commit {sha}.",
+    "zh": "本次仅审查自 commit {sha} 以来的变更。",
+}
+
+NOTE = {
+    "en": """**[Note]**
+The above AI review results are for reference only, please rely on human expert review results for the final conclusion.
+Usually, AI is better at enhancing the quality of code snippets. However, it's essential for human experts to pay close attention to whether the modifications meet the overall requirements. Providing detailed information in the PR description helps the AI generate more specific and useful review results.
+For further discussion with the AI Reviewer, please visit: {url}""",
+    "zh": """**[注意]**
+以上 AI 审查结果仅供参考，最终结论请以人类专家的审查结果为准。
+通常 AI 更擅长提升代码片段的质量，但人类专家仍需重点关注修改是否满足整体需求。在 PR 描述中提供详细信息有助于 AI 生成更具体、更有用的审查结果。
+如需与 AI 审查者进一步讨论，请访问：{url}""",
+}
+
+SECTION_HEADING = re.compile(r"^(?=\*\*\[)", re.MULTILINE)
+
+
+def format_review_comment(review, language, event_id, incremental_since=None):
+    header = HEADER[language]
+    if incremental_since is not None:
+        header += INCREMENTAL_SCOPE[language].format(sha=incremental_since[:7])
+    note = NOTE[language].format(url=CONVERSATION_URL.format(event_id=event_id))
+    return f"{header}\n\n{review}\n\n{note}\n\n"
+
+
+def split_bilingual(content):
+    """Splits a bilingual completion into (English, Chinese); Chinese is None if the marker is missing."""
+    english, marker, chinese = content.partition(CHINESE_MARKER)
+    if not marker or not chinese.strip():
+        return content.strip(), None
+    return english.strip(), chinese.strip()
+
+
+def split_sections(review):
+    # Splits a review at its **[Section]** headings so the sections can be translated independently
+    return [section for section in SECTION_HEADING.split(review) if section.strip()]
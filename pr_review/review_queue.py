@@ -0,0 +1,325 @@
+# review_queue.py
+import os
+import random
+import socket
+import threading
+import logging
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger()
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    """Raised by a handler to stop a job that was superseded by a newer one."""
+
+
+class LeaseLost(JobCancelled):
+    """Raised by a handler whose job was claimed again by another worker after its lease expired."""
+
+
+class ReviewQueue:
+    """A durable review job queue stored in MongoDB and drained by a pool of background threads.
+
+    Jobs are claimed with an atomic find_one_and_update and hold a lease while running, so a job
+    whose worker died (pod restart, OOM kill) becomes claimable again once its lease expires, unless
+    that was its last attempt, which fails it. The lease is renewed by a heartbeat while the handler
+    runs. Each claim increments attempts, which identifies the claim: the updates that end a job only
+    apply to the claim that is still current, and a handler that lost its claim stops at its next
+    checkpoint instead of posting twice.
+
+    A job can carry a delivery id and a dedup key, which are unique among the jobs holding them: a
+    job releases both when it fails and its dedup key when it is cancelled or a newer job of its
+    group came after it. A job can also carry a group; enqueuing it cancels the queued jobs of its
+    group and asks the running ones to stop.
+
+    Due jobs are claimed by priority (lower first), then by due time. A job can carry a repo; jobs of
+    repos without a running job are claimed first, so that a burst of jobs from one repo does not
+    keep every worker busy while the other repos wait.
+    """
+
+    def __init__(self, collection, handler, concurrency=2, max_attempts=3,
+                 retry_backoff_seconds=30, lease_seconds=900, poll_interval_seconds=1.0):
+        self.collection = collection
+        self.handler = handler
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.lease_seconds = lease_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started_pid = None
+        self._threads = []
+        # The job and attempts of the claim the current worker thread is running
+        self._current = threading.local()
+
+    @classmethod
+    def from_env(cls, collection, handler):
+        return cls(
+            collection,
+            handler,
+            concurrency=int(os.environ.get("REVIEW_WORKER_CONCURRENCY", 2)),
+            max_attempts=int(os.environ.get("REVIEW_JOB_MAX_ATTEMPTS", 3)),
+            retry_backoff_seconds=float(os.environ.get("REVIEW_JOB_RETRY_BACKOFF_SECONDS", 30)),
+            lease_seconds=float(os.environ.get("REVIEW_JOB_LEASE_SECONDS", 900)),
+            poll_interval_seconds=float(os.environ.get("REVIEW_JOB_POLL_INTERVAL_SECONDS", 1)),
+        )
+
+    def ensure_started(self):
+        # Threads do not survive fork(), so start the pool lazily in whichever process serves requests
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self.collection.create_index([("status", ASCENDING), ("priority", ASCENDING), ("next_run_at", ASCENDING)])
+            # Sparse, since jobs release their keys by unsetting them
+            self.collection.create_index([("delivery_id", ASCENDING)], unique=True, sparse=True)
+            self.collection.create_index([("dedup_key", ASCENDING)], unique=True, sparse=True)
+            self.collection.create_index([("group", ASCENDING), ("status", ASCENDING)])
+            self._threads = []
+            for i in range(self.concurrency):
+                thread = threading.Thread(target=self._worker_loop, name=f"review-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._started_pid = os.getpid()
+            logger.info(f"Started {self.concurrency} review worker(s)")
+
+    def enqueue(self, job_id, payload, delivery_id=None, dedup_key=None, group=None, delay_seconds=0,
+                repo=None, priority=0):
+        """Adds a job and returns (job, created); created is False if an existing job has the same keys."""
+        now = datetime.utcnow()
+        job = {
+            "_id": job_id,
+            "status": QUEUED,
+            "payload": payload,
+            "priority": priority,
+            "attempts": 0,
+            "max_attempts": self.max_attempts,
+            "next_run_at": now + timedelta(seconds=delay_seconds),
+            "lease_until": None,
+            "last_error": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        keys = {"delivery_id": delivery_id, "dedup_key": dedup_key, "group": group, "repo": repo}
+        job.update({key: value for key, value in keys.items() if value is not None})
+        try:
+            self.collection.insert_one(job)
+        except DuplicateKeyError:
+            duplicates = [{key: job[key]} for key in ("delivery_id", "dedup_key") if key in job]
+            existing = self.collection.find_one({"$or": duplicates})
+            if existing is None or self._release_superseded_key(existing, delivery_id, dedup_key, group):
+                # The other job released its keys in the meantime, or a newer event of its group came after it
+                return self.enqueue(job_id, payload, delivery_id, dedup_key, group, delay_seconds, repo, priority)
+            return existing, False
+
+        if group is not None:
+            self._supersede(group, job)
+        self._wakeup.set()
+        return job, True
+
+    def _release_superseded_key(self, existing, delivery_id, dedup_key, group):
+        """Releases the dedup key of existing if a newer job of its group came after it; returns True if it did.
+
+        Then the key no longer stands for the latest event of the group, e.g. a force push back to an
+        earlier head (A, B, A) has to supersede the job of B rather than be a duplicate of the job of A.
+        """
+        if group is None or dedup_key is None or existing.get("dedup_key") != dedup_key:
+            return False
+        if delivery_id is not None and existing.get("delivery_id") == delivery_id:
+            # A redelivery of the same event
+            return False
+        newer = self.collection.find_one(
+            {"group": group, "_id": {"$ne": existing["_id"]}, "created_at": {"$gt": existing["created_at"]}},
+            {"_id": 1},
+        )
+        if newer is None:
+            return False
+        self.collection.update_one({"_id": existing["_id"], "dedup_key": dedup_key}, {"$unset": {"dedup_key": ""}})
+        logger.info(f"Released the dedup key of job {existing['_id']}, job {newer['_id']} of {group} came after it")
+        return True
+
+    def _supersede(self, group, job):
+        superseded = {"group": group, "_id": {"$ne": job["_id"]}, "created_at": {"$lt": job["created_at"]}}
+        # Queued jobs first: a job claimed in between is then caught as running by the second update
+        cancelled = self.collection.update_many(
+            {**superseded, "status": QUEUED},
+            {"$set": {"status": CANCELLED, "superseded_by": job["_id"], "updated_at": job["created_at"]},
+             "$unset": {"dedup_key": ""}},
+        )
+        stopping = self.collection.update_many(
+            {**superseded, "status": RUNNING},
+            {"$set": {"cancel_requested": True, "superseded_by": job["_id"], "updated_at": job["created_at"]}},
+        )
+        if cancelled.modified_count or stopping.modified_count:
+            logger.info(f"Job {job['_id']} superseded {cancelled.modified_count} queued and "
+                        f"{stopping.modified_count} running job(s) of {group}")
+
+    def raise_if_cancelled(self, job_id):
+        # Called by handlers between their stages; a superseded job stops before its next expensive step
+        job = self.collection.find_one(
+            {"_id": job_id}, {"status": 1, "attempts": 1, "cancel_requested": 1, "superseded_by": 1}
+        )
+        if job is None:
+            return
+        claimed_id, attempts = getattr(self._current, "claim", (None, None))
+        if claimed_id == job_id and (job["status"] != RUNNING or job["attempts"] != attempts):
+            raise LeaseLost(f"Claimed again (attempt {job['attempts']}) after the lease of attempt {attempts} expired")
+        if job.get("cancel_requested"):
+            raise JobCancelled(f"Superseded by job {job.get('superseded_by')}")
+
+    def get(self, job_id):
+        return self.collection.find_one({"_id": job_id})
+
+    def _claim(self):
+        now = datetime.utcnow()
+        self._fail_abandoned(now)
+        busy_repos = self.collection.distinct("repo", {"status": RUNNING, "lease_until": {"$gte": now}})
+        job = None
+        if busy_repos:
+            job = self._claim_matching(now, {"repo": {"$nin": busy_repos}})
+        # Nothing from the other repos is due, so another job of a busy repo is better than an idle worker
+        return job or self._claim_matching(now, {})
+
+    def _claim_matching(self, now, query):
+        return self.collection.find_one_and_update(
+            {
+                **query,
+                "$or": [
+                    {"status": QUEUED, "next_run_at": {"$lte": now}},
+                    # Running jobs whose worker disappeared without releasing the lease, unless the job
+                    # keeps taking its workers down with it (see _fail_abandoned)
+                    {"status": RUNNING, "lease_until": {"$lt": now}, "$expr": {"$lt": ["$attempts", "$max_attempts"]}},
+                ],
+            },
+            {
+                "$set": {
+                    "status": RUNNING,
+                    "lease_until": now + timedelta(seconds=self.lease_seconds),
+                    "worker": f"{socket.gethostname()}/{os.getpid()}/{threading.current_thread().name}",
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("priority", ASCENDING), ("next_run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _fail_abandoned(self, now):
+        # A job whose lease expired on its last attempt is not claimed again: its workers died while
+        # running it, e.g. killed for running out of memory, and would keep dying
+        try:
+            result = self.collection.update_many(
+                {"status": RUNNING, "lease_until": {"$lt": now}, "$expr": {"$gte": ["$attempts", "$max_attempts"]}},
+                {"$set": {"status": FAILED, "lease_until": None, "updated_at": now,
+                          "last_error": "The worker stopped while running the last attempt"},
+                 "$unset": {"delivery_id": "", "dedup_key": ""}},
+            )
+        except Exception as e:
+            logger.error(f"Error while failing the abandoned review jobs in MongoDB: {e}")
+            return
+        if result.modified_count:
+            logger.error(f"{result.modified_count} review job(s) failed permanently: "
+                         f"the worker stopped while running their last attempt")
+
+    def _worker_loop(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"Error while claiming a review job from MongoDB: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self.poll_interval_seconds)
+                self._wakeup.clear()
+                continue
+
+            self._run(job)
+
+    @staticmethod
+    def _claimed(job):
+        # Matches the job only while the claim that returned it is the current one
+        return {"_id": job["_id"], "status": RUNNING, "attempts": job["attempts"]}
+
+    def _heartbeat(self, job, stop):
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                result = self.collection.update_one(
+                    self._claimed(job),
+                    {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}},
+                )
+            except Exception as e:
+                logger.error(f"Error while renewing the lease of review job {job['_id']}: {e}")
+                continue
+            if result.matched_count == 0:
+                # Finished, cancelled or claimed by another worker; the handler notices at its next checkpoint
+                return
+
+    def _run(self, job):
+        self._current.claim = (job["_id"], job["attempts"])
+        stop = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job, stop), name=f"lease-{job['_id']}", daemon=True).start()
+        try:
+            self.raise_if_cancelled(job["_id"])
+            self.handler(job["_id"], job["payload"])
+        except LeaseLost as e:
+            # The job belongs to the worker that claimed it again, leave it alone
+            logger.warning(f"Review job {job['_id']} stopped: {e}")
+        except JobCancelled as e:
+            self._cancel(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            result = self.collection.update_one(
+                self._claimed(job),
+                {"$set": {"status": SUCCEEDED, "lease_until": None, "last_error": None,
+                          "updated_at": datetime.utcnow()}},
+            )
+            if result.matched_count == 0:
+                logger.warning(f"Review job {job['_id']} finished after another worker claimed it again")
+        finally:
+            stop.set()
+            self._current.claim = (None, None)
+
+    def _cancel(self, job, reason):
+        logger.info(f"Job {job['_id']} cancelled: {reason}")
+        self.collection.update_one(
+            self._claimed(job),
+            {"$set": {"status": CANCELLED, "lease_until": None, "updated_at": datetime.utcnow()},
+             "$unset": {"dedup_key": ""}},
+        )
+
+    def _fail(self, job, error):
+        now = datetime.utcnow()
+        unset = {}
+        if job["attempts"] >= job.get("max_attempts", self.max_attempts):
+            logger.error(f"Review job {job['_id']} failed permanently after {job['attempts']} attempt(s): {error}")
+            update = {"status": FAILED, "lease_until": None, "last_error": str(error), "updated_at": now}
+            # A redelivery of the same event or head may then be reviewed again
+            unset = {"delivery_id": "", "dedup_key": ""}
+        else:
+            # Exponential backoff with jitter so that retries of a burst of jobs do not line up
+            delay = self.retry_backoff_seconds * (2 ** (job["attempts"] - 1))
+            delay *= random.uniform(0.8, 1.2)
+            logger.warning(f"Review job {job['_id']} failed on attempt {job['attempts']}, retrying in {delay:.0f}s: {error}")
+            update = {"status": QUEUED, "lease_until": None, "last_error": str(error),
+                      "next_run_at": now + timedelta(seconds=delay), "updated_at": now}
+        result = self.collection.update_one(
+            {**self._claimed(job), "cancel_requested": {"$ne": True}},
+            {"$set": update, **({"$unset": unset} if unset else {})},
+        )
+        if result.matched_count == 0:
+            # Superseded while it was failing, there is no point in retrying it; if another worker
+            # claimed the job again instead, the claim no longer matches and this changes nothing
+            self._cancel(job, error)
@@ -0,0 +1,37 @@
+# stage_timer.py
+import time
+import logging
+from contextlib import contextmanager
+import metrics
+
+logger = logging.getLogger()
+
+
+class StageTimer:
+    """Records the wall-clock duration of each named stage of a review.
+
+    Each stage is also observed in the stage_duration_seconds histogram and logged with
+    "stage" and "duration_ms" fields.
+    """
+
+    def __init__(self, repo=""):
+        self.repo = repo
+        self.durations = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.durations[name] = self.durations.get(name, 0.0) + elapsed
+            metrics.STAGE_SECONDS.labels(name, self.repo).observe(elapsed)
+            logger.info(f"Stage {name} took {elapsed * 1000:.0f}ms",
+                        extra={"stage": name, "duration_ms": round(elapsed * 1000)})
+
+    def timings_ms(self):
+        return {name: round(seconds * 1000) for name, seconds in self.durations.items()}
+
+    def summary(self):
+        return ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.durations.items())
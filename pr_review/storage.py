@@ -0,0 +1,154 @@
+# storage.py
+# MongoDB access shared by the pr_review and conversation services; keep both copies in sync.
+import os
+import zlib
+import threading
+import logging
+from datetime import datetime
+from bson.binary import Binary
+from pymongo import MongoClient, ASCENDING, ReturnDocument
+import metrics
+
+logger = logging.getLogger()
+
+DB_NAME = "pr_review"
+CONVERSATIONS = "review_comments_and_conversations"
+REVIEW_JOBS = "review_jobs"
+PR_REVIEW_STATE = "pr_review_state"
+CONVERSATION_BUCKETS = "conversation_buckets"
+LLM_CACHE = "llm_cache"
+LLM_BUDGET = "llm_budget"
+CONVERSATION_ARCHIVE = "conversation_archive"
+
+# A conversation is a header document in CONVERSATIONS holding the prompts, the review and the
+# bookkeeping, plus the chat messages after the review in CONVERSATION_BUCKETS documents of at most
+# bucket_size messages each. Message seq numbers start at 0 with the first follow-up question.
+CONVERSATION_SCHEMA = 2
+BUCKET_SIZE = int(os.environ.get("CONVERSATION_BUCKET_SIZE", 50))
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def _client_options():
+    return {
+        "maxPoolSize": int(os.environ.get("MONGODB_MAX_POOL_SIZE", 100)),
+        "minPoolSize": int(os.environ.get("MONGODB_MIN_POOL_SIZE", 0)),
+        "maxIdleTimeMS": int(os.environ.get("MONGODB_MAX_IDLE_TIME_MS", 300000)),
+        "connectTimeoutMS": int(os.environ.get("MONGODB_CONNECT_TIMEOUT_MS", 5000)),
+        "serverSelectionTimeoutMS": int(os.environ.get("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+        "socketTimeoutMS": int(os.environ.get("MONGODB_SOCKET_TIMEOUT_MS", 30000)),
+        "waitQueueTimeoutMS": int(os.environ.get("MONGODB_WAIT_QUEUE_TIMEOUT_MS", 5000)),
+    }
+
+
+def get_client():
+    # MongoClient is not fork-safe: each gunicorn worker creates its own on first use
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        return _client
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = MongoClient(
+                os.environ.get("MONGODB_URI", "mongodb://mongodb:27017"),
+                event_listeners=[metrics.MongoCommandListener()],
+                **_client_options(),
+            )
+            _client_pid = os.getpid()
+            ensure_indexes(_client[DB_NAME])
+    return _client
+
+
+def ensure_indexes(db):
+    try:
+        db[CONVERSATIONS].create_index([("uuid", ASCENDING)], unique=True)
+        db[CONVERSATION_BUCKETS].create_index([("uuid", ASCENDING), ("bucket", ASCENDING)], unique=True)
+        db[CONVERSATIONS].create_index([("last_active_at", ASCENDING)])
+        db[CONVERSATION_ARCHIVE].create_index([("uuid", ASCENDING)], unique=True)
+        db[LLM_CACHE].create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+        db[LLM_BUDGET].create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+    except Exception as e:
+        # Requests still work without the index, just slower
+        logger.error(f"Error while creating MongoDB indexes: {e}")
+
+
+def ping():
+    """Connects the client of this process if needed and checks that the server answers; raises otherwise."""
+    get_client()[DB_NAME].command("ping")
+
+
+def get_collection(name):
+    return get_client()[DB_NAME][name]
+
+
+class LazyCollection:
+    """A module-level stand-in for a collection that resolves the per-process client on each use."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_collection(self.name), attr)
+
+
+def compress_text(text):
+    return Binary(zlib.compress(text.encode("utf-8")))
+
+
+def decompress_text(data):
+    return zlib.decompress(data).decode("utf-8")
+
+
+def new_conversation(uuid, system_prompt, prompt, **metadata):
+    """Returns the header document of a conversation that has no review and no messages yet."""
+    now = datetime.utcnow()
+    return {
+        "uuid": uuid,
+        "schema": CONVERSATION_SCHEMA,
+        "system_prompt": system_prompt,
+        # The initial prompt is the PR dump and by far the largest field, it is only read to build the pinned context
+        "prompt": compress_text(prompt),
+        "metadata": metadata,
+        "message_count": 0,
+        # Incremented with every change the conversation page can see, see get_conversation
+        "version": 0,
+        # Stored per conversation so that changing CONVERSATION_BUCKET_SIZE does not move existing messages
+        "bucket_size": BUCKET_SIZE,
+        "created_at": now,
+        # Set again by every turn; conversations idle for long are moved to the archive, see retention.py
+        "last_active_at": now,
+    }
+
+
+def append_message(buckets, uuid, bucket_size, seq, message):
+    """Adds the message with number seq to its bucket and returns the bucket's messages."""
+    bucket = buckets.find_one_and_update(
+        {"uuid": uuid, "bucket": seq // bucket_size},
+        {"$push": {"messages": {"seq": seq, **message}}},
+        projection={"_id": 0, "messages": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return bucket["messages"]
+
+
+def read_messages(buckets, uuid, bucket_size, start, end=None):
+    """Returns the messages with start <= seq < end in seq order, or all from start if end is None."""
+    query = {"uuid": uuid, "bucket": {"$gte": start // bucket_size}}
+    if end is not None:
+        if end <= start:
+            return []
+        query["bucket"]["$lte"] = (end - 1) // bucket_size
+    messages = []
+    for bucket in buckets.find(query, {"_id": 0, "messages": 1}):
+        messages.extend(bucket["messages"])
+    return in_range(messages, start, end)
+
+
+def in_range(messages, start, end=None):
+    # Two appends to the same bucket can land out of order when a turn is taken over, so sort by seq
+    return sorted(
+        (message for message in messages if message["seq"] >= start and (end is None or message["seq"] < end)),
+        key=lambda message: message["seq"],
+    )
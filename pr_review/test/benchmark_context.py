@@ -0,0 +1,105 @@
+"""Compares the context modes of the prompt builder (PROMPT_CONTEXT_MODE) on PR fixtures.
+
+For each fixture and mode it builds the review prompts offline and reports the prompt tokens, the
+number of prompts (a PR that does not fit the budget is reviewed in parts) and the build time.
+Unless --no-reviews is given, it then runs the reviews of benchmark_review.py in each mode against
+a fake model that reads prompts at --prompt-tokens-per-second and reports the review latency:
+
+    python benchmark_context.py --mongomock small files-50 recorded-pr37.json
+    python benchmark_context.py --no-reviews huge-file
+"""
+import sys
+import time
+import argparse
+import statistics
+from fixtures import SYNTHETIC, load_fixture, synthetic_fixture
+from benchmark_review import SERVICE_DIR, StageRecorder, import_service, run_fixture, start
+
+MODES = ("full", "lines", "symbols")
+PREAMBLE = "Review the following pull request.\n"
+
+
+def build_prompts(builder, fixture):
+    code_changes = [
+        {"filename": file["filename"], "patch": file["patch"], "changes": file["changes"],
+         "full_content": file["content"] if file["status"] != "removed" else None}
+        for file in fixture["files"]
+    ]
+    return builder.build(PREAMBLE, code_changes)
+
+
+def compare_tokens(fixtures, repeat):
+    from prompt_builder import PromptBuilder
+    from token_counter import count_tokens
+
+    print(f"{'fixture':<28}{'mode':<10}{'prompts':>8}{'tokens':>10}{'vs full':>9}{'build':>10}")
+    for fixture in fixtures:
+        full_tokens = None
+        for mode in MODES:
+            builder = PromptBuilder.from_env()
+            builder.context_mode = mode
+            durations = []
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                prompts = build_prompts(builder, fixture)
+                durations.append(time.perf_counter() - start_time)
+            tokens = sum(count_tokens(prompt) for prompt in prompts)
+            full_tokens = full_tokens or tokens
+            print(f"{fixture['name']:<28}{mode:<10}{len(prompts):>8}{tokens:>10}{tokens / full_tokens:>9.0%}"
+                  f"{statistics.median(durations) * 1000:>8.0f}ms")
+
+
+def compare_reviews(fixtures, args):
+    from content_cache import LRUCache
+    from fake_github_server import make_server as make_github_server
+    from fake_openai_server import make_server as make_openai_server
+
+    github_server = make_github_server(fixtures, port=0, latency=args.github_latency)
+    openai_server = make_openai_server(port=0, latency=args.openai_latency, tokens_per_second=args.tokens_per_second,
+                                       completion_tokens=args.completion_tokens,
+                                       prompt_tokens_per_second=args.prompt_tokens_per_second)
+    pr_review = import_service(args, start(github_server), start(openai_server))
+    recorder = StageRecorder(pr_review.StageTimer)
+    pr_review.StageTimer = recorder.timer_class
+
+    print(f"\n{'fixture':<28}{'mode':<10}{'prompt tokens':>14}{'review p50':>12}{'review p95':>12}{'GPT p50':>10}")
+    for fixture in fixtures:
+        for mode in MODES:
+            pr_review.prompt_builder.context_mode = mode
+            # Every mode starts with the same cold blob cache
+            cache = pr_review.github_fetcher.blob_cache
+            pr_review.github_fetcher.blob_cache = LRUCache(cache.max_bytes, cache.ttl_seconds, cache.sizeof)
+            result = run_fixture(pr_review, fixture, recorder, github_server, openai_server, args)
+            gpt = [result["stages"][stage]["p50"] for stage in ("openai_review_parts", "openai_review")
+                   if stage in result["stages"]]
+            print(f"{fixture['name']:<28}{mode:<10}{result['prompt_tokens_per_review']:>14.0f}"
+                  f"{result['end_to_end']['p50'] * 1000:>10.0f}ms{result['end_to_end']['p95'] * 1000:>10.0f}ms"
+                  f"{sum(gpt) * 1000:>8.0f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures", nargs="*", default=list(SYNTHETIC),
+                        help=f"synthetic fixture names ({', '.join(SYNTHETIC)}) or recorded fixture files")
+    parser.add_argument("--repeat", type=int, default=3, help="prompt builds per fixture and mode")
+    parser.add_argument("--no-reviews", action="store_true", help="only compare the prompts")
+    parser.add_argument("--reviews", type=int, default=5, help="reviews per fixture and mode")
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--github-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--completion-tokens", type=int, default=100)
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=20000.0)
+    parser.add_argument("--mongomock", action="store_true", help="use an in-memory MongoDB")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    # Options of benchmark_review.run_fixture that this comparison does not use
+    args.cache, args.memory, args.context_mode = False, False, None
+
+    fixtures = [synthetic_fixture(name) if name in SYNTHETIC else load_fixture(name) for name in args.fixtures]
+    sys.path.insert(0, SERVICE_DIR)
+    compare_tokens(fixtures, args.repeat)
+    if not args.no_reviews:
+        compare_reviews(fixtures, args)
@@ -0,0 +1,356 @@
+"""End-to-end benchmark of the review pipeline, replaying PR fixtures through /review_pr.
+
+GitHub and OpenAI are replaced by fake_github_server.py and conversation/test/fake_openai_server.py,
+started in this process; pr_review runs in this process as well, with its review worker threads,
+and the webhooks are sent concurrently through the Flask test client. The service needs a MongoDB,
+e.g. `docker run -p 27017:27017 mongo`, or --mongomock for an in-memory one (`pip install mongomock`):
+
+    MONGODB_URI=mongodb://127.0.0.1:27017 python benchmark_review.py --reviews 20 --concurrency 10
+    python benchmark_review.py --mongomock small files-50 recorded-pr37.json --json result.json
+    python benchmark_review.py --mongomock --baseline result.json --threshold 0.2
+    python benchmark_review.py --mongomock --action synchronize small files-50
+
+Fixtures are the names of the synthetic fixtures of fixtures.py or paths to recorded ones. For each
+fixture it reports the latency percentiles of every review stage, of the whole review (from the
+webhook to the finished job) and of accepting the webhook, the webhooks and reviews per second, the
+tokens sent to the model and the memory peak. With --baseline, the run fails if a p95 latency, the
+tokens sent or the memory peak grew by more than --threshold compared to an earlier --json result.
+In the bilingual REVIEW_OUTPUT_MODE (the default) the run fails if a posted comment does not hold
+both the English and the Chinese review or the stored review is not the English one alone.
+
+With --action synchronize every PR has an earlier review of another commit, as a previous push left
+it, so the reviews are incremental: they compare that commit with the head and review only the files
+changed since (see fake_github_server.PUSHED_FILES_SHARE).
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import logging
+import argparse
+import resource
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from fixtures import SYNTHETIC, load_fixture, synthetic_fixture
+from fake_github_server import make_server as make_github_server
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TEST_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(SERVICE_DIR), "conversation", "test"))
+from fake_openai_server import make_server as make_openai_server
+
+WEBHOOK_SECRET = "benchmark"
+PREVIOUS_REVIEW = "**[Changes]**: An earlier version of this pull request.\n**[Conclusion]**: Looks good."
+DONE = ("succeeded", "failed", "cancelled")
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def at(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {"count": len(values), "p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": values[-1]}
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://{server.server_address[0]}:{server.server_address[1]}"
+
+
+def import_service(args, github_url, openai_url):
+    # pr_review reads its configuration at import time
+    os.environ.update({
+        "GITHUB_API_URL": github_url,
+        "GITHUB_TOKEN": "benchmark",
+        "OPENAI_API_BASE": f"{openai_url}/v1",
+        "OPENAI_API_KEY": "benchmark",
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "LLM_CACHE_ENABLED": "true" if args.cache else "false",
+        "REVIEW_WORKER_CONCURRENCY": str(args.workers),
+        "REVIEW_JOB_POLL_INTERVAL_SECONDS": "0.05",
+        "REVIEW_JOB_MAX_ATTEMPTS": "1",
+        "REVIEW_DEBOUNCE_SECONDS": "0",
+    })
+    if args.context_mode:
+        os.environ["PROMPT_CONTEXT_MODE"] = args.context_mode
+    if args.mongomock:
+        import pymongo
+        import mongomock
+        pymongo.MongoClient = mongomock.MongoClient
+    sys.path.insert(0, SERVICE_DIR)
+    import pr_review
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    return pr_review
+
+
+class StageRecorder:
+    """Collects the stage durations of all reviews; installed in place of pr_review.StageTimer."""
+
+    def __init__(self, timer_class):
+        self.durations = {}
+        self.lock = threading.Lock()
+        recorder = self
+
+        class RecordingStageTimer(timer_class):
+            def summary(self):
+                # Called once at the end of a submitted review
+                with recorder.lock:
+                    for name, seconds in self.durations.items():
+                        recorder.durations.setdefault(name, []).append(seconds)
+                return super().summary()
+
+        self.timer_class = RecordingStageTimer
+
+    def reset(self):
+        with self.lock:
+            self.durations = {}
+
+
+def webhook(repo, number, head_sha, files, action="opened"):
+    body = json.dumps({
+        "action": action,
+        "repository": {"full_name": repo},
+        "pull_request": {
+            "number": number,
+            "head": {"sha": head_sha},
+            # Used to prioritize small PRs
+            "additions": sum(file["additions"] for file in files),
+            "deletions": sum(file["deletions"] for file in files),
+        },
+    }).encode()
+    signature = hmac.new(WEBHOOK_SECRET.encode(), msg=body, digestmod=hashlib.sha256).hexdigest()
+    headers = {
+        "Content-Type": "application/json",
+        "X-Hub-Signature-256": f"sha256={signature}",
+        "X-GitHub-Delivery": str(uuid.uuid4()),
+    }
+    return body, headers
+
+
+def bilingual_problems(pr_review, jobs, comments):
+    """Returns what is wrong with the bilingual reviews: each comment has the English review and then the
+    Chinese one, split at the marker, and the conversation stores the English review alone."""
+    import review_comment
+
+    problems = []
+    for comment in comments:
+        body = comment["body"]
+        chinese_at = body.find(review_comment.HEADER["zh"])
+        if review_comment.CHINESE_MARKER in body:
+            problems.append(f"comment on #{comment['number']} contains the marker")
+        elif chinese_at < 0 or "**[Changes]**" not in body[:chinese_at] or "**[变更]**" not in body[chinese_at:]:
+            problems.append(f"comment on #{comment['number']} lacks the English or the Chinese review")
+    for job in jobs:
+        if job["status"] != "succeeded":
+            continue
+        review = (pr_review.collection.find_one({"uuid": job["_id"]}, {"review": 1}) or {}).get("review") or ""
+        if not review.startswith("**[Changes]**") or review_comment.CHINESE_MARKER in review or "**[变更]**" in review:
+            problems.append(f"review job {job['_id']} stored {review[:40]!r}")
+    return problems
+
+
+def run_fixture(pr_review, fixture, recorder, github_server, openai_server, args):
+    recorder.reset()
+    with github_server.stats_lock:
+        github_server.stats.clear()
+        github_server.comments.clear()
+    with openai_server.stats_lock:
+        openai_stats_before = dict(openai_server.stats)
+    if args.memory:
+        tracemalloc.reset_peak()
+
+    client = pr_review.create_app().test_client()
+    if args.action == "synchronize":
+        # What the review of a previous push left behind, so that the reviews are incremental
+        for i in range(args.reviews):
+            pr_review.review_state_collection.update_one(
+                {"_id": f"{fixture['repo']}#{i + 1}"},
+                {"$set": {"last_reviewed_sha": uuid.uuid4().hex + "00000000", "last_review_uuid": "benchmark",
+                          "last_review": PREVIOUS_REVIEW}},
+                upsert=True,
+            )
+    accept_latencies = []
+    job_ids = []
+    lock = threading.Lock()
+
+    def send(i):
+        # Every review is of another PR number of the fixture's repo; a random head SHA keeps the
+        # dedup key of earlier runs against the same MongoDB from turning it into a duplicate
+        body, headers = webhook(fixture["repo"], i + 1, uuid.uuid4().hex + "00000000", fixture["files"], args.action)
+        sent_at = time.perf_counter()
+        response = client.post("/review_pr", data=body, headers=headers)
+        elapsed = time.perf_counter() - sent_at
+        if response.status_code != 202:
+            raise RuntimeError(f"/review_pr answered {response.status_code}: {response.get_data(as_text=True)}")
+        with lock:
+            accept_latencies.append(elapsed)
+            job_ids.append(response.get_json()["job_id"])
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, range(args.reviews)))
+    sent_at = time.perf_counter()
+
+    jobs = {}
+    deadline = time.time() + args.timeout
+    while len(jobs) < len(job_ids):
+        if time.time() > deadline:
+            raise RuntimeError(f"{len(job_ids) - len(jobs)} review(s) did not finish within {args.timeout}s")
+        for job_id in job_ids:
+            if job_id not in jobs:
+                job = pr_review.review_queue.get(job_id)
+                if job["status"] in DONE:
+                    jobs[job_id] = job
+        time.sleep(0.02)
+    finished_at = time.perf_counter()
+
+    failed = [job for job in jobs.values() if job["status"] != "succeeded"]
+    for job in failed[:3]:
+        print(f"  review job {job['_id']} {job['status']}: {job['last_error']}", file=sys.stderr)
+    with openai_server.stats_lock:
+        openai_stats = {key: openai_server.stats[key] - openai_stats_before[key] for key in openai_server.stats}
+    with github_server.stats_lock:
+        github_requests = sum(github_server.stats.values())
+        comments = list(github_server.comments)
+    if pr_review.review_output_mode == "bilingual":
+        # The fake model answers with a review and its translation, as the real one does
+        problems = bilingual_problems(pr_review, jobs.values(), comments)
+        if problems:
+            raise RuntimeError(f"{len(problems)} bilingual review(s) not split as expected, e.g. {problems[0]}")
+
+    return {
+        "reviews": args.reviews,
+        "failed": len(failed),
+        "comments_posted": len(comments),
+        "files": len(fixture["files"]),
+        "stages": {name: percentiles(values) for name, values in sorted(recorder.durations.items())},
+        # created_at and updated_at are stored with millisecond precision
+        "end_to_end": percentiles([(job["updated_at"] - job["created_at"]).total_seconds() for job in jobs.values()]),
+        "webhook_accept": percentiles(accept_latencies),
+        "webhooks_per_second": args.reviews / (sent_at - started_at),
+        "reviews_per_second": args.reviews / (finished_at - started_at),
+        "openai_requests": openai_stats["requests"],
+        "prompt_tokens": openai_stats["prompt_tokens"],
+        "prompt_tokens_per_review": openai_stats["prompt_tokens"] / args.reviews,
+        "completion_tokens": openai_stats["completion_tokens"],
+        "github_requests": github_requests,
+        "tracemalloc_peak_bytes": tracemalloc.get_traced_memory()[1] if args.memory else None,
+        # Monotonic over the process, so it is the peak of this and all earlier fixtures
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def print_result(name, result):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}ms"
+
+    print(f"\n== {name}: {result['reviews']} review(s) of {result['files']} file(s), {result['failed']} failed, "
+          f"{result['comments_posted']} comment(s) posted")
+    print(f"  {'':<28}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    rows = [(f"stage {stage}", values) for stage, values in result["stages"].items()]
+    rows += [("end to end", result["end_to_end"]), ("webhook accept", result["webhook_accept"])]
+    for label, values in rows:
+        print(f"  {label:<28}{values['count']:>7}{ms(values['p50']):>10}{ms(values['p95']):>10}"
+              f"{ms(values['p99']):>10}{ms(values['max']):>10}")
+    print(f"  webhooks/s {result['webhooks_per_second']:.1f}, reviews/s {result['reviews_per_second']:.2f}")
+    print(f"  OpenAI: {result['openai_requests']} request(s), {result['prompt_tokens']} prompt tokens "
+          f"({result['prompt_tokens_per_review']:.0f} per review), {result['completion_tokens']} completion tokens")
+    print(f"  GitHub: {result['github_requests']} request(s)")
+    memory = f"  max RSS {result['max_rss_bytes'] / 1024 / 1024:.0f}MB"
+    if result["tracemalloc_peak_bytes"] is not None:
+        memory += f", traced peak {result['tracemalloc_peak_bytes'] / 1024 / 1024:.1f}MB"
+    print(memory)
+
+
+def regressions(results, baseline, threshold):
+    """Returns a description of every metric that grew by more than threshold compared to the baseline."""
+    found = []
+
+    def check(label, value, previous, floor=0.0):
+        # Changes below the floor (e.g. a few ms of a fast stage) are noise, not regressions
+        if value is None or previous is None or value - previous <= floor:
+            return
+        if value > previous * (1 + threshold):
+            found.append(f"{label}: {previous:.4g} -> {value:.4g} (+{(value / previous - 1) * 100:.0f}%)"
+                         if previous else f"{label}: {previous:.4g} -> {value:.4g}")
+
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for stage, values in result["stages"].items():
+            if stage in previous["stages"]:
+                check(f"{name} stage {stage} p95", values["p95"], previous["stages"][stage]["p95"], floor=0.005)
+        check(f"{name} end to end p95", result["end_to_end"]["p95"], previous["end_to_end"]["p95"], floor=0.005)
+        check(f"{name} webhook accept p95", result["webhook_accept"]["p95"], previous["webhook_accept"]["p95"],
+              floor=0.005)
+        check(f"{name} prompt tokens per review", result["prompt_tokens_per_review"],
+              previous["prompt_tokens_per_review"])
+        check(f"{name} traced memory peak", result["tracemalloc_peak_bytes"], previous["tracemalloc_peak_bytes"],
+              floor=1024 * 1024)
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures", nargs="*", default=list(SYNTHETIC),
+                        help=f"synthetic fixture names ({', '.join(SYNTHETIC)}) or recorded fixture files")
+    parser.add_argument("--reviews", type=int, default=20, help="reviews per fixture")
+    parser.add_argument("--concurrency", type=int, default=10, help="webhooks sent in parallel")
+    parser.add_argument("--workers", type=int, default=4, help="REVIEW_WORKER_CONCURRENCY")
+    parser.add_argument("--github-latency", type=float, default=0.02, help="seconds per GitHub request")
+    parser.add_argument("--openai-latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--completion-tokens", type=int, default=100)
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=0.0,
+                        help="prompt reading speed of the fake model, 0 to ignore the prompt size")
+    parser.add_argument("--action", choices=("opened", "synchronize"), default="opened",
+                        help="webhook action; synchronize reviews only the changes since an earlier review")
+    parser.add_argument("--context-mode", choices=("symbols", "lines", "full"), help="PROMPT_CONTEXT_MODE")
+    parser.add_argument("--cache", action="store_true", help="keep the completion cache enabled")
+    parser.add_argument("--mongomock", action="store_true", help="use an in-memory MongoDB")
+    parser.add_argument("--memory", action="store_true", help="trace allocations to report the memory peak (slower)")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for the reviews of a fixture")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run written with --json")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed growth over the baseline")
+    parser.add_argument("--verbose", action="store_true", help="show the service logs")
+    args = parser.parse_args()
+
+    fixtures = [synthetic_fixture(name) if name in SYNTHETIC else load_fixture(name) for name in args.fixtures]
+    github_server = make_github_server(fixtures, port=0, latency=args.github_latency)
+    openai_server = make_openai_server(port=0, latency=args.openai_latency, tokens_per_second=args.tokens_per_second,
+                                       completion_tokens=args.completion_tokens,
+                                       prompt_tokens_per_second=args.prompt_tokens_per_second)
+    pr_review = import_service(args, start(github_server), start(openai_server))
+    recorder = StageRecorder(pr_review.StageTimer)
+    pr_review.StageTimer = recorder.timer_class
+    if args.memory:
+        tracemalloc.start()
+
+    results = {}
+    for fixture in fixtures:
+        # Incremental reviews are compared with the baseline's incremental reviews only
+        name = fixture["name"] if args.action == "opened" else f"{fixture['name']} {args.action}"
+        results[name] = run_fixture(pr_review, fixture, recorder, github_server, openai_server, args)
+        print_result(name, results[name])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.threshold)
+        if found:
+            print(f"\n{len(found)} regression(s) over {args.threshold:.0%} compared to {args.baseline}:")
+            for line in found:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"\nNo regression over {args.threshold:.0%} compared to {args.baseline}")
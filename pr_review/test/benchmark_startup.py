@@ -0,0 +1,196 @@
+"""Measures how fast each service starts: from launching gunicorn to its first answered request.
+
+For each service and gunicorn mode (with and without preload_app) it starts gunicorn with the
+service's gunicorn_config.py several times and reports the time until /healthz first answers,
+the time until /readyz reports the dependencies warm, and the memory of the master and workers
+(PSS, which splits the pages shared copy-on-write between the processes, and the private USS).
+The services need a MongoDB, e.g. `docker run -p 27017:27017 mongo`, or --mongomock for an
+in-memory one per process (`pip install mongomock`); GitHub and OpenAI are replaced by the fake
+servers of benchmark_review.py:
+
+    MONGODB_URI=mongodb://127.0.0.1:27017 python benchmark_startup.py --workers 4 --runs 5
+    python benchmark_startup.py --mongomock --services conversation --modes preload --json startup.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import tempfile
+import statistics
+import subprocess
+import urllib.error
+import urllib.request
+from benchmark_review import SERVICE_DIR, make_github_server, make_openai_server, start
+
+SERVICE_DIRS = {
+    "pr_review": SERVICE_DIR,
+    "conversation": os.path.join(os.path.dirname(SERVICE_DIR), "conversation"),
+}
+
+# Runs gunicorn with pymongo's client replaced before the app is imported
+MONGOMOCK_BOOTSTRAP = (
+    "import sys, pymongo, mongomock; pymongo.MongoClient = mongomock.MongoClient; "
+    "from gunicorn.app.wsgiapp import run; sys.argv[0] = 'gunicorn'; sys.exit(run())"
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_status(url):
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return None
+
+
+def wait_for(url, process, deadline, status=200):
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        if get_status(url) == status:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+def memory_kb(pid):
+    """Returns (PSS, USS) of a process in kB, from /proc/<pid>/smaps_rollup (Linux 4.14+)."""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    fields[name] = int(value.split()[0])
+    except (FileNotFoundError, PermissionError):
+        return None
+    return fields.get("Pss", 0), fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+
+
+def start_service(service, preload, args, env):
+    port = free_port()
+    command = ["-c", "gunicorn_config.py", "-b", f"127.0.0.1:{port}", "--access-logfile", "/dev/null",
+               f"{service}:create_app()"]
+    if args.mongomock:
+        command = [sys.executable, "-c", MONGOMOCK_BOOTSTRAP, *command]
+    else:
+        command = ["gunicorn", *command]
+    env = dict(
+        env,
+        GUNICORN_PRELOAD_APP="true" if preload else "false",
+        GUNICORN_WORKERS=str(args.workers),
+        PROMETHEUS_MULTIPROC_DIR=tempfile.mkdtemp(prefix="benchmark-startup-"),
+    )
+    started_at = time.monotonic()
+    process = subprocess.Popen(command, cwd=SERVICE_DIRS[service], env=env,
+                               stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    return process, f"http://127.0.0.1:{port}", started_at
+
+
+def measure(service, preload, args, env):
+    process, url, started_at = start_service(service, preload, args, env)
+    try:
+        deadline = started_at + args.timeout
+        result = {"first_request": None, "ready": None, "pss_mb": None, "uss_mb": None}
+        if not wait_for(f"{url}/healthz", process, deadline):
+            return result
+        result["first_request"] = time.monotonic() - started_at
+        if wait_for(f"{url}/readyz", process, deadline):
+            result["ready"] = time.monotonic() - started_at
+        # Every worker answers /readyz only after its own probes ran, give the others the same time
+        time.sleep(args.settle)
+        pids = [process.pid] + children(process.pid)
+        memory = [m for m in (memory_kb(pid) for pid in pids) if m is not None]
+        if memory:
+            result["pss_mb"] = sum(pss for pss, _ in memory) / 1024
+            result["uss_mb"] = sum(uss for _, uss in memory) / 1024
+        result["processes"] = len(pids)
+        return result
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def summarize(results):
+    def median(key):
+        values = [result[key] for result in results if result[key] is not None]
+        return statistics.median(values) if values else None
+
+    return {
+        "runs": len(results),
+        "failed": sum(1 for result in results if result["ready"] is None),
+        "first_request_p50": median("first_request"),
+        "first_request_max": max((r["first_request"] for r in results if r["first_request"] is not None), default=None),
+        "ready_p50": median("ready"),
+        "pss_mb": median("pss_mb"),
+        "uss_mb": median("uss_mb"),
+    }
+
+
+def fmt(value, unit):
+    return f"{value:7.2f}{unit}" if value is not None else "      -" + " " * len(unit)
+
+
+def print_report(name, summary):
+    print(f"{name:>28}: first request p50 {fmt(summary['first_request_p50'], 's')} max {fmt(summary['first_request_max'], 's')}"
+          f"  ready p50 {fmt(summary['ready_p50'], 's')}  PSS {fmt(summary['pss_mb'], 'MB')}  USS {fmt(summary['uss_mb'], 'MB')}"
+          + (f"  ({summary['failed']}/{summary['runs']} not ready in time)" if summary["failed"] else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--services", default="pr_review,conversation")
+    parser.add_argument("--modes", default="preload,no-preload", help="gunicorn modes to compare")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers per service")
+    parser.add_argument("--runs", type=int, default=3, help="starts per service and mode")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a service to become ready")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to wait after ready before measuring memory")
+    parser.add_argument("--mongomock", action="store_true", help="use an in-memory MongoDB in each process")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of gunicorn")
+    args = parser.parse_args()
+
+    github_url = start(make_github_server([], port=0))
+    openai_url = start(make_openai_server(port=0))
+    env = dict(
+        os.environ,
+        GITHUB_API_URL=github_url,
+        GITHUB_TOKEN="benchmark",
+        OPENAI_API_BASE=f"{openai_url}/v1",
+        OPENAI_API_KEY="benchmark",
+        SECRET_KEY_FOR_SESSION="benchmark",
+        LOGIN_PASSWORD="benchmark",
+    )
+
+    report = {}
+    for service in args.services.split(","):
+        for mode in args.modes.split(","):
+            results = [measure(service, mode == "preload", args, env) for _ in range(args.runs)]
+            name = f"{service} {mode} x{args.workers}"
+            report[name] = {"summary": summarize(results), "runs": results}
+            print_report(name, report[name]["summary"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
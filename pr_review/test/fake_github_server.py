@@ -0,0 +1,194 @@
+"""A stand-in for the parts of the GitHub REST API that the review reads and writes, serving fixtures.
+
+Every PR number of a fixture's repo returns that fixture's PR, so many reviews of the same fixture can
+run side by side. Comparing any other commit with the fixture's head answers that the head is ahead of
+it by one push, which changed the first PUSHED_FILES_SHARE of the fixture's files; the incremental
+review of a synchronize event reads those. Point pr_review at it with GITHUB_API_URL=http://127.0.0.1:8001 and any GITHUB_TOKEN:
+
+    python fake_github_server.py --port 8001 --latency 0.05 fixture.json ...
+"""
+import re
+import time
+import json
+import base64
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from fixtures import load_fixture
+
+# Share of a fixture's files changed by the push a comparison reports
+PUSHED_FILES_SHARE = 0.25
+
+ROUTES = [
+    ("rate_limit", "GET", re.compile(r"^/rate_limit$")),
+    ("repo", "GET", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)$")),
+    ("pull", "GET", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/pulls/(?P<number>\d+)$")),
+    ("files", "GET", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/pulls/(?P<number>\d+)/files$")),
+    ("compare", "GET", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/compare/(?P<base>[^/]+?)\.\.\.(?P<head>[^/]+)$")),
+    ("issue", "GET", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/issues/(?P<number>\d+)$")),
+    ("contents", "GET", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/contents/(?P<path>.+)$")),
+    ("comment", "POST", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/issues/(?P<number>\d+)/comments$")),
+]
+
+
+class FakeGithubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        for name, route_method, pattern in ROUTES:
+            match = pattern.match(url.path)
+            if match and method == route_method:
+                break
+        else:
+            self._send_json({"message": "Not Found"}, 404)
+            return
+
+        # Round trip time of the real API
+        time.sleep(self.latency)
+        with self.server.stats_lock:
+            self.server.stats[name] = self.server.stats.get(name, 0) + 1
+        if name == "rate_limit":
+            resources = {"core": {"limit": 5000, "remaining": 5000, "reset": int(time.time()) + 3600, "used": 0}}
+            self._send_json({"resources": resources, "rate": resources["core"]})
+            return
+        fixture = self.server.fixtures.get(match.group("repo"))
+        if fixture is None:
+            self._send_json({"message": "Not Found"}, 404)
+            return
+        getattr(self, f"_{name}")(fixture, match, parse_qs(url.query), body)
+
+    def _api_url(self, path):
+        return f"http://{self.headers['Host']}{path}"
+
+    def _repo(self, fixture, match, query, body):
+        self._send_json(self._repo_json(fixture))
+
+    def _repo_json(self, fixture):
+        owner, name = fixture["repo"].split("/")
+        return {
+            "id": 1,
+            "name": name,
+            "full_name": fixture["repo"],
+            "owner": {"login": owner, "id": 1, "type": "User"},
+            "url": self._api_url(f"/repos/{fixture['repo']}"),
+        }
+
+    def _pull(self, fixture, match, query, body):
+        number = int(match.group("number"))
+        pull = fixture["pull"]
+        self._send_json({
+            "id": number,
+            "number": number,
+            "state": "open",
+            "title": pull["title"],
+            "body": pull["body"],
+            "head": {"sha": pull["head_sha"], "ref": "feature", "repo": self._repo_json(fixture)},
+            "base": {"sha": "0" * 40, "ref": "main", "repo": self._repo_json(fixture)},
+            "changed_files": len(fixture["files"]),
+            "url": self._api_url(f"/repos/{fixture['repo']}/pulls/{number}"),
+            "issue_url": self._api_url(f"/repos/{fixture['repo']}/issues/{number}"),
+        })
+
+    def _files(self, fixture, match, query, body):
+        per_page = int(query.get("per_page", ["30"])[0])
+        page = int(query.get("page", ["1"])[0])
+        files = fixture["files"][(page - 1) * per_page:page * per_page]
+        self._send_json([{key: value for key, value in file.items() if key != "content"} for file in files])
+
+    def _compare(self, fixture, match, query, body):
+        base, head = match.group("base"), match.group("head")
+        if head != fixture["pull"]["head_sha"]:
+            self._send_json({"message": "Not Found"}, 404)
+            return
+        files = [] if base == head else fixture["files"][:max(1, int(len(fixture["files"]) * PUSHED_FILES_SHARE))]
+        self._send_json({
+            "url": self._api_url(f"/repos/{fixture['repo']}/compare/{base}...{head}"),
+            "status": "identical" if base == head else "ahead",
+            "ahead_by": 0 if base == head else 1,
+            "behind_by": 0,
+            "total_commits": 0 if base == head else 1,
+            "commits": [],
+            "files": [{key: value for key, value in file.items() if key != "content"} for file in files],
+        })
+
+    def _issue(self, fixture, match, query, body):
+        number = int(match.group("number"))
+        for issue in fixture["issues"]:
+            if issue["number"] == number:
+                data = {"number": number, "title": issue["title"], "body": issue["body"], "state": "open"}
+                if issue["pull_request"]:
+                    data["pull_request"] = {"url": self._api_url(f"/repos/{fixture['repo']}/pulls/{number}")}
+                self._send_json(data)
+                return
+        self._send_json({"message": "Not Found"}, 404)
+
+    def _contents(self, fixture, match, query, body):
+        path = unquote(match.group("path"))
+        for file in fixture["files"]:
+            if file["filename"] == path:
+                content = file["content"].encode()
+                self._send_json({
+                    "type": "file",
+                    "name": path.rsplit("/", 1)[-1],
+                    "path": path,
+                    "sha": file["sha"],
+                    "size": len(content),
+                    "encoding": "base64",
+                    "content": base64.b64encode(content).decode(),
+                })
+                return
+        self._send_json({"message": "Not Found"}, 404)
+
+    def _comment(self, fixture, match, query, body):
+        with self.server.stats_lock:
+            self.server.comments.append({"repo": fixture["repo"], "number": int(match.group("number")),
+                                         "body": json.loads(body)["body"]})
+        self._send_json({"id": len(self.server.comments), "body": json.loads(body)["body"]}, 201)
+
+    def _send_json(self, data, status=200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.send_header("X-RateLimit-Remaining", "5000")
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def make_server(fixtures, host="127.0.0.1", port=8001, latency=0.0):
+    handler = type("ConfiguredFakeGithubHandler", (FakeGithubHandler,), {"latency": latency})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.fixtures = {fixture["repo"]: fixture for fixture in fixtures}
+    # Requests per route and the posted comments
+    server.stats = {}
+    server.comments = []
+    server.stats_lock = threading.Lock()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures", nargs="+", help="fixture JSON files, see fixtures.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    args = parser.parse_args()
+    server = make_server([load_fixture(path) for path in args.fixtures], args.host, args.port, args.latency)
+    print(f"Fake GitHub API listening on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,148 @@
+"""Pull request fixtures for benchmark_review.py and fake_github_server.py.
+
+A fixture is the JSON of everything the review reads from GitHub for one PR: the PR itself, the
+issues it references and the changed files with their patch and head content. Record a real PR:
+
+    GITHUB_TOKEN=... python fixtures.py record OpenRHINO/code-chat-reviewer 37 -o pr37.json
+
+or write the synthetic fixtures (small, files-50, files-500, huge-file) to look at them:
+
+    python fixtures.py synthetic -o fixtures/
+"""
+import os
+import json
+import argparse
+import hashlib
+
+# name -> (files, lines per file, hunks per file)
+SYNTHETIC = {
+    "small": (3, 120, 2),
+    "files-50": (50, 300, 3),
+    "files-500": (500, 200, 2),
+    # Stays below the 1MB limit of the GitHub contents API
+    "huge-file": (1, 20000, 40),
+}
+
+
+def load_fixture(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_fixture(fixture, path):
+    with open(path, "w") as f:
+        json.dump(fixture, f, indent=1)
+
+
+def sha_of(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def synthetic_file(index, line_count, hunk_count):
+    """Returns (head content, patch) of a Python file with hunk_count modified places."""
+    lines = []
+    for i in range(line_count):
+        if i % 10 == 0:
+            lines.append(f"def function_{index}_{i}(value):")
+        else:
+            lines.append(f"    value = transform_{i % 7}(value, {index}, {i})  # step {i}")
+    patch = []
+    offset = 0
+    step = line_count // (hunk_count + 1)
+    for hunk in range(1, hunk_count + 1):
+        # Lines start..start+1 are added in place of one removed line, with 3 lines of context around them
+        start = hunk * step
+        lines[start] = f"    value = changed_{hunk}(value, {index})  # added"
+        lines[start + 1] = f"    value = validated_{hunk}(value)  # added"
+        new_start = start - 3 + 1
+        old_start = new_start - offset
+        patch.append(f"@@ -{old_start},7 +{new_start},8 @@")
+        patch.extend(f" {line}" for line in lines[start - 3:start])
+        patch.append(f"-    value = legacy_{hunk}(value, {index})")
+        patch.extend(f"+{line}" for line in lines[start:start + 2])
+        patch.extend(f" {line}" for line in lines[start + 2:start + 5])
+        offset += 1
+    return "\n".join(lines) + "\n", "\n".join(patch)
+
+
+def synthetic_fixture(name):
+    file_count, line_count, hunk_count = SYNTHETIC[name]
+    files = []
+    for index in range(file_count):
+        content, patch = synthetic_file(index, line_count, hunk_count)
+        files.append({
+            "filename": f"src/module_{index // 50}/file_{index}.py",
+            "status": "modified",
+            "sha": sha_of(content),
+            "additions": hunk_count * 2,
+            "deletions": hunk_count,
+            "changes": hunk_count * 3,
+            "patch": patch,
+            "content": content,
+        })
+    return {
+        "name": name,
+        "repo": f"benchmark/{name}",
+        "pull": {
+            "number": 1,
+            "title": f"Synthetic {name} pull request",
+            "body": f"Refactors the transform pipeline, {file_count} file(s). Fixes #1",
+            "head_sha": sha_of(name),
+        },
+        "issues": [{"number": 1, "title": "Transforms are not validated", "body": "Values are passed on unchecked.",
+                    "pull_request": False}],
+        "files": files,
+    }
+
+
+def record(gh, repo_name, number):
+    """Records a PR from GitHub as a fixture."""
+    import re
+    repo = gh.get_repo(repo_name)
+    pull = repo.get_pull(number)
+    issues = []
+    for ref in sorted(set(int(n) for n in re.findall(r"#(\d+)", pull.body or ""))):
+        issue = repo.get_issue(ref)
+        issues.append({"number": ref, "title": issue.title, "body": issue.body or "",
+                       "pull_request": issue.pull_request is not None})
+    files = []
+    for file in pull.get_files():
+        content = ""
+        if file.status != "removed":
+            content = repo.get_contents(file.filename, ref=pull.head.sha).decoded_content.decode()
+        files.append({
+            "filename": file.filename,
+            "status": file.status,
+            "sha": file.sha,
+            "additions": file.additions,
+            "deletions": file.deletions,
+            "changes": file.changes,
+            "patch": file.patch,
+            "content": content,
+        })
+    return {
+        "name": f"{repo_name}#{number}",
+        "repo": repo_name,
+        "pull": {"number": number, "title": pull.title, "body": pull.body or "", "head_sha": pull.head.sha},
+        "issues": issues,
+        "files": files,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="record a PR from GitHub")
+    record_parser.add_argument("repo")
+    record_parser.add_argument("number", type=int)
+    record_parser.add_argument("-o", "--output", required=True)
+    synthetic_parser = commands.add_parser("synthetic", help="write the synthetic fixtures")
+    synthetic_parser.add_argument("-o", "--output", default=".")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        from github import Github
+        save_fixture(record(Github(os.environ.get("GITHUB_TOKEN")), args.repo, args.number), args.output)
+    else:
+        for name in SYNTHETIC:
+            save_fixture(synthetic_fixture(name), os.path.join(args.output, f"{name}.json"))
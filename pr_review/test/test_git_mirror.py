@@ -0,0 +1,185 @@
+"""Checks the git mirror backend (REVIEW_FETCH_BACKEND=git) against local file:// remotes.
+
+Builds throwaway repos with a PR ref like GitHub's refs/pull/<n>/head in a temporary directory, fetches
+them through git_mirror.GitMirrors and checks the changed files, patches, contents, incremental
+comparisons and the eviction of cold mirrors. Needs only git:
+
+    python test_git_mirror.py
+"""
+import os
+import sys
+import tempfile
+import threading
+import subprocess
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from git_mirror import GitMirrors, GitMirrorError
+
+failures = []
+
+
+def check(name, condition, detail=""):
+    print(f"{'ok  ' if condition else 'FAIL'} {name}" + (f": {detail}" if detail and not condition else ""))
+    if not condition:
+        failures.append(name)
+
+
+def git(cwd, *args):
+    env = {**os.environ, "GIT_AUTHOR_NAME": "test", "GIT_AUTHOR_EMAIL": "test@example.com",
+           "GIT_COMMITTER_NAME": "test", "GIT_COMMITTER_EMAIL": "test@example.com"}
+    return subprocess.run(["git", *args], cwd=cwd, env=env, check=True, capture_output=True).stdout.decode().strip()
+
+
+def write(work, path, data):
+    path = os.path.join(work, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data if isinstance(data, bytes) else data.encode())
+
+
+def commit(work, message):
+    git(work, "add", "-A")
+    git(work, "commit", "-q", "-m", message)
+    return git(work, "rev-parse", "HEAD")
+
+
+def make_remote(remotes, repo):
+    """Returns the work tree of a new remote repo with a main branch and an open PR #1 branch."""
+    remote = os.path.join(remotes, f"{repo}.git")
+    os.makedirs(remote)
+    git(remote, "init", "-q", "--bare")
+    work = tempfile.mkdtemp(dir=remotes)
+    git(work, "init", "-q", "-b", "main")
+    write(work, "app.py", "".join(f"line {i}\n" for i in range(100)))
+    write(work, "old_name.py", "".join(f"print({i})\n" for i in range(50)))
+    write(work, "deleted.txt", "gone soon\n")
+    write(work, "retyped.py", "becomes a symlink\n")
+    write(work, "big.py", "".join(f"x{i} = {i}\n" for i in range(6000)))
+    commit(work, "base")
+    git(work, "remote", "add", "origin", remote)
+    git(work, "push", "-q", "origin", "main")
+    return work, remote
+
+
+def push_pr(work, number):
+    head = git(work, "rev-parse", "HEAD")
+    git(work, "push", "-q", "-f", "origin", f"HEAD:refs/pull/{number}/head")
+    return head
+
+
+def pr(base_sha, head_sha, base_ref="main"):
+    return SimpleNamespace(base=SimpleNamespace(sha=base_sha, ref=base_ref), head=SimpleNamespace(sha=head_sha))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        remotes = os.path.join(tmp, "remotes")
+        mirrors = GitMirrors(os.path.join(tmp, "mirrors"), url_template=f"file://{remotes}/{{repo}}.git",
+                             max_file_bytes=64 * 1024)
+
+        work, _ = make_remote(remotes, "org/service")
+        base = git(work, "rev-parse", "HEAD")
+        git(work, "checkout", "-q", "-b", "feature")
+        write(work, "app.py", "".join(f"line {i}\n" if i % 10 else f"changed {i}\n" for i in range(100)))
+        git(work, "mv", "old_name.py", "new_name.py")
+        git(work, "rm", "-q", "deleted.txt")
+        write(work, "added.py", "def f():\n    return 1\n")
+        write(work, "image.png", b"\x89PNG\r\n\x1a\n\0\0\0binary")
+        write(work, "latin1.txt", "caf\xe9\n".encode("latin-1"))
+        write(work, "huge.txt", "".join(f"row {i}\n" for i in range(20000)))
+        # Every line changes: GitHub leaves the patch of such a diff out
+        write(work, "big.py", "".join(f"x{i} = {i + 1}\n" for i in range(6000)))
+        os.symlink("app.py", os.path.join(work, "link.py"))
+        # A type change, which git prints as two patches: the removed file and the added symlink
+        os.remove(os.path.join(work, "retyped.py"))
+        os.symlink("app.py", os.path.join(work, "retyped.py"))
+        head = commit(work, "feature")
+        push_pr(work, 1)
+
+        mirror = mirrors.fetch("org/service", 1, "main", head)
+        files = {file.filename: file for file in mirror.fetch_files(pr(base, head))}
+        expected = {
+            "app.py": "modified", "new_name.py": "renamed", "deleted.txt": "removed", "added.py": "added",
+            "image.png": "added", "latin1.txt": "added", "huge.txt": "added", "big.py": "modified", "link.py": "added",
+            "retyped.py": "changed",
+        }
+        check("file statuses", {name: file.status for name, file in files.items()} == expected,
+              {name: file.status for name, file in files.items()})
+        check("rename source", files["new_name.py"].previous_filename == "old_name.py")
+        check("patch of a modified file", files["app.py"].patch.startswith("@@ -1,") and "+changed 10" in files["app.py"].patch)
+        check("counts of a modified file", (files["app.py"].additions, files["app.py"].deletions) == (10, 10))
+        check("patch of a large diff", files["big.py"].patch is not None and files["big.py"].changes == 12000,
+              files["big.py"].changes)
+        check("no patch for a binary file", files["image.png"].patch is None)
+        check("patch of a type change", "-becomes a symlink" in (files["retyped.py"].patch or "")
+              and "+app.py" in (files["retyped.py"].patch or ""), files["retyped.py"].patch)
+        check("counts of a type change", (files["retyped.py"].additions, files["retyped.py"].deletions) == (1, 1))
+
+        changed = list(files.values())
+        contents = dict(zip((file.filename for file in changed), mirror.fetch_contents(None, changed, head)))
+        check("text content", contents["added.py"] == ("def f():\n    return 1\n", None), contents["added.py"])
+        check("binary note", contents["image.png"] == (None, "binary file"), contents["image.png"])
+        check("encoding note", contents["latin1.txt"] == (None, "not UTF-8 text"), contents["latin1.txt"])
+        check("size note", contents["huge.txt"] == (None, "larger than 65536 bytes"), contents["huge.txt"])
+        check("symlink note", contents["link.py"] == (None, "not a regular file"), contents["link.py"])
+        check("type change note", contents["retyped.py"] == (None, "not a regular file"), contents["retyped.py"])
+        check("removed file", contents["deleted.txt"] == (None, None), contents["deleted.txt"])
+
+        # A push on top of the reviewed head is compared incrementally
+        write(work, "added.py", "def f():\n    return 2\n")
+        second = commit(work, "follow-up")
+        push_pr(work, 1)
+        mirror = mirrors.fetch("org/service", 1, "main", second)
+        compared = mirror.fetch_compare_files(None, head, second)
+        check("incremental files", [file.filename for file in compared or []] == ["added.py"])
+        check("unknown base", mirror.fetch_compare_files(None, "0" * 40, second) is None)
+
+        # A force-push that drops the reviewed head needs a full review
+        git(work, "reset", "-q", "--hard", base)
+        write(work, "rewritten.py", "x = 1\n")
+        rewritten = commit(work, "rewritten")
+        push_pr(work, 1)
+        mirror = mirrors.fetch("org/service", 1, "main", rewritten)
+        check("force-push", mirror.fetch_compare_files(None, second, rewritten) is None)
+
+        try:
+            mirrors.fetch("org/service", 1, "main", second[:-4] + "0000")
+            check("unknown head", False, "no error")
+        except GitMirrorError:
+            check("unknown head", True)
+
+        # Concurrent fetches of the same repo are serialized
+        errors = []
+
+        def fetch():
+            try:
+                mirrors.fetch("org/service", 1, "main", rewritten)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        check("concurrent fetches", not errors, errors)
+
+        # With a budget below one clone, fetching another repo evicts the idle one
+        other_work, _ = make_remote(remotes, "org/other")
+        git(other_work, "checkout", "-q", "-b", "feature")
+        write(other_work, "app.py", "changed\n")
+        other_head = commit(other_work, "feature")
+        push_pr(other_work, 7)
+        mirrors.max_bytes = 1
+        mirrors.min_idle_seconds = 0
+        mirrors.fetch("org/other", 7, "main", other_head)
+        check("cold mirror evicted", not os.path.exists(os.path.join(tmp, "mirrors", "org", "service.git")))
+        check("fetched mirror kept", os.path.exists(os.path.join(tmp, "mirrors", "org", "other.git")))
+
+    print(f"\n{len(failures)} failure(s)" if failures else "\nAll checks passed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Checks the admission of llm_scheduler.LLMScheduler against the shared token budget.
+
+Uses an in-memory MongoDB for the budget (`pip install mongomock`):
+
+    python test_llm_scheduler.py
+"""
+import os
+import sys
+import time
+import threading
+import mongomock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llm_scheduler import BULK, INTERACTIVE, REVIEW, LLMScheduler, TokenBudget
+
+MODEL = "gpt-test"
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+failures = []
+
+
+def check(name, condition, detail=""):
+    print(f"{'ok  ' if condition else 'FAIL'} {name}" + (f": {detail}" if detail and not condition else ""))
+    if not condition:
+        failures.append(name)
+
+
+def admit_in_thread(scheduler, priority):
+    """Starts a request in a thread; returns the event set once it was admitted."""
+    admitted = threading.Event()
+
+    def run():
+        with scheduler.admit(MODEL, MESSAGES, repo="org/repo", priority=priority) as settle:
+            admitted.set()
+            settle({"prompt_tokens": 5, "completion_tokens": 15})
+
+    threading.Thread(target=run, daemon=True).start()
+    return admitted
+
+
+def main():
+    budget = TokenBudget(mongomock.MongoClient().db.llm_budget, tpm_limits={MODEL: 1000},
+                         bulk_share=0.8, review_share=0.9)
+    scheduler = LLMScheduler(lambda model: 4, budget, completion_tokens=20)
+    # The checks below have to happen within one minute of the budget
+    if budget.seconds_to_next_window() < 10:
+        time.sleep(budget.seconds_to_next_window() + 0.1)
+
+    # Bulk reviews used up almost all of their share of this minute
+    check("bulk share filled", budget.reserve(MODEL, 790, BULK) is not None)
+    bulk = admit_in_thread(scheduler, BULK)
+    check("bulk waits for the next minute", not bulk.wait(1))
+
+    # Small reviews and chat turns have larger shares and are not held up by the bulk request
+    review = admit_in_thread(scheduler, REVIEW)
+    check("review admitted while bulk waits", review.wait(2))
+    interactive = admit_in_thread(scheduler, INTERACTIVE)
+    check("interactive admitted while bulk waits", interactive.wait(2))
+    check("bulk still waiting", not bulk.is_set())
+
+    # Once the review share is used up as well, only chat turns go on
+    check("review share filled", budget.reserve(MODEL, 60, REVIEW) is not None)
+    review = admit_in_thread(scheduler, REVIEW)
+    check("review waits for the next minute", not review.wait(1))
+    interactive = admit_in_thread(scheduler, INTERACTIVE)
+    check("interactive admitted while review waits", interactive.wait(2))
+
+    # A rate limit error of the provider holds back every priority
+    scheduler.pause(MODEL, 1.5)
+    interactive = admit_in_thread(scheduler, INTERACTIVE)
+    check("interactive waits during a pause", not interactive.wait(0.5))
+    check("interactive admitted after the pause", interactive.wait(3))
+
+    print(f"\n{len(failures)} failure(s)" if failures else "\nAll checks passed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
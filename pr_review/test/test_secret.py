@@ -3,6 +3,7 @@ import json
 import hmac
 import hashlib
 import os
+import uuid
 
 # Replace these variables with your own values
 url = os.environ.get("TEST_REVIEW_ENDPOINT", "http://127.0.0.1:8080/review_pr")
@@ -40,7 +41,10 @@ payload = {
         "pull_request": {
           "number": 2,
           "title": "Sample Pull Request",
-          "body": "This is a sample pull request."
+          "body": "This is a sample pull request.",
+          "head": {
+            "sha": os.environ.get("TEST_HEAD_SHA", "0000000000000000000000000000000000000000")
+          }
         },
         "repository": {
           "full_name": "LI-Mingyu/cndev-tutorial"
@@ -50,7 +54,8 @@ payload = {
 
 headers = {
     "Content-Type": "application/json",
-    "X-GitHub-Event": "pull_request"
+    "X-GitHub-Event": "pull_request",
+    "X-GitHub-Delivery": str(uuid.uuid4())
 }
 
 def create_signature(payload, secret):
@@ -0,0 +1,35 @@
+# token_counter.py
+import threading
+import logging
+
+logger = logging.getLogger()
+
+# Encoding used by the gpt-4 and gpt-3.5-turbo models
+ENCODING_NAME = "cl100k_base"
+
+_encoding = None
+_encoding_loaded = False
+_lock = threading.Lock()
+
+
+def _get_encoding():
+    # The BPE file is downloaded into TIKTOKEN_CACHE_DIR at image build time, so loading it needs no network
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(ENCODING_NAME)
+                except Exception as e:
+                    logger.warning(f"tiktoken encoding {ENCODING_NAME} unavailable, estimating tokens from text length: {e}")
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is None:
+        # Roughly four characters per token for English text and code
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))